@@ -0,0 +1,103 @@
+"""Alert lifecycle events pushed to dashboards over the socket
+
+Events (payloads are alert dicts with the owning device_id added):
+
+- alert_created: a new alert was raised
+- alert_escalated: a new alert was raised for a device and condition that
+  already had an open alert of lower severity
+- alert_acknowledged: {'ids': [...], 'device_id': ...} alerts were acknowledged
+
+Dashboards get them by joining the dashboard room (socket event
+`dashboard_subscribe`); ward walls only get acknowledgments for the devices
+they watch. The same events go to the device's SSE / long-poll stream (see
+streams.py).
+"""
+import logging
+
+from flask_socketio import join_room
+
+from app import socketio, db
+from models import HealthData, Alert, ALERT_SEVERITIES
+from streams import publish, DASHBOARD_ROOM, device_room
+
+logger = logging.getLogger(__name__)
+
+def open_severities(device_id, conditions, exclude_ids=()):
+    """Highest severity rank of open alerts per condition for one device"""
+    rows = (db.session.query(Alert.id, Alert.condition, Alert.severity)
+            .join(HealthData, Alert.health_data_id == HealthData.id)
+            .filter(HealthData.device_id == device_id,
+                    Alert.acknowledged.is_(False),
+                    Alert.condition.in_(conditions)))
+    ranks = {}
+    for alert_id, condition, severity in rows:
+        if alert_id in exclude_ids:
+            continue
+        ranks[condition] = max(ranks.get(condition, -1), ALERT_SEVERITIES.index(severity))
+    return ranks
+
+def classify_new_alerts(device_id, new_alerts):
+    """Pair each new alert with its lifecycle event name
+
+    Must run before the new alerts are flushed, or they would be compared
+    against themselves.
+    """
+    if not new_alerts:
+        return []
+    previous = open_severities(device_id, {a.condition for a in new_alerts},
+                               exclude_ids={a.id for a in new_alerts})
+    events = []
+    for alert in new_alerts:
+        escalated = ALERT_SEVERITIES.index(alert.severity) > previous.get(alert.condition, len(ALERT_SEVERITIES))
+        events.append(('alert_escalated' if escalated else 'alert_created', alert))
+    return events
+
+def classify_alert_batch(device_alerts):
+    """classify_new_alerts for a batch of (device_id, new_alerts), in arrival order
+
+    Open alerts are read with one query; alerts raised earlier in the batch
+    count as open for later ones. Must run before the batch is flushed.
+    Returns one event list per entry.
+    """
+    device_ids = {device_id for device_id, new_alerts in device_alerts if new_alerts}
+    ranks = {}
+    if device_ids:
+        rows = (db.session.query(HealthData.device_id, Alert.condition, Alert.severity)
+                .join(HealthData, Alert.health_data_id == HealthData.id)
+                .filter(HealthData.device_id.in_(device_ids), Alert.acknowledged.is_(False)))
+        for device_id, condition, severity in rows:
+            key = (device_id, condition)
+            ranks[key] = max(ranks.get(key, -1), ALERT_SEVERITIES.index(severity))
+
+    results = []
+    for device_id, new_alerts in device_alerts:
+        events = []
+        for alert in new_alerts:
+            key = (device_id, alert.condition)
+            rank = ALERT_SEVERITIES.index(alert.severity)
+            escalated = rank > ranks.get(key, len(ALERT_SEVERITIES))
+            events.append(('alert_escalated' if escalated else 'alert_created', alert))
+            ranks[key] = max(ranks.get(key, -1), rank)
+        results.append(events)
+    return results
+
+@socketio.on('dashboard_subscribe')
+def on_dashboard_subscribe(*args):
+    """Add a dashboard socket to the room that gets every reading and alert event"""
+    join_room(DASHBOARD_ROOM)
+
+def publish_alert_events(device_id, events):
+    """Emit classified alert events to connected dashboards"""
+    for event, alert in events:
+        payload = {**alert.to_dict(), 'device_id': device_id}
+        socketio.emit(event, payload, to=DASHBOARD_ROOM)
+        publish(device_id, event, payload)
+
+def publish_acknowledged(alert_ids, device_id=None):
+    """Emit an acknowledgment event for one or more alerts to dashboards and the device's watchers"""
+    if alert_ids:
+        payload = {'ids': list(alert_ids), 'device_id': device_id}
+        socketio.emit('alert_acknowledged', payload,
+                      to=[DASHBOARD_ROOM, device_room(device_id)] if device_id else DASHBOARD_ROOM)
+        if device_id:
+            publish(device_id, 'alert_acknowledged', payload)
@@ -0,0 +1,204 @@
+"""Population-level cohort analytics for HealthSense
+
+Cohort queries rank devices across the whole population. The work happens
+in the database, using window functions and GROUP BY with one round trip
+per query, or in vectorized NumPy over the column store when that backend
+serves readings. Only the ranked result rows reach Python. With device
+shards, each shard ranks its own devices and merge_rankings() combines the
+top entries of every shard.
+"""
+import operator
+
+import numpy as np
+from sqlalchemy import case, func, select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.types import Float
+
+from models import HealthData, Prediction, VITAL_FIELDS
+from shards import merge_sorted
+
+RISK_FIELDS = ('diabetes_risk', 'heart_disease_risk', 'hypoxia_risk')
+COMPARISONS = {'lt': operator.lt, 'le': operator.le, 'gt': operator.gt, 'ge': operator.ge}
+
+class epoch_seconds(FunctionElement):
+    """Seconds since the Unix epoch of an ISO timestamp string column"""
+    type = Float()
+    inherit_cache = True
+
+@compiles(epoch_seconds)
+def _epoch_seconds_default(element, compiler, **kw):
+    return f"EXTRACT(EPOCH FROM CAST({compiler.process(element.clauses, **kw)} AS TIMESTAMP))"
+
+@compiles(epoch_seconds, 'sqlite')
+def _epoch_seconds_sqlite(element, compiler, **kw):
+    return f"((julianday({compiler.process(element.clauses, **kw)}) - 2440587.5) * 86400.0)"
+
+@compiles(epoch_seconds, 'mysql')
+def _epoch_seconds_mysql(element, compiler, **kw):
+    return f"UNIX_TIMESTAMP({compiler.process(element.clauses, **kw)})"
+
+def _check_choice(name, value, choices):
+    if value not in choices:
+        raise ValueError(f"{name} must be one of {', '.join(choices)}")
+
+def episode_order(entry):
+    """Sort key of threshold_episodes results: longest run, then total time"""
+    return (-entry['longest_seconds'], -entry['total_seconds'])
+
+def risk_order(entry):
+    """Sort key of top_devices_by_risk results"""
+    return (-entry['mean_risk'],)
+
+def merge_rankings(results, order, limit=50):
+    """Combine per-shard rankings of disjoint devices into one ranking
+
+    results are the (shard, entries) pairs returned by scatter(). Each
+    shard's top `limit` entries are enough, since a device ranked lower on
+    its own shard cannot make the overall top `limit`. Ties share a rank.
+    """
+    if len(results) == 1:
+        return results[0][1]
+    merged = merge_sorted(results, key=lambda entry: (order(entry), entry['device_id']), limit=limit)
+    for position, entry in enumerate(merged):
+        if position and order(entry) == order(merged[position - 1]):
+            entry['rank'] = merged[position - 1]['rank']
+        else:
+            entry['rank'] = position + 1
+    return merged
+
+def threshold_episodes(session, vital, op, value, min_seconds, start_time, end_time=None, limit=50):
+    """Rank devices by their longest run of readings past a threshold
+
+    A run is a sequence of consecutive readings of one device that all
+    satisfy `vital op value`. It lasts from its first to its last reading.
+    Only runs of at least min_seconds count. Returns dicts with rank,
+    device_id, episodes, longest_seconds and total_seconds.
+    """
+    _check_choice('vital', vital, VITAL_FIELDS)
+    _check_choice('op', op, COMPARISONS)
+    table = HealthData.__table__
+
+    breach = case((COMPARISONS[op](table.c[vital], value), 1), else_=0)
+    flagged = (select(table.c.id, table.c.device_id, table.c.timestamp, breach.label('breach'))
+               .where(table.c.timestamp >= start_time))
+    if end_time:
+        flagged = flagged.where(table.c.timestamp < end_time)
+    flagged = flagged.subquery()
+
+    # Gaps and islands: every non-breaching reading starts a new group, so the
+    # breaching readings of one run share a group number
+    group = func.sum(1 - flagged.c.breach).over(partition_by=flagged.c.device_id,
+                                                order_by=(flagged.c.timestamp, flagged.c.id), rows=(None, 0))
+    runs = select(flagged.c.device_id, flagged.c.timestamp, flagged.c.breach, group.label('run')).subquery()
+
+    seconds = epoch_seconds(func.max(runs.c.timestamp)) - epoch_seconds(func.min(runs.c.timestamp))
+    episodes = (select(runs.c.device_id, seconds.label('seconds'))
+                .where(runs.c.breach == 1)
+                .group_by(runs.c.device_id, runs.c.run)
+                .having(seconds >= min_seconds)
+                .subquery())
+
+    per_device = (select(episodes.c.device_id,
+                         func.count().label('episodes'),
+                         func.max(episodes.c.seconds).label('longest_seconds'),
+                         func.sum(episodes.c.seconds).label('total_seconds'))
+                  .group_by(episodes.c.device_id)
+                  .subquery())
+    rank = func.rank().over(order_by=(per_device.c.longest_seconds.desc(), per_device.c.total_seconds.desc()))
+    query = (select(per_device, rank.label('rank'))
+             .order_by(rank, per_device.c.device_id)
+             .limit(limit))
+    return [
+        {
+            'rank': row.rank,
+            'device_id': row.device_id,
+            'episodes': row.episodes,
+            'longest_seconds': round(float(row.longest_seconds), 3),
+            'total_seconds': round(float(row.total_seconds), 3)
+        }
+        for row in session.execute(query)
+    ]
+
+def threshold_episodes_columnar(columns, vital, op, value, min_seconds, limit=50):
+    """threshold_episodes over column store arrays, with vector operations"""
+    _check_choice('vital', vital, VITAL_FIELDS)
+    _check_choice('op', op, COMPARISONS)
+    if not len(columns['timestamp']):
+        return []
+
+    devices, codes = np.unique(columns['device_id'].astype(str), return_inverse=True)
+    order = np.lexsort((columns['timestamp'], codes))
+    timestamps = np.asarray(columns['timestamp'])[order]
+    codes = codes[order]
+    breach = COMPARISONS[op](np.asarray(columns[vital], dtype=np.float64)[order], value)
+
+    # A run starts at a breaching reading whose predecessor (same device) did
+    # not breach, and ends at one whose successor does not
+    same_as_previous = np.r_[False, codes[1:] == codes[:-1]]
+    starts = np.flatnonzero(breach & ~(same_as_previous & np.r_[False, breach[:-1]]))
+    ends = np.flatnonzero(breach & ~(np.r_[same_as_previous[1:], False] & np.r_[breach[1:], False]))
+    seconds = (timestamps[ends] - timestamps[starts]) / 1e6
+    keep = seconds >= min_seconds
+    run_devices, seconds = codes[starts][keep], seconds[keep]
+    if not len(seconds):
+        return []
+
+    episodes = np.bincount(run_devices, minlength=len(devices))
+    total = np.bincount(run_devices, weights=seconds, minlength=len(devices))
+    longest = np.zeros(len(devices))
+    np.maximum.at(longest, run_devices, seconds)
+
+    candidates = np.flatnonzero(episodes)
+    ranked = candidates[np.lexsort((devices[candidates], -total[candidates], -longest[candidates]))]
+    results = []
+    for position, index in enumerate(ranked[:limit]):
+        if position and (longest[index], total[index]) == (longest[ranked[position - 1]], total[ranked[position - 1]]):
+            rank = results[-1]['rank']
+        else:
+            rank = position + 1
+        results.append({
+            'rank': rank,
+            'device_id': str(devices[index]),
+            'episodes': int(episodes[index]),
+            'longest_seconds': round(float(longest[index]), 3),
+            'total_seconds': round(float(total[index]), 3)
+        })
+    return results
+
+def top_devices_by_risk(session, risk, start_time, end_time=None, limit=50, min_readings=1):
+    """Rank devices by mean predicted risk over readings in a time window
+
+    Returns dicts with rank, device_id, mean_risk, max_risk and readings.
+    """
+    _check_choice('risk', risk, RISK_FIELDS)
+    readings = HealthData.__table__
+    risks = Prediction.__table__
+    value = risks.c[risk]
+
+    per_device = (select(readings.c.device_id,
+                         func.avg(value).label('mean_risk'),
+                         func.max(value).label('max_risk'),
+                         func.count().label('readings'))
+                  .select_from(readings.join(risks, risks.c.health_data_id == readings.c.id))
+                  .where(readings.c.timestamp >= start_time))
+    if end_time:
+        per_device = per_device.where(readings.c.timestamp < end_time)
+    per_device = (per_device
+                  .group_by(readings.c.device_id)
+                  .having(func.count() >= min_readings)
+                  .subquery())
+    rank = func.rank().over(order_by=per_device.c.mean_risk.desc())
+    query = (select(per_device, rank.label('rank'))
+             .order_by(rank, per_device.c.device_id)
+             .limit(limit))
+    return [
+        {
+            'rank': row.rank,
+            'device_id': row.device_id,
+            'mean_risk': float(row.mean_risk),
+            'max_risk': float(row.max_risk),
+            'readings': row.readings
+        }
+        for row in session.execute(query)
+    ]
@@ -0,0 +1,273 @@
+"""Per-device streaming anomaly detection for HealthSense
+
+Each device keeps an exponentially weighted mean and variance of every
+vital (EWMA / EWMVar), updated in O(1) per reading. A reading is anomalous
+when a vital's z-score against the device's own baseline exceeds
+HEALTHSENSE_ANOMALY_Z. This catches changes that stay inside the absolute
+alert thresholds but are unusual for that patient.
+
+The update is a Huber-style robust step: deviations are clipped at the
+threshold before they move the baseline, so one outlier cannot drag it. The
+state of a device is one 80-byte row in device_baselines (five means, five
+variances), written in the reading's transaction, so it survives restarts
+without replaying history. The row is locked before it is read, so
+concurrent readings of one device (several workers, or lanes disabled)
+apply their steps one after the other. Every function works on arrays, so a batch of
+devices is updated with a few vector operations:
+
+    python anomaly.py rebuild    # recompute all baselines from stored readings
+"""
+import argparse
+import logging
+import os
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import select, tuple_
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+# Weight of the newest reading in the baseline (about 1 / readings remembered)
+ANOMALY_ALPHA = float(os.environ.get("HEALTHSENSE_ANOMALY_ALPHA", 0.05))
+# Z-score above which a vital is flagged (0 disables detection)
+ANOMALY_Z = float(os.environ.get("HEALTHSENSE_ANOMALY_Z", 4.0))
+# Readings a device needs before its baseline is trusted
+ANOMALY_WARMUP = int(os.environ.get("HEALTHSENSE_ANOMALY_WARMUP", 20))
+
+VITALS = ('glucose', 'bp_systolic', 'bp_diastolic', 'spo2', 'heart_rate')
+VITAL_LABELS = {
+    'glucose': ('glucose', 'mg/dL'),
+    'bp_systolic': ('systolic blood pressure', 'mmHg'),
+    'bp_diastolic': ('diastolic blood pressure', 'mmHg'),
+    'spo2': ('oxygen saturation', '%'),
+    'heart_rate': ('heart rate', 'BPM'),
+}
+# Variance floor per vital so a very steady baseline does not flag noise
+MIN_STD = np.array([5.0, 4.0, 3.0, 1.0, 3.0])
+
+def ewma_step(mean, var, count, values, alpha=None, z_threshold=None):
+    """Advance baselines by one reading each
+
+    mean, var and values are (n, 5) arrays and count is (n,). Returns the new
+    (mean, var, count) and the (n, 5) z-scores of values against the old
+    baseline. z-scores are NaN until a baseline has seen the warmup count.
+    """
+    alpha = ANOMALY_ALPHA if alpha is None else alpha
+    z_threshold = ANOMALY_Z if z_threshold is None else z_threshold
+    std = np.maximum(np.sqrt(var), MIN_STD)
+    diff = values - mean
+    z = np.where((count >= ANOMALY_WARMUP)[:, None], diff / std, np.nan)
+
+    # The first reading seeds the mean; later outliers move it only by a clipped step
+    first = (count == 0)[:, None]
+    if z_threshold > 0:
+        trusted = (count >= ANOMALY_WARMUP)[:, None]
+        diff = np.where(trusted, np.clip(diff, -z_threshold * std, z_threshold * std), diff)
+    step = alpha * diff
+    new_mean = np.where(first, values, mean + step)
+    new_var = np.where(first, 0.0, (1 - alpha) * (var + diff * step))
+    return new_mean, new_var, count + 1, z
+
+def pack_state(mean, var):
+    """Serialize one device baseline into 80 bytes"""
+    return np.concatenate([mean, var]).astype('<f8').tobytes()
+
+def unpack_state(state):
+    values = np.frombuffer(state, dtype='<f8')
+    return values[:len(VITALS)], values[len(VITALS):]
+
+def anomaly_alerts(values, z, z_threshold=None):
+    """Alert dicts (like get_health_alerts) for the flagged vitals of one reading"""
+    z_threshold = ANOMALY_Z if z_threshold is None else z_threshold
+    if z_threshold <= 0:
+        return []
+    with np.errstate(invalid='ignore'):
+        flagged = np.flatnonzero(np.abs(z) > z_threshold)
+    if not len(flagged):
+        return []
+    parts = []
+    for i in flagged:
+        label, unit = VITAL_LABELS[VITALS[i]]
+        direction = 'above' if z[i] > 0 else 'below'
+        parts.append(f"{label} {values[i]:g} {unit} ({abs(z[i]):.1f} SD {direction} baseline)")
+    return [{
+        "condition": "baseline_deviation",
+        "message": "Unusual for this patient: " + ", ".join(parts),
+        "severity": "high" if np.nanmax(np.abs(z)) > 2 * z_threshold else "medium"
+    }]
+
+def _locked_baselines(device_ids):
+    """Load baselines for update, creating the missing ones with count 0
+
+    Existing rows are touched first, which takes the row lock (PostgreSQL)
+    or the write lock (SQLite) before anything is read. Missing rows are
+    inserted in a savepoint; if a concurrent first reading inserted one
+    first, the SELECT ... FOR UPDATE below waits for it and reads its row.
+    Returns {device_id: DeviceBaseline}.
+    """
+    from app import db
+    from models import DeviceBaseline
+
+    device_ids = sorted(set(device_ids))
+    now = datetime.utcnow().isoformat()
+    touched = (DeviceBaseline.query
+               .filter(DeviceBaseline.device_id.in_(device_ids))
+               .update({'updated_at': now}, synchronize_session=False))
+    if touched < len(device_ids):
+        existing = {row[0] for row in (db.session.query(DeviceBaseline.device_id)
+                                       .filter(DeviceBaseline.device_id.in_(device_ids)))}
+        missing = [device_id for device_id in device_ids if device_id not in existing]
+        try:
+            _insert_baselines(db, DeviceBaseline, missing, now)
+        except IntegrityError:
+            # Another worker created some of the rows first
+            for device_id in missing:
+                try:
+                    _insert_baselines(db, DeviceBaseline, [device_id], now)
+                except IntegrityError:
+                    pass
+    return {b.device_id: b for b in (DeviceBaseline.query
+                                     .filter(DeviceBaseline.device_id.in_(device_ids))
+                                     .order_by(DeviceBaseline.device_id)
+                                     .with_for_update()
+                                     .populate_existing())}
+
+def _insert_baselines(db, model, device_ids, now):
+    with db.session.begin_nested():
+        db.session.execute(model.__table__.insert(),
+                           [{'device_id': device_id, 'count': 0, 'state': bytes(80), 'updated_at': now}
+                            for device_id in device_ids])
+
+def update_baseline(reading):
+    """Update the reading's device baseline in the current session
+
+    Returns alert dicts for vitals that deviate from the baseline.
+    """
+    if ANOMALY_Z <= 0:
+        return []
+    values = np.array([[getattr(reading, name) for name in VITALS]], dtype=np.float64)
+    baseline = _locked_baselines([reading.device_id])[reading.device_id]
+    mean, var = unpack_state(baseline.state)
+
+    new_mean, new_var, count, z = ewma_step(mean[None], var[None], np.array([baseline.count or 0]), values)
+    baseline.state = pack_state(new_mean[0], new_var[0])
+    baseline.count = int(count[0])
+    baseline.updated_at = datetime.utcnow().isoformat()
+    return anomaly_alerts(values[0], z[0])
+
+def update_baselines(readings):
+    """update_baseline for a batch of time-ordered readings, with one query
+
+    Returns a list of alert dict lists, one per reading.
+    """
+    if ANOMALY_Z <= 0:
+        return [[] for _ in readings]
+    device_ids = [reading.device_id for reading in readings]
+    values = np.array([[getattr(reading, name) for name in VITALS] for reading in readings], dtype=np.float64)
+    baselines = _locked_baselines(device_ids)
+    states = {device: (*unpack_state(b.state), b.count or 0) for device, b in baselines.items()}
+
+    z = update_baselines_batch(device_ids, values, states)
+
+    now = datetime.utcnow().isoformat()
+    for device, (mean, var, count) in states.items():
+        baseline = baselines[str(device)]
+        baseline.state = pack_state(mean, var)
+        baseline.count = count
+        baseline.updated_at = now
+    return [anomaly_alerts(values[i], z[i]) for i in range(len(readings))]
+
+def update_baselines_batch(device_ids, values, states):
+    """Advance many device baselines over a batch of time-ordered readings
+
+    device_ids is a length-n sequence and values an (n, 5) array. states
+    maps device id to (mean, var, count) and is updated in place. Readings
+    of one device are applied in order: round k applies every device's
+    k-th reading as one vector step. Returns the (n, 5) z-scores.
+    """
+    device_ids = np.asarray(device_ids)
+    values = np.asarray(values, dtype=np.float64)
+    devices, codes = np.unique(device_ids, return_inverse=True)
+    mean = np.zeros((len(devices), len(VITALS)))
+    var = np.zeros((len(devices), len(VITALS)))
+    count = np.zeros(len(devices), dtype=np.int64)
+    for i, device in enumerate(devices):
+        if device in states:
+            mean[i], var[i], count[i] = states[device]
+
+    # Rank of each reading among its device's readings in this batch
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    group_starts = np.r_[0, np.flatnonzero(sorted_codes[1:] != sorted_codes[:-1]) + 1]
+    ranks = np.empty(len(codes), dtype=np.int64)
+    ranks[order] = np.arange(len(codes)) - np.repeat(group_starts, np.diff(np.r_[group_starts, len(codes)]))
+
+    z = np.full(values.shape, np.nan)
+    for k in range(int(ranks.max()) + 1 if len(ranks) else 0):
+        rows = np.flatnonzero(ranks == k)
+        targets = codes[rows]
+        new_mean, new_var, new_count, z[rows] = ewma_step(mean[targets], var[targets], count[targets], values[rows])
+        mean[targets], var[targets], count[targets] = new_mean, new_var, new_count
+
+    for i, device in enumerate(devices):
+        states[device] = (mean[i], var[i], int(count[i]))
+    return z
+
+def rebuild(batch_size=50000):
+    """Recompute every device baseline by streaming stored readings in time order
+
+    Each shard's baselines are rebuilt from that shard's readings.
+    """
+    from app import app
+    from shards import on_shard, shard_names
+
+    processed = devices = 0
+    with app.app_context():
+        for shard in shard_names():
+            with on_shard(shard):
+                shard_processed, shard_devices = _rebuild_shard(batch_size)
+            processed += shard_processed
+            devices += shard_devices
+    return processed, devices
+
+def _rebuild_shard(batch_size):
+    from app import db
+    from models import HealthData, DeviceBaseline
+
+    table = HealthData.__table__
+    states = {}
+    processed = 0
+    last = None
+    while True:
+        query = (select(table.c.timestamp, table.c.id, table.c.device_id, *[table.c[name] for name in VITALS])
+                 .order_by(table.c.timestamp, table.c.id)
+                 .limit(batch_size))
+        if last is not None:
+            query = query.where(tuple_(table.c.timestamp, table.c.id) > last)
+        rows = db.session.execute(query).all()
+        if not rows:
+            break
+        update_baselines_batch([row[2] for row in rows], [row[3:] for row in rows], states)
+        processed += len(rows)
+        last = (rows[-1][0], rows[-1][1])
+        logger.info(f"Replayed {processed} readings")
+
+    now = datetime.utcnow().isoformat()
+    DeviceBaseline.query.delete()
+    if states:
+        db.session.execute(DeviceBaseline.__table__.insert(), [
+            {'device_id': str(device), 'count': count, 'state': pack_state(mean, var), 'updated_at': now}
+            for device, (mean, var, count) in states.items()
+        ])
+    db.session.commit()
+    return processed, len(states)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='HealthSense per-device anomaly baselines')
+    parser.add_argument('command', choices=['rebuild'], help='rebuild: recompute baselines from stored readings')
+    parser.add_argument('--batch-size', type=int, default=50000, help='Readings per database batch')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    processed, devices = rebuild(args.batch_size)
+    print(f"Rebuilt baselines for {devices} devices from {processed} readings")
@@ -1,12 +1,15 @@
 import os
 import logging
-import pickle
+import threading
 from flask import Flask
 from flask_cors import CORS
 from flask_socketio import SocketIO
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 
+from replicas import REPLICA_BIND, REPLICA_URI
+from shards import ShardedSession, binds_config
+
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -15,43 +18,140 @@ logger = logging.getLogger(__name__)
 class Base(DeclarativeBase):
     pass
 
-# Initialize SQLAlchemy
-db = SQLAlchemy(model_class=Base)
+# Initialize extensions; they are bound to the app in create_app()
+db = SQLAlchemy(model_class=Base, session_options={"class_": ShardedSession})
+socketio = SocketIO()
 
-# Create Flask app
-app = Flask(__name__)
-app.secret_key = os.environ.get("SESSION_SECRET", "healthsense_default_secret")
+# Initialize in-memory data storage (for transition phase); several ingest
+# lanes append at once, so changes and reads go through memory_lock
+health_data = []
+predictions = []
+alerts = []
+memory_lock = threading.Lock()
 
-# Configure database
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("SQLALCHEMY_DATABASE_URI")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
+def remember(items, item, limit):
+    """Append to an in-memory list, dropping the oldest entries beyond limit"""
+    with memory_lock:
+        items.append(item)
+        del items[:-limit]
 
-# Initialize extensions
-db.init_app(app)
+def recent(items):
+    """A copy of an in-memory list that is safe to iterate while ingest appends"""
+    with memory_lock:
+        return list(items)
 
-# Enable CORS
-CORS(app)
+def create_app():
+    """Create and configure the Flask application
 
-# Setup SocketIO for real-time updates
-socketio = SocketIO(app, cors_allowed_origins="*")
+    Only configuration happens here, so importing the app is fast for web
+    workers, CLI tools and tests alike. Schema changes are made by
+    `python migrate.py upgrade`, models load on first use, and background
+    threads are started by start_services().
+    """
+    app = Flask(__name__)
+    app.secret_key = os.environ.get("SESSION_SECRET", "healthsense_default_secret")
 
-# Initialize in-memory data storage (for transition phase)
-health_data = []
-predictions = []
-alerts = []
+    # Configure database; pool sizing, pre-ping and slow query logging are
+    # set through HEALTHSENSE_DB_* variables (see db_health.py)
+    from db_health import engine_options
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("SQLALCHEMY_DATABASE_URI")
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config["SQLALCHEMY_DATABASE_URI"])
+
+    # Read replica for dashboard and report queries (see replicas.py) and
+    # one bind per device shard (see shards.py)
+    binds = binds_config()
+    if REPLICA_URI:
+        binds[REPLICA_BIND] = {"url": REPLICA_URI, **engine_options(REPLICA_URI)}
+    if binds:
+        app.config["SQLALCHEMY_BINDS"] = binds
+
+    # Schema mode: "legacy" keeps text UUID keys and string enums, "compact" uses
+    # time-ordered native UUID keys and small-integer enum codes
+    app.config["HEALTHSENSE_SCHEMA_MODE"] = os.environ.get("HEALTHSENSE_SCHEMA_MODE", "legacy")
+
+    # Readings backend: "sql" serves history from the health_data table,
+    # "columnar" mirrors readings into memory-mapped column files and serves
+    # history and rollups from there (predictions and alerts stay in SQL)
+    app.config["HEALTHSENSE_READINGS_BACKEND"] = os.environ.get("HEALTHSENSE_READINGS_BACKEND", "sql")
+    app.config["HEALTHSENSE_COLUMN_STORE_DIR"] = os.environ.get("HEALTHSENSE_COLUMN_STORE_DIR", "timeseries")
+
+    # Data retention: per-table policies in days and where archived readings go
+    from retention import parse_policies
+    app.config["HEALTHSENSE_RETENTION"] = parse_policies(os.environ.get("HEALTHSENSE_RETENTION"))
+    app.config["HEALTHSENSE_ARCHIVE_DIR"] = os.environ.get("HEALTHSENSE_ARCHIVE_DIR", "archive")
+
+    # Edge profile: WAL and tuned pragmas on every SQLite connection (see edge.py)
+    import edge
+    if edge.EDGE_PROFILE:
+        edge.enable_sqlite_pragmas()
+
+    db.init_app(app)
+    if REPLICA_URI:
+        import replicas
+        replicas.init_app(app)
+
+    # Enable CORS
+    CORS(app)
+
+    # Setup SocketIO for real-time updates
+    from serving import ASYNC_MODE, SOCKETIO_MESSAGE_QUEUE
+    socketio.init_app(app, cors_allowed_origins="*", async_mode=ASYNC_MODE,
+                      message_queue=SOCKETIO_MESSAGE_QUEUE)
+    return app
+
+app = create_app()
+
+# ML models are managed by the model manager, which loads them on first use,
+# hot-swaps registry versions and shadow-scores candidates without a restart
+from model_manager import ModelManager
+model_manager = ModelManager(
+    os.environ.get("HEALTHSENSE_MODEL_DIR", "model_registry"),
+    poll_interval=float(os.environ.get("HEALTHSENSE_MODEL_POLL_INTERVAL", 30)),
+)
+
+def start_services(app):
+    """Start what a serving process needs beyond the app itself
+
+    Runs the schema upgrade when HEALTHSENSE_AUTO_MIGRATE=1, loads the
+    models in the background so the first reading does not wait for them,
+    and starts the registry watcher, retention job, ingest lanes and
+    gateway listener.
+    """
+    if os.environ.get("HEALTHSENSE_AUTO_MIGRATE", "0") == "1":
+        from migrate import upgrade
+        upgrade(app)
+
+    model_manager.start(app, preload=True)
+
+    # Start the retention job if enabled (interval in seconds, 0 disables it)
+    retention_interval = int(os.environ.get("HEALTHSENSE_RETENTION_INTERVAL", 0))
+    if retention_interval > 0:
+        from retention import RetentionJob
+        RetentionJob(app, retention_interval).start()
+
+    # Start the replica lag monitor if a read replica is configured
+    if REPLICA_URI:
+        from replicas import ReplicaMonitor
+        ReplicaMonitor(app).start()
 
-# Initialize database tables
-with app.app_context():
-    # Import models here to avoid circular imports
-    import models
-    db.create_all()
-    logger.info("Database tables created")
+    # Edge profile: one writer thread commits all ingest in batches, and
+    # readings are shipped to the central server when HEALTHSENSE_SYNC_URL is set
+    import edge
+    if edge.EDGE_PROFILE:
+        edge.start_write_queue(app)
+    else:
+        # Otherwise each device's readings are stored in order on one of
+        # HEALTHSENSE_INGEST_LANES writer threads (0 disables the lanes)
+        import lanes
+        if lanes.INGEST_LANES > 0:
+            lanes.start_ingest_lanes(app)
+    if edge.SYNC_URL:
+        edge.SyncUploader(app).start()
 
-# Import ML models
-from ml_models import load_models
-diabetes_model, heart_model, hypoxia_model = load_models()
+    # Start the binary gateway listener if enabled (TCP port, 0 disables it)
+    gateway_port = int(os.environ.get("HEALTHSENSE_GATEWAY_PORT", 0))
+    if gateway_port > 0:
+        from gateway import GatewayServer
+        GatewayServer(app, os.environ.get("HEALTHSENSE_GATEWAY_HOST", "0.0.0.0"), gateway_port).start()
 
-logger.info("HealthSense application initialized")
+    logger.info("HealthSense application initialized")
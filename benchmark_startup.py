@@ -0,0 +1,77 @@
+"""Startup-time benchmark for HealthSense web workers
+
+Starts fresh Python processes the way a process manager does when it
+recycles or adds a worker, and measures from process spawn to:
+
+    import_app     `import app` finished (Flask app configured)
+    worker_ready   `import main` finished (routes registered, services started)
+    first_reading  the first POST /api/healthdata was answered
+
+The database is prepared once with `migrate.py upgrade`, as in a deploy, so
+the numbers cover only what every new worker pays.
+
+    python benchmark_startup.py --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Runs inside each fresh worker process; argv[1] is its spawn time
+WORKER = """
+import json, sys, time
+spawned = float(sys.argv[1])
+sys.path.insert(0, {root!r})
+import app
+import_app = time.time() - spawned
+import main
+worker_ready = time.time() - spawned
+response = main.app.test_client().post('/api/healthdata', json={{
+    'device_id': 'benchmark-device', 'glucose': 110, 'bp_systolic': 125,
+    'bp_diastolic': 82, 'spo2': 97, 'heart_rate': 74
+}})
+assert response.status_code == 200, response.get_data(as_text=True)
+first_reading = time.time() - spawned
+print(json.dumps({{'import_app': import_app, 'worker_ready': worker_ready,
+                  'first_reading': first_reading}}))
+"""
+
+def run_worker(env):
+    spawned = time.time()
+    result = subprocess.run([sys.executable, '-c', WORKER.format(root=ROOT), repr(spawned)],
+                            env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Worker failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure HealthSense worker startup time')
+    parser.add_argument('--runs', type=int, default=5, help='Fresh worker processes to start')
+    parser.add_argument('--database', help='SQLAlchemy URI to use (default: a temporary SQLite file)')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ)
+        env['SQLALCHEMY_DATABASE_URI'] = args.database or f"sqlite:///{os.path.join(tmp, 'startup.db')}"
+        env['HEALTHSENSE_MODEL_POLL_INTERVAL'] = '0'
+        env['HEALTHSENSE_AUTO_MIGRATE'] = '0'
+        env.setdefault('HEALTHSENSE_MODEL_DIR', os.path.join(tmp, 'model_registry'))
+        subprocess.run([sys.executable, os.path.join(ROOT, 'migrate.py'), 'upgrade'],
+                       env=env, cwd=ROOT, capture_output=True, check=True)
+
+        timings = [run_worker(env) for _ in range(args.runs)]
+
+    print(f"{'stage':<14}{'median':>10}{'min':>10}{'max':>10}")
+    for stage in ('import_app', 'worker_ready', 'first_reading'):
+        values = [t[stage] for t in timings]
+        print(f"{stage:<14}{statistics.median(values):>9.2f}s{min(values):>9.2f}s{max(values):>9.2f}s")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
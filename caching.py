@@ -0,0 +1,158 @@
+"""HTTP caching and compression for HealthSense read endpoints
+
+Every device has a data version that is bumped in the same transaction as
+new readings and alert acknowledgments. Read endpoints derive a (weak) ETag
+and Last-Modified from the versions, so a polling client that already has
+the current payload gets a 304 before any query work is done. ETags track
+data changes only: rows ageing out of a sliding `hours=` window do not
+change them.
+"""
+import gzip
+import hashlib
+import logging
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import request, make_response
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from models import DeviceVersion
+from shards import scatter, shard_for
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Responses smaller than this are not worth compressing
+COMPRESS_MIN_SIZE = 1024
+COMPRESSIBLE_TYPES = ('application/json', 'application/octet-stream')
+
+def bump_data_version(device_id):
+    """Increment a device's data version inside the current transaction"""
+    now = datetime.utcnow().isoformat()
+    updated = (DeviceVersion.query
+               .filter_by(device_id=device_id)
+               .update({'version': DeviceVersion.version + 1, 'updated_at': now},
+                       synchronize_session=False))
+    if updated:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(DeviceVersion(device_id, updated_at=now))
+    except IntegrityError:
+        # Another worker created the row first
+        (DeviceVersion.query
+         .filter_by(device_id=device_id)
+         .update({'version': DeviceVersion.version + 1, 'updated_at': now},
+                 synchronize_session=False))
+
+def bump_data_versions(device_ids):
+    """bump_data_version for many devices with one UPDATE"""
+    device_ids = set(device_ids)
+    if not device_ids:
+        return
+    now = datetime.utcnow().isoformat()
+    (DeviceVersion.query
+     .filter(DeviceVersion.device_id.in_(device_ids))
+     .update({'version': DeviceVersion.version + 1, 'updated_at': now},
+             synchronize_session=False))
+    existing = {row[0] for row in (db.session.query(DeviceVersion.device_id)
+                                   .filter(DeviceVersion.device_id.in_(device_ids)))}
+    missing = device_ids - existing
+    if not missing:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.execute(DeviceVersion.__table__.insert(),
+                               [{'device_id': d, 'version': 1, 'updated_at': now} for d in missing])
+    except IntegrityError:
+        # Another worker created some of the rows first
+        for device_id in missing:
+            bump_data_version(device_id)
+
+def data_version(device_id=None):
+    """Return (version token, last modified ISO timestamp) for one or all devices"""
+    def versions():
+        query = db.session.query(func.coalesce(func.sum(DeviceVersion.version), 0),
+                                 func.count(DeviceVersion.device_id),
+                                 func.max(DeviceVersion.updated_at))
+        if device_id:
+            query = query.filter(DeviceVersion.device_id == device_id)
+        return tuple(query.one())
+
+    # One device lives on one shard; all devices add up over every shard
+    results = [row for _, row in scatter(versions, [shard_for(device_id)] if device_id else None)]
+    total = sum(row[0] for row in results)
+    devices = sum(row[1] for row in results)
+    updated_at = max((row[2] for row in results if row[2]), default=None)
+    return f"{total}.{devices}", updated_at
+
+def _http_datetime(timestamp):
+    if not timestamp:
+        return None
+    value = datetime.fromisoformat(timestamp)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.replace(microsecond=0)
+
+def conditional(view):
+    """Serve 304 Not Modified when the client already has the current data
+
+    The ETag covers the data version of the requested device (or of all
+    devices) and the full query string.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        version, updated_at = data_version(request.args.get('device_id'))
+        etag = hashlib.sha1(f"{version}:{request.full_path}".encode()).hexdigest()
+        last_modified = _http_datetime(updated_at)
+
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(etag)
+        else:
+            not_modified = (request.if_modified_since is not None and last_modified is not None
+                            and last_modified <= request.if_modified_since)
+
+        if not_modified:
+            response = app.response_class(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        response.set_etag(etag, weak=True)
+        if last_modified:
+            response.last_modified = last_modified
+        # Let browsers keep the payload but revalidate it on every poll
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
+
+@app.after_request
+def compress_response(response):
+    """Compress large JSON and binary responses with brotli or gzip"""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        response.set_data(brotli.compress(data, quality=5))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepted['gzip']:
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        return response
+    response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,294 @@
+"""Connection pool tuning and database health instrumentation
+
+Engine options come from environment variables (see engine_options()). On
+top of SQLAlchemy's pool, this module adds:
+
+- Idle-only pre-ping: a connection is tested with a `SELECT 1` on checkout
+  only if it sat in the pool longer than HEALTHSENSE_DB_PRE_PING_IDLE
+  seconds. A busy worker then pays no ping round trip per request, and a
+  connection a firewall or server restart may have dropped is still tested
+  before use. A failed ping discards the connection and the pool hands out
+  another.
+- Checkout wait: time spent getting a connection from the pool, including
+  opening a new one. Checkouts slower than HEALTHSENSE_DB_SLOW_CHECKOUT_MS
+  are logged with the pool's state.
+- Slow queries: statements slower than HEALTHSENSE_DB_SLOW_QUERY_MS are
+  logged with the database's plan for them (`EXPLAIN` on PostgreSQL,
+  `EXPLAIN QUERY PLAN` on SQLite). Each statement is explained once per
+  process, inside a SAVEPOINT, so a failed EXPLAIN cannot abort the
+  caller's transaction. Bound parameters hold patient data and are
+  redacted unless HEALTHSENSE_DB_LOG_QUERY_PARAMETERS=1.
+
+GET /api/db/health reports both per engine. A starved pool shows long
+checkout waits with every connection checked out and fast queries. Slow
+queries show as query time while checkouts stay short.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.pool import Pool, QueuePool
+
+logger = logging.getLogger(__name__)
+
+# Seconds a connection may sit idle in the pool before checkout pings it
+# (0 pings on every checkout, a negative value never pings)
+DB_PRE_PING_IDLE = float(os.environ.get("HEALTHSENSE_DB_PRE_PING_IDLE", 30))
+# Statements slower than this are logged with their plan (0 disables)
+DB_SLOW_QUERY_MS = float(os.environ.get("HEALTHSENSE_DB_SLOW_QUERY_MS", 500))
+# Log slow queries' bound parameters (patient data; off by default)
+DB_LOG_QUERY_PARAMETERS = os.environ.get("HEALTHSENSE_DB_LOG_QUERY_PARAMETERS", "0") == "1"
+# Pool checkouts slower than this are logged with the pool state (0 disables)
+DB_SLOW_CHECKOUT_MS = float(os.environ.get("HEALTHSENSE_DB_SLOW_CHECKOUT_MS", 100))
+
+# Recent samples kept for percentiles and the health endpoint
+_SAMPLES = 1000
+_SLOW_QUERIES_KEPT = 50
+
+def engine_options(uri):
+    """SQLAlchemy engine options for a database URI, from the environment
+
+    Pool sizing applies to the default QueuePool. An in-memory SQLite
+    database keeps SQLAlchemy's single-connection pool.
+    """
+    options = {
+        "pool_recycle": int(os.environ.get("HEALTHSENSE_DB_POOL_RECYCLE", 300)),
+        # Compiled SQL kept per engine, so repeated queries skip compilation
+        "query_cache_size": int(os.environ.get("HEALTHSENSE_DB_STATEMENT_CACHE_SIZE", 500)),
+    }
+    if DB_PRE_PING_IDLE == 0:
+        options["pool_pre_ping"] = True
+    if not _in_memory_sqlite(uri):
+        options.update({
+            "poolclass": InstrumentedQueuePool,
+            "pool_size": int(os.environ.get("HEALTHSENSE_DB_POOL_SIZE", 5)),
+            "max_overflow": int(os.environ.get("HEALTHSENSE_DB_MAX_OVERFLOW", 10)),
+            "pool_timeout": float(os.environ.get("HEALTHSENSE_DB_POOL_TIMEOUT", 30)),
+        })
+    return options
+
+def _in_memory_sqlite(uri):
+    return bool(uri) and uri.startswith("sqlite") and (uri.rstrip("/") in ("sqlite:", "sqlite:/")
+                                                       or ":memory:" in uri or "mode=memory" in uri)
+
+class Samples:
+    """Bounded window of durations in milliseconds with running totals"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=_SAMPLES)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms):
+        with self._lock:
+            self._recent.append(ms)
+            self.count += 1
+            self.total_ms += ms
+            self.max_ms = max(self.max_ms, ms)
+
+    def summary(self):
+        with self._lock:
+            recent = sorted(self._recent)
+            count, total_ms, max_ms = self.count, self.total_ms, self.max_ms
+
+        def percentile(p):
+            return round(recent[min(len(recent) - 1, int(p * len(recent)))], 3) if recent else None
+
+        return {
+            'count': count,
+            'mean_ms': round(total_ms / count, 3) if count else None,
+            'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'max_ms': round(max_ms, 3)
+        }
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that times how long each checkout waits for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkout_wait = Samples()
+        # Checkouts that timed out or could not open a connection
+        self.failures = 0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            waited_ms = (time.perf_counter() - started) * 1000
+            self.checkout_wait.add(waited_ms)
+            if DB_SLOW_CHECKOUT_MS and waited_ms > DB_SLOW_CHECKOUT_MS:
+                logger.warning(f"Waited {waited_ms:.0f}ms for a database connection ({self.status()})")
+
+    def recreate(self):
+        # Keep the numbers when the pool is replaced after a disconnect
+        pool = super().recreate()
+        pool.checkout_wait, pool.failures = self.checkout_wait, self.failures
+        return pool
+
+# Idle-only pre-ping
+
+@event.listens_for(Pool, 'connect')
+def _on_connect(dbapi_connection, connection_record):
+    connection_record.info['healthsense_checked_in'] = time.monotonic()
+
+@event.listens_for(Pool, 'checkin')
+def _on_checkin(dbapi_connection, connection_record):
+    if connection_record is not None:
+        connection_record.info['healthsense_checked_in'] = time.monotonic()
+
+@event.listens_for(Pool, 'checkout')
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    if DB_PRE_PING_IDLE <= 0:
+        return
+    checked_in = connection_record.info.get('healthsense_checked_in')
+    if checked_in is None or time.monotonic() - checked_in < DB_PRE_PING_IDLE:
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except Exception as e:
+        # The pool discards this connection and checks out another
+        raise DisconnectionError(f"Idle connection failed its ping: {e}") from e
+    finally:
+        try:
+            cursor.close()
+        except Exception:
+            pass
+
+# Query timing and slow query plans
+
+_query_times = {}  # engine -> Samples
+_slow_queries = deque(maxlen=_SLOW_QUERIES_KEPT)
+_plans = OrderedDict()  # statement -> plan, explained once per process
+_plans_lock = threading.Lock()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.healthsense_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'healthsense_started', None)
+    if started is None:
+        return
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    samples = _query_times.get(conn.engine)
+    if samples is None:
+        samples = _query_times.setdefault(conn.engine, Samples())
+    samples.add(elapsed_ms)
+    if DB_SLOW_QUERY_MS and elapsed_ms > DB_SLOW_QUERY_MS:
+        _record_slow_query(conn, statement, parameters, executemany, elapsed_ms)
+
+def _record_slow_query(conn, statement, parameters, executemany, elapsed_ms):
+    plan = None
+    if not executemany:
+        plan = _explain(conn, statement, parameters)
+    if executemany or not parameters:
+        shown_parameters = None
+    elif DB_LOG_QUERY_PARAMETERS:
+        shown_parameters = repr(parameters)[:500]
+    else:
+        shown_parameters = '[redacted]'
+    _slow_queries.append({
+        'at': datetime.utcnow().isoformat(),
+        'duration_ms': round(elapsed_ms, 1),
+        'statement': statement,
+        'parameters': shown_parameters,
+        'plan': plan
+    })
+    plan_text = "\n    ".join(plan) if plan else "(not explained)"
+    logger.warning(f"Slow query ({elapsed_ms:.0f}ms): {statement} {shown_parameters or ''}\n    {plan_text}")
+
+def _explain(conn, statement, parameters):
+    """The database's plan for a statement, computed once per statement text"""
+    with _plans_lock:
+        if statement in _plans:
+            return _plans[statement]
+    verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+    if verb not in ('SELECT', 'WITH', 'UPDATE', 'DELETE'):
+        return None
+    dialect = conn.dialect.name
+    if dialect == 'postgresql':
+        prefix = 'EXPLAIN '
+    elif dialect == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        return None
+    plan = None
+    try:
+        # A raw DBAPI cursor, so the EXPLAIN itself is not timed or explained. It runs
+        # on the caller's connection inside a savepoint: on PostgreSQL a failed
+        # statement would otherwise abort the caller's whole transaction
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute('SAVEPOINT healthsense_explain')
+            try:
+                cursor.execute(prefix + statement, parameters)
+                plan = [' '.join(str(column) for column in row) if dialect == 'sqlite' else str(row[0])
+                        for row in cursor.fetchall()]
+            except Exception as e:
+                cursor.execute('ROLLBACK TO SAVEPOINT healthsense_explain')
+                logger.debug(f"Could not explain slow query: {e}")
+            cursor.execute('RELEASE SAVEPOINT healthsense_explain')
+        finally:
+            cursor.close()
+    except Exception as e:
+        logger.debug(f"Could not explain slow query: {e}")
+    with _plans_lock:
+        _plans[statement] = plan
+        if len(_plans) > 256:
+            _plans.popitem(last=False)
+    return plan
+
+def pool_stats(engine):
+    """Pool state and checkout waits of one engine"""
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__, 'status': pool.status()}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'idle': pool.checkedin(),
+            'overflow': pool.overflow(),
+            'max_overflow': pool._max_overflow,
+            'timeout_s': pool.timeout(),
+        })
+    if isinstance(pool, InstrumentedQueuePool):
+        stats['checkout_wait'] = pool.checkout_wait.summary()
+        stats['checkout_failures'] = pool.failures
+    return stats
+
+def health_report(engines):
+    """Pool and query statistics for the engines of this process
+
+    engines maps a name (None for the default database) to an Engine.
+    """
+    report = {}
+    for name, engine in engines.items():
+        samples = _query_times.get(engine)
+        report[name or 'default'] = {
+            'url': engine.url.render_as_string(hide_password=True),
+            **pool_stats(engine),
+            'queries': samples.summary() if samples else Samples().summary()
+        }
+    return {
+        'engines': report,
+        'pre_ping_idle_s': DB_PRE_PING_IDLE,
+        'slow_query_ms': DB_SLOW_QUERY_MS,
+        'slow_queries': list(reversed(_slow_queries))
+    }
@@ -2,8 +2,19 @@ import requests
 import time
 import json
 import random
+import select
+import socket
+import struct
 import argparse
-from datetime import datetime
+from datetime import datetime, timezone
+
+# Gateway binary protocol (see gateway.py): magic header, then 48-byte frames of
+# device id, sequence number, epoch milliseconds and five float32 vitals
+GATEWAY_MAGIC = b'HSG1'
+GATEWAY_FRAME = struct.Struct('<16sIq5f')
+# Device ids are NUL-terminated in their 16-byte field
+GATEWAY_MAX_DEVICE_ID = 15
+GATEWAY_ACK = struct.Struct('<Q')
 
 def generate_random_health_data(device_id):
     """Generate random health data within realistic ranges"""
@@ -81,6 +92,58 @@ def send_health_data(url, data):
         print(f"Exception while sending data: {e}")
         return False
 
+def encode_gateway_frame(data, seq):
+    """Pack one reading into a gateway frame"""
+    timestamp = datetime.fromisoformat(data["timestamp"]).replace(tzinfo=timezone.utc)
+    timestamp_ms = int(timestamp.timestamp() * 1000)
+    device_id = data["device_id"].encode("ascii")
+    if len(device_id) > GATEWAY_MAX_DEVICE_ID:
+        raise ValueError(f"Device id {data['device_id']!r} is longer than {GATEWAY_MAX_DEVICE_ID} bytes")
+    return GATEWAY_FRAME.pack(device_id, seq, timestamp_ms,
+                              data["glucose"], data["bp_systolic"], data["bp_diastolic"],
+                              data["spo2"], data["heart_rate"])
+
+def run_gateway_simulator(device_ids, gateway, interval, scenario, duration):
+    """Stream readings for many devices over one binary gateway connection"""
+    host, _, port = gateway.rpartition(':')
+    sock = socket.create_connection((host or 'localhost', int(port)))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(GATEWAY_MAGIC)
+    
+    print(f"Streaming {len(device_ids)} devices to gateway {gateway}")
+    print(f"Interval: {interval} seconds")
+    print(f"Scenario: {scenario}")
+    
+    start_time = time.time()
+    seq = 0
+    acknowledged = 0
+    pending = b''
+    
+    try:
+        while duration <= 0 or time.time() - start_time <= duration:
+            seq += 1
+            frames = b''.join(encode_gateway_frame(generate_scenario_health_data(device_id, scenario), seq)
+                              for device_id in device_ids)
+            sock.sendall(frames)
+            
+            # Read whatever acknowledgments have arrived; sendall stays blocking,
+            # so a server pushing back simply slows the simulator down
+            while select.select([sock], [], [], 0)[0]:
+                data = sock.recv(4096)
+                if not data:
+                    raise ConnectionError("Gateway closed the connection")
+                pending += data
+            whole = len(pending) - len(pending) % GATEWAY_ACK.size
+            if whole:
+                (acknowledged,) = GATEWAY_ACK.unpack(pending[whole - GATEWAY_ACK.size:whole])
+                pending = pending[whole:]
+            print(f"Sent {seq * len(device_ids)} frames, {acknowledged} acknowledged")
+            
+            time.sleep(interval)
+    finally:
+        sock.close()
+    print(f"Simulation completed after {duration} seconds. Sent {seq * len(device_ids)} frames.")
+
 def run_simulator(device_id, server_url, interval, scenario, duration):
     """Run the device simulator"""
     api_url = f"{server_url}/api/healthdata"
@@ -117,10 +180,19 @@ if __name__ == "__main__":
                        help='Health scenario to simulate')
     parser.add_argument('--duration', type=int, default=0, 
                        help='Duration to run the simulator in seconds (0 for unlimited)')
+    parser.add_argument('--protocol', default='http', choices=['http', 'binary'],
+                       help='http: one JSON POST per reading; binary: frames over a gateway TCP connection')
+    parser.add_argument('--gateway', default='localhost:7070', help='Gateway host:port for --protocol binary')
+    parser.add_argument('--devices', type=int, default=1,
+                       help='Number of devices to simulate with --protocol binary (ids get a -N suffix)')
     
     args = parser.parse_args()
     
     try:
-        run_simulator(args.device_id, args.server, args.interval, args.scenario, args.duration)
+        if args.protocol == 'binary':
+            device_ids = [args.device_id] if args.devices == 1 else [f"{args.device_id}-{i}" for i in range(args.devices)]
+            run_gateway_simulator(device_ids, args.gateway, args.interval, args.scenario, args.duration)
+        else:
+            run_simulator(args.device_id, args.server, args.interval, args.scenario, args.duration)
     except KeyboardInterrupt:
         print("\nSimulator stopped by user.")
@@ -0,0 +1,366 @@
+"""Edge profile: tuned SQLite, a single-writer ingest queue and sync-up
+
+Small clinic boxes run HealthSense on SQLite with HEALTHSENSE_PROFILE=edge:
+
+- Every SQLite connection is switched to WAL, so readers never wait for the
+  writer and the writer never waits for readers. synchronous=NORMAL syncs
+  the WAL at checkpoints instead of on every commit. A power cut can lose
+  the last few commits but cannot corrupt the database. The cache, mmap and
+  busy timeout are tunable.
+- Readings from HTTP requests and the gateway go through one writer
+  thread (WriteQueue). It commits whatever has queued up (up to
+  HEALTHSENSE_EDGE_WRITE_BATCH readings) in one transaction. Each request
+  still waits for its own reading to be committed and gets its prediction
+  back, but concurrent requests share one transaction and one WAL sync
+  instead of queueing on SQLite's write lock. Other writes, such as
+  acknowledgments and retention, are rare and wait up to the busy timeout.
+
+With HEALTHSENSE_SYNC_URL set, a background thread ships readings, with
+their predictions and alerts, to a central HealthSense server;
+`edge.py sync --url` ships them on demand. Under the edge profile (or with
+HEALTHSENSE_SYNC_URL or HEALTHSENSE_SYNC_OUTBOX=1) ingest adds
+every reading to sync_outbox, whose AUTOINCREMENT seq gives the insertion
+order; readings are shipped in seq order after a cursor kept in
+sync_cursors. Each batch is columnar JSON with a device-id dictionary,
+gzip-compressed and posted to <url>/api/sync/batch. Only after the server
+accepts a batch does the cursor advance and the batch leave the outbox;
+retention keeps readings that are still in the outbox. The server skips
+rows it already has, so a batch resent after a lost response is harmless,
+and it refuses batches that decompress to more than
+HEALTHSENSE_SYNC_MAX_BYTES. When the server cannot be reached the
+thread backs off up to HEALTHSENSE_SYNC_MAX_BACKOFF seconds. Once the link
+is back it drains the backlog batch by batch.
+
+    python edge.py status
+    python edge.py sync
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime
+from types import SimpleNamespace
+
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+
+from lanes import WriteQueue
+
+logger = logging.getLogger(__name__)
+
+EDGE_PROFILE = os.environ.get("HEALTHSENSE_PROFILE", "server") == "edge"
+
+# SQLite tuning applied to every connection in the edge profile
+SQLITE_SYNCHRONOUS = os.environ.get("HEALTHSENSE_SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_CACHE_MB = int(os.environ.get("HEALTHSENSE_SQLITE_CACHE_MB", 64))
+SQLITE_MMAP_MB = int(os.environ.get("HEALTHSENSE_SQLITE_MMAP_MB", 256))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("HEALTHSENSE_SQLITE_BUSY_TIMEOUT_MS", 5000))
+
+# Single-writer queue: readings per transaction, how long to wait for more,
+# and queued submissions before submitters block
+EDGE_WRITE_BATCH = int(os.environ.get("HEALTHSENSE_EDGE_WRITE_BATCH", 200))
+EDGE_WRITE_WAIT = float(os.environ.get("HEALTHSENSE_EDGE_WRITE_WAIT_MS", 5)) / 1000.0
+EDGE_WRITE_PENDING = int(os.environ.get("HEALTHSENSE_EDGE_WRITE_PENDING", 1000))
+
+# Sync-up to a central server
+SYNC_URL = os.environ.get("HEALTHSENSE_SYNC_URL")
+SYNC_TOKEN = os.environ.get("HEALTHSENSE_SYNC_TOKEN")
+SYNC_INTERVAL = float(os.environ.get("HEALTHSENSE_SYNC_INTERVAL", 30))
+SYNC_MAX_BACKOFF = float(os.environ.get("HEALTHSENSE_SYNC_MAX_BACKOFF", 300))
+SYNC_BATCH = int(os.environ.get("HEALTHSENSE_SYNC_BATCH", 2000))
+SYNC_TIMEOUT = float(os.environ.get("HEALTHSENSE_SYNC_TIMEOUT", 30))
+# Largest decompressed batch the central server accepts
+SYNC_MAX_BYTES = int(os.environ.get("HEALTHSENSE_SYNC_MAX_BYTES", 64 * 1024 * 1024))
+EDGE_ID = os.environ.get("HEALTHSENSE_EDGE_ID") or socket.gethostname()
+
+SYNC_CURSOR = 'central'
+PREDICTION_FIELDS = ('id', 'health_data_id', 'diabetes_risk', 'heart_disease_risk', 'hypoxia_risk',
+                     'model_version', 'timestamp')
+ALERT_FIELDS = ('id', 'health_data_id', 'message', 'condition', 'severity', 'timestamp', 'acknowledged')
+
+# Queue readings for sync: always on edge boxes, which may ship them with
+# `edge.py sync --url` rather than the background uploader, and on any
+# server with HEALTHSENSE_SYNC_URL
+SYNC_OUTBOX = os.environ.get("HEALTHSENSE_SYNC_OUTBOX", "1" if EDGE_PROFILE or SYNC_URL else "0") == "1"
+
+# The running WriteQueue, if any (see start_write_queue)
+write_queue = None
+
+def enable_sqlite_pragmas():
+    """Tune every new SQLite connection for one writer and many readers"""
+    event.listen(Pool, 'connect', _sqlite_pragmas)
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        # A negative cache_size is in KiB
+        cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_MB * 1024}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_MB * 1024 * 1024}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    finally:
+        cursor.close()
+
+def start_write_queue(app):
+    global write_queue
+    write_queue = WriteQueue(app, EDGE_WRITE_BATCH, EDGE_WRITE_WAIT, EDGE_WRITE_PENDING,
+                             name='healthsense-edge-writer')
+    write_queue.start()
+    return write_queue
+
+# Sync-up
+
+_sync_status = {'shipped': 0, 'last_success': None, 'last_error': None}
+
+def _columns(rows, fields):
+    return {field: [getattr(row, field) for row in rows] for field in fields}
+
+def _rows(columns):
+    fields = list(columns)
+    return [dict(zip(fields, values)) for values in zip(*(columns[field] for field in fields))]
+
+def _require_sqlite(db):
+    if db.engine.dialect.name != 'sqlite':
+        raise RuntimeError("Sync-up relies on SQLite's single writer to commit outbox rows in seq order; "
+                           "the edge database must be SQLite")
+
+def build_sync_batch(after_seq, limit):
+    """Outbox readings after after_seq, with their predictions and alerts
+
+    Returns (payload, last seq, reading count); payload is None when the
+    outbox has nothing after after_seq.
+    """
+    from sqlalchemy import select
+    from app import db
+    from models import HealthData, Prediction, Alert, SyncOutbox, VITAL_FIELDS
+
+    _require_sqlite(db)
+    outbox = SyncOutbox.__table__
+    entries = db.session.execute(
+        select(outbox.c.seq, outbox.c.health_data_id).where(outbox.c.seq > after_seq).order_by(outbox.c.seq).limit(limit)
+    ).all()
+    if not entries:
+        return None, after_seq, 0
+
+    ids = [entry.health_data_id for entry in entries]
+    position = {row_id: index for index, row_id in enumerate(ids)}
+    rows = sorted(db.session.execute(select(HealthData.__table__).where(HealthData.__table__.c.id.in_(ids))).all(),
+                  key=lambda row: position[row.id])
+    predictions = db.session.execute(
+        select(Prediction.__table__).where(Prediction.__table__.c.health_data_id.in_(ids))).all()
+    alerts = db.session.execute(select(Alert.__table__).where(Alert.__table__.c.health_data_id.in_(ids))).all()
+
+    devices = list(dict.fromkeys(row.device_id for row in rows))
+    device_index = {device_id: index for index, device_id in enumerate(devices)}
+    readings = _columns(rows, ('id', 'timestamp') + VITAL_FIELDS)
+    readings['device'] = [device_index[row.device_id] for row in rows]
+    payload = {
+        'edge_id': EDGE_ID,
+        'devices': devices,
+        'readings': readings,
+        'predictions': _columns(predictions, PREDICTION_FIELDS),
+        'alerts': _columns(alerts, ALERT_FIELDS)
+    }
+    return payload, entries[-1].seq, len(rows)
+
+def encode_sync_batch(payload):
+    return gzip.compress(json.dumps(payload, separators=(',', ':')).encode(), compresslevel=6)
+
+def decompress_sync_batch(data, max_bytes=None):
+    """Gunzip an uploaded batch, refusing one that inflates past max_bytes"""
+    max_bytes = max_bytes or SYNC_MAX_BYTES
+    decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    body = decompressor.decompress(data, max_bytes + 1)
+    if len(body) > max_bytes:
+        raise ValueError(f"Sync batch decompresses to more than {max_bytes} bytes")
+    return body
+
+def apply_sync_batch(payload):
+    """Store a batch from an edge box; rows the server already has are skipped
+
+    Each device's rows go to its shard. Returns the number of new rows per table.
+    """
+    from app import app, db
+    from caching import bump_data_versions
+    from models import HealthData, Prediction, Alert
+    from shards import group_by_shard, on_shard
+
+    devices = payload['devices']
+    readings = _rows(payload['readings'])
+    for reading in readings:
+        reading['device_id'] = devices[reading.pop('device')]
+    predictions = _rows(payload['predictions'])
+    alerts = _rows(payload['alerts'])
+
+    inserted = {model.__tablename__: 0 for model in (HealthData, Prediction, Alert)}
+    new_readings = []
+    for shard, positions in group_by_shard(reading['device_id'] for reading in readings).items():
+        shard_readings = [readings[i] for i in positions]
+        ids = {reading['id'] for reading in shard_readings}
+        with on_shard(shard):
+            for model, rows in ((HealthData, shard_readings),
+                                (Prediction, [row for row in predictions if row['health_data_id'] in ids]),
+                                (Alert, [row for row in alerts if row['health_data_id'] in ids])):
+                new_rows = _missing_rows(db, model, rows)
+                if new_rows:
+                    db.session.execute(model.__table__.insert(), new_rows)
+                inserted[model.__tablename__] += len(new_rows)
+                if model is HealthData:
+                    shard_new_readings = new_rows
+            bump_data_versions(reading['device_id'] for reading in shard_new_readings)
+            db.session.commit()
+        new_readings.extend(shard_new_readings)
+
+    if app.config['HEALTHSENSE_READINGS_BACKEND'] == 'columnar':
+        from timeseries_store import get_store
+        for reading in new_readings:
+            get_store().append(SimpleNamespace(**reading))
+    return inserted
+
+def _missing_rows(db, model, rows):
+    ids = [row['id'] for row in rows]
+    existing = set()
+    for start in range(0, len(ids), 500):
+        existing.update(row[0] for row in db.session.query(model.id).filter(model.id.in_(ids[start:start + 500])))
+    return [row for row in rows if row['id'] not in existing]
+
+def record_outbox(db, reading):
+    """Queue a staged reading for sync-up (no-op unless SYNC_OUTBOX)"""
+    from models import SyncOutbox
+    if SYNC_OUTBOX:
+        db.session.add(SyncOutbox(health_data_id=reading.id))
+
+def _cursor_position(db):
+    from models import SyncCursor
+    cursor = db.session.get(SyncCursor, SYNC_CURSOR)
+    if cursor is None or cursor.last_seq is None:
+        cursor = _fill_outbox(db, cursor)
+    return cursor.last_seq
+
+def _fill_outbox(db, cursor):
+    """Queue readings stored before the outbox existed, once, from the old rowid cursor"""
+    from sqlalchemy import text
+    from models import SyncCursor
+
+    _require_sqlite(db)
+    result = db.session.execute(text(
+        'INSERT INTO sync_outbox (health_data_id) SELECT id FROM health_data '
+        'WHERE rowid > :after AND id NOT IN (SELECT health_data_id FROM sync_outbox) ORDER BY rowid'
+    ), {'after': cursor.last_rowid if cursor else 0})
+    if cursor is None:
+        cursor = SyncCursor(name=SYNC_CURSOR, last_rowid=0)
+        db.session.add(cursor)
+    cursor.last_seq = 0
+    cursor.updated_at = datetime.utcnow().isoformat()
+    db.session.commit()
+    logger.info(f"Queued {result.rowcount} earlier readings in the sync outbox")
+    return cursor
+
+def _advance_cursor(db, last_seq):
+    """Record an accepted batch and drop it from the outbox in one transaction"""
+    from models import SyncCursor, SyncOutbox
+    cursor = db.session.get(SyncCursor, SYNC_CURSOR)
+    cursor.last_seq = last_seq
+    cursor.updated_at = datetime.utcnow().isoformat()
+    SyncOutbox.query.filter(SyncOutbox.seq <= last_seq).delete(synchronize_session=False)
+    db.session.commit()
+
+def sync_pending(url=None, token=None, batch_size=None):
+    """Ship every reading not yet accepted by the central server; returns readings shipped"""
+    import requests
+    from app import db
+
+    url = (url or SYNC_URL).rstrip('/')
+    token = token or SYNC_TOKEN
+    headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+    if token:
+        headers['Authorization'] = f'Bearer {token}'
+
+    shipped = 0
+    after = _cursor_position(db)
+    while True:
+        payload, last_seq, count = build_sync_batch(after, batch_size or SYNC_BATCH)
+        # Release the read snapshot before the upload so WAL checkpoints are not held back
+        db.session.rollback()
+        if payload is None:
+            break
+        response = requests.post(f'{url}/api/sync/batch', data=encode_sync_batch(payload),
+                                 headers=headers, timeout=SYNC_TIMEOUT)
+        response.raise_for_status()
+        _advance_cursor(db, last_seq)
+        after = last_seq
+        shipped += count
+        _sync_status['shipped'] += count
+        logger.info(f"Synced {count} readings to {url} ({response.json().get('inserted')})")
+    _sync_status.update(last_success=datetime.utcnow().isoformat(), last_error=None)
+    return shipped
+
+def sync_status():
+    """Readings waiting to be shipped and the outcome of recent sync attempts"""
+    from sqlalchemy import text
+    from app import db
+
+    after = _cursor_position(db)
+    pending = db.session.execute(text('SELECT count(*) FROM sync_outbox WHERE seq > :after'),
+                                 {'after': after}).scalar()
+    return {'edge_id': EDGE_ID, 'url': SYNC_URL, 'pending': pending, 'cursor': after, **_sync_status}
+
+class SyncUploader(threading.Thread):
+    """Ships pending readings every SYNC_INTERVAL seconds, backing off while offline"""
+
+    def __init__(self, app, interval=None):
+        super().__init__(name='healthsense-sync-uploader', daemon=True)
+        self.app = app
+        self.interval = interval or SYNC_INTERVAL
+
+    def run(self):
+        failures = 0
+        while True:
+            try:
+                with self.app.app_context():
+                    sync_pending()
+                failures = 0
+                delay = self.interval
+            except Exception as e:
+                failures += 1
+                delay = min(self.interval * 2 ** failures, SYNC_MAX_BACKOFF)
+                _sync_status['last_error'] = str(e)
+                if failures == 1:
+                    logger.warning(f"Sync to {SYNC_URL} failed, retrying with backoff: {e}")
+            time.sleep(delay)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='HealthSense edge sync-up')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('status', help='Show readings waiting to be synced')
+    sync = subparsers.add_parser('sync', help='Ship all pending readings to the central server now')
+    sync.add_argument('--url', default=SYNC_URL, help='Central server base URL')
+    sync.add_argument('--batch-size', type=int, default=SYNC_BATCH, help='Readings per upload')
+    args = parser.parse_args(argv)
+
+    from app import app
+    with app.app_context():
+        if args.command == 'status':
+            print(json.dumps(sync_status(), indent=2))
+        elif args.command == 'sync':
+            if not args.url:
+                parser.error('--url or HEALTHSENSE_SYNC_URL is required')
+            if not SYNC_OUTBOX:
+                parser.error('ingest does not queue readings for sync here; '
+                             'set HEALTHSENSE_PROFILE=edge or HEALTHSENSE_SYNC_OUTBOX=1')
+            print(f"{sync_pending(args.url, batch_size=args.batch_size)} readings synced")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,269 @@
+"""Binary TCP ingest for device gateways
+
+A gateway (a bedside hub or a radio bridge) keeps one TCP connection open
+and streams fixed-size frames for any number of devices. Each frame is
+48 bytes, little-endian:
+
+    offset  size  field
+    0       16    device id, ASCII, at most 15 bytes, NUL-padded
+    16      4     uint32 sequence number (per device)
+    20      8     int64 timestamp, epoch milliseconds (0: time of receipt)
+    28      20    float32 glucose, bp_systolic, bp_diastolic, spo2, heart_rate
+
+A connection starts with the 4-byte magic b'HSG1'. The server answers every
+committed batch with a uint64 count of the frames handled on that connection
+so far. Frames with non-finite vitals or an empty, non-ASCII or 16-byte
+device id are counted but not stored. A gateway may drop buffered frames
+once they are acknowledged and should resend unacknowledged ones after a
+reconnect. A frame is identified by its device id, sequence number and
+timestamp field: its reading gets an id derived from them, so a resent
+frame that was already stored is skipped. Gateways must therefore not
+reuse a sequence number for a device with the same timestamp (including 0).
+
+Frames are decoded in bulk with np.frombuffer. The ingest thread collects
+up to HEALTHSENSE_GATEWAY_MAX_BATCH frames (or whatever arrives within
+HEALTHSENSE_GATEWAY_MAX_WAIT_MS) and runs them through
+ingest.process_health_data_batch: one scoring call and one commit, or one
+per ingest lane when lanes are running (see lanes.py). Each connection's
+frames are stored or fail on their own. If the database is unreachable,
+the connection is closed and its frames are resent later. A reading the
+database rejects would fail every resend, so it is dropped and logged
+and the connection's other frames are kept. When the
+bounded queue between connections and the ingest thread is full, connection
+threads stop reading. TCP flow control then slows the gateways down instead
+of letting memory grow.
+
+The listener is started in each web process when HEALTHSENSE_GATEWAY_PORT is
+set. The port is bound with SO_REUSEPORT where available, so the kernel
+spreads gateway connections over the workers.
+"""
+import logging
+import os
+import queue
+import socket
+import struct
+import threading
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import exc as sa_exc
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'HSG1'
+FRAME_DTYPE = np.dtype([
+    ('device_id', 'S16'),
+    ('seq', '<u4'),
+    ('timestamp_ms', '<i8'),
+    ('vitals', '<f4', (5,)),
+])
+# The same layout for encoders (see device_simulator.py)
+FRAME = struct.Struct('<16sIq5f')
+# A 16-byte id may have been cut short by its encoder, so ids always end in NUL
+MAX_DEVICE_ID = 15
+ACK = struct.Struct('<Q')
+
+GATEWAY_MAX_BATCH = int(os.environ.get("HEALTHSENSE_GATEWAY_MAX_BATCH", 500))
+GATEWAY_MAX_WAIT = float(os.environ.get("HEALTHSENSE_GATEWAY_MAX_WAIT_MS", 20)) / 1000.0
+# Received chunks waiting for the ingest thread before connections stop reading
+GATEWAY_MAX_PENDING = int(os.environ.get("HEALTHSENSE_GATEWAY_MAX_PENDING", 256))
+
+def encode_frame(device_id, seq, timestamp_ms, vitals):
+    encoded = device_id.encode('ascii')
+    if len(encoded) > MAX_DEVICE_ID:
+        raise ValueError(f"Device id {device_id!r} is longer than {MAX_DEVICE_ID} bytes")
+    return FRAME.pack(encoded, seq, timestamp_ms, *vitals)
+
+def decode_frames(data, now=None):
+    """Decode a buffer of whole frames into HealthData rows
+
+    Returns (readings, rejected count).
+    """
+    from models import HealthData, frame_id
+    from timeseries_store import to_iso
+
+    frames = np.frombuffer(data, dtype=FRAME_DTYPE)
+    vitals = frames['vitals'].astype(np.float64)
+    device_ids = np.char.decode(frames['device_id'], 'ascii', errors='replace')
+    # Empty, possibly truncated (no NUL in the field) and non-ASCII ids are rejected
+    id_lengths = np.char.str_len(device_ids)
+    valid = (np.isfinite(vitals).all(axis=1) & (id_lengths > 0) & (id_lengths <= MAX_DEVICE_ID)
+             & (np.char.find(device_ids, '\ufffd') < 0))
+
+    now = now or datetime.utcnow().isoformat()
+    timestamps = to_iso(frames['timestamp_ms'] * 1000).astype(object)
+    timestamps[frames['timestamp_ms'] == 0] = now
+    # float32 carries about 7 significant digits; 97.4 arrives as 97.40000152
+    vitals = np.round(vitals, 2).tolist()
+
+    readings = []
+    for i in np.flatnonzero(valid):
+        reading = HealthData(str(device_ids[i]), *vitals[i], timestamp=timestamps[i])
+        reading.id = frame_id(reading.device_id, int(frames['seq'][i]), int(frames['timestamp_ms'][i]))
+        readings.append(reading)
+    return readings, int(len(frames) - valid.sum())
+
+class GatewayConnection:
+    """One gateway's socket and its running frame count"""
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.handled = 0
+        self.closed = False
+        self._send_lock = threading.Lock()
+
+    def acknowledge(self, frames):
+        self.handled += frames
+        with self._send_lock:
+            self.sock.sendall(ACK.pack(self.handled))
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+class GatewayServer(threading.Thread):
+    """Accept gateway connections and feed their frames to the ingest pipeline"""
+
+    def __init__(self, app, host, port, max_batch=None, max_wait=None, max_pending=None):
+        super().__init__(name='healthsense-gateway', daemon=True)
+        self.app = app
+        self.max_batch = max_batch or GATEWAY_MAX_BATCH
+        self.max_wait = GATEWAY_MAX_WAIT if max_wait is None else max_wait
+        self.chunks = queue.Queue(maxsize=max_pending or GATEWAY_MAX_PENDING)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(128)
+        self.port = self.listener.getsockname()[1]
+
+    def run(self):
+        logger.info(f"Gateway ingest listening on port {self.port}")
+        threading.Thread(target=self._ingest_loop, name='healthsense-gateway-ingest', daemon=True).start()
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = GatewayConnection(sock, address)
+            threading.Thread(target=self._read_loop, args=(connection,),
+                             name='healthsense-gateway-connection', daemon=True).start()
+
+    def stop(self):
+        self.listener.close()
+
+    def _read_loop(self, connection):
+        buffer = bytearray()
+        try:
+            while len(buffer) < len(MAGIC):
+                data = connection.sock.recv(len(MAGIC) - len(buffer))
+                if not data:
+                    return
+                buffer += data
+            if bytes(buffer) != MAGIC:
+                logger.warning(f"Gateway {connection.address} sent an unknown protocol header")
+                return
+            buffer.clear()
+            while not connection.closed:
+                data = connection.sock.recv(65536)
+                if not data:
+                    return
+                buffer += data
+                whole = len(buffer) - len(buffer) % FRAME_DTYPE.itemsize
+                if whole:
+                    # Blocks while the ingest thread is behind, which stops
+                    # this socket being read and pushes back on the gateway
+                    self.chunks.put((connection, bytes(buffer[:whole])))
+                    del buffer[:whole]
+        except OSError as e:
+            if not connection.closed:
+                logger.info(f"Gateway {connection.address} disconnected: {e}")
+        finally:
+            if not connection.closed:
+                connection.close()
+
+    def _next_batch(self):
+        """Block for one chunk, then gather more until the batch is full or max_wait passes"""
+        batch = [self.chunks.get()]
+        frames = len(batch[0][1]) // FRAME_DTYPE.itemsize
+        while frames < self.max_batch:
+            try:
+                item = self.chunks.get(timeout=self.max_wait)
+            except queue.Empty:
+                break
+            batch.append(item)
+            frames += len(item[1]) // FRAME_DTYPE.itemsize
+        return batch
+
+    def _ingest_loop(self):
+        from ingest import submit_health_data_groups
+
+        while True:
+            # A closed connection's queued frames are resent after it reconnects;
+            # storing them now could put them ahead of its earlier failed frames
+            batch = [(connection, data) for connection, data in self._next_batch() if not connection.closed]
+            now = datetime.utcnow().isoformat()
+            frames = {}
+            readings = {}
+            rejected = 0
+            for connection, data in batch:
+                decoded, dropped = decode_frames(data, now)
+                frames[connection] = frames.get(connection, 0) + len(data) // FRAME_DTYPE.itemsize
+                readings.setdefault(connection, []).extend(decoded)
+                rejected += dropped
+            if rejected:
+                logger.warning(f"Dropped {rejected} gateway frames with invalid vitals or device ids")
+
+            # Each connection's readings are stored (or fail) on their own
+            connections = [connection for connection, rows in readings.items() if rows]
+            with self.app.app_context():
+                results = submit_health_data_groups([readings[connection] for connection in connections])
+                failed = set()
+                for connection, result in zip(connections, results):
+                    if isinstance(result, Exception) and not self._store_one_by_one(connection, readings[connection],
+                                                                                    result):
+                        failed.add(connection)
+
+            for connection, count in frames.items():
+                if connection in failed:
+                    # Unacknowledged frames are resent after the gateway reconnects
+                    connection.close()
+                    continue
+                try:
+                    connection.acknowledge(count)
+                except OSError:
+                    pass
+
+    def _store_one_by_one(self, connection, readings, error):
+        """Retry a failed connection's readings singly, dropping those the database rejects
+
+        Returns False if the connection must be closed so its frames are resent.
+        """
+        from ingest import submit_health_data_groups
+
+        if _is_transient(error):
+            logger.error(f"Error ingesting frames from gateway {connection.address}: {error}")
+            return False
+        dropped = 0
+        for reading, result in zip(readings, submit_health_data_groups([[reading] for reading in readings])):
+            if not isinstance(result, Exception):
+                continue
+            if _is_transient(result):
+                logger.error(f"Error ingesting frames from gateway {connection.address}: {result}")
+                return False
+            logger.error(f"Dropped gateway frame for {reading.device_id} at {reading.timestamp}: {result}")
+            dropped += 1
+        logger.warning(f"Stored gateway {connection.address} frames one by one, {dropped} rejected")
+        return True
+
+def _is_transient(error):
+    """Whether a failure is the database being unavailable, rather than a reading it rejects"""
+    return isinstance(error, (sa_exc.OperationalError, sa_exc.TimeoutError)) or \
+        getattr(error, 'connection_invalidated', False)
@@ -0,0 +1,96 @@
+"""Risk scoring for readings, optionally offloaded to other processes
+
+Scoring runs in one of three places, in order of preference:
+
+- HEALTHSENSE_INFERENCE_SOCKET: the host-local inference server
+  (inference_server.py), shared by all web workers on the host. If it is
+  unreachable, overloaded or reports an error, the reading is scored
+  locally instead.
+- HEALTHSENSE_INFERENCE_PROCESSES > 0: a pool of scoring processes owned by
+  this web process (started lazily, so gunicorn forks first), which gets
+  the current models once.
+- Otherwise on the calling thread.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from ml_models import predict_batch, predict_diabetes, predict_heart_disease, predict_hypoxia
+
+logger = logging.getLogger(__name__)
+
+INFERENCE_PROCESSES = int(os.environ.get("HEALTHSENSE_INFERENCE_PROCESSES", 0))
+INFERENCE_SOCKET = os.environ.get("HEALTHSENSE_INFERENCE_SOCKET")
+
+_client = None
+
+_executor = None
+_executor_models = None
+_executor_lock = threading.Lock()
+
+# Models held by each scoring process
+_worker_models = None
+
+def _init_worker(models):
+    global _worker_models
+    _worker_models = models
+
+def _score(glucose, bp_systolic, bp_diastolic, spo2, heart_rate, models=None):
+    diabetes_model, heart_model, hypoxia_model = models or _worker_models
+    return (
+        predict_diabetes(diabetes_model, glucose),
+        predict_heart_disease(heart_model, bp_systolic, bp_diastolic, heart_rate),
+        predict_hypoxia(hypoxia_model, spo2, heart_rate),
+    )
+
+def _score_batch(features):
+    return predict_batch(_worker_models, features)
+
+def _get_executor(models):
+    """Return the scoring pool, restarting it if the models changed"""
+    global _executor, _executor_models
+    with _executor_lock:
+        if _executor is None or _executor_models is not models:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            logger.info(f"Starting inference pool with {INFERENCE_PROCESSES} processes")
+            _executor = ProcessPoolExecutor(max_workers=INFERENCE_PROCESSES,
+                                            initializer=_init_worker, initargs=(models,))
+            _executor_models = models
+        return _executor
+
+def _get_client():
+    global _client
+    with _executor_lock:
+        if _client is None:
+            from inference_server import InferenceClient
+            _client = InferenceClient(INFERENCE_SOCKET)
+        return _client
+
+def score_reading(model_set, reading):
+    """Return (diabetes_risk, heart_disease_risk, hypoxia_risk) for a reading and the model version used
+
+    model_set is the worker's active ModelSet. The inference server scores
+    with its own active version, which is returned instead.
+    """
+    args = (reading.glucose, reading.bp_systolic, reading.bp_diastolic, reading.spo2, reading.heart_rate)
+    if INFERENCE_SOCKET:
+        try:
+            return _get_client().score(args)
+        except (OSError, RuntimeError) as e:
+            logger.warning(f"Inference server unavailable, scoring locally: {e}")
+    if INFERENCE_PROCESSES > 0:
+        return _get_executor(model_set.models).submit(_score, *args).result(), model_set.version
+    return _score(*args, models=model_set.models), model_set.version
+
+def score_readings(model_set, features):
+    """Score an (n, 5) feature array; returns an (n, 3) risk array and the model version used"""
+    if INFERENCE_SOCKET:
+        try:
+            return _get_client().score_many(features)
+        except (OSError, RuntimeError) as e:
+            logger.warning(f"Inference server unavailable, scoring locally: {e}")
+    if INFERENCE_PROCESSES > 0:
+        return _get_executor(model_set.models).submit(_score_batch, features).result(), model_set.version
+    return predict_batch(model_set.models, features), model_set.version
@@ -0,0 +1,306 @@
+"""Host-local inference server for HealthSense
+
+One server per host loads the models once and forks a pool of scoring
+processes that share the model memory copy-on-write. Web workers connect
+over a Unix socket; requests from all of them are merged into micro-batches
+and scored with vectorized predict_proba calls, in parallel across cores.
+
+The server follows the model registry like a web worker does
+(HEALTHSENSE_MODEL_POLL_INTERVAL). When the active version changes, new
+batches go to a freshly forked pool holding the new models while the old
+pool finishes what it has. Every response names the version that scored
+it, and that is the version stored with the predictions.
+
+    python inference_server.py --socket /tmp/healthsense-inference.sock --processes 4
+
+and point the web workers at it with HEALTHSENSE_INFERENCE_SOCKET.
+
+Wire format (little-endian): a request is a uint32 row count followed by
+count x 5 float64 features [glucose, bp_systolic, bp_diastolic, spo2,
+heart_rate]; the response is a uint32 row count, a uint32 length and the
+UTF-8 model version, then count x 3 float64 risks. A row count of 0xFFFFFFFF in a response is followed by a
+uint32 length and a UTF-8 error message.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import struct
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from ml_models import predict_batch
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('<I')
+ERROR_MARKER = 0xFFFFFFFF
+FEATURES = 5
+RISKS = 3
+
+# Models held by each scoring process; handed over at fork, so they are shared copy-on-write
+_models = None
+
+def _init_worker(models):
+    global _models
+    _models = models
+
+def _score_batch(features):
+    return predict_batch(_models, features)
+
+class BatchScorer:
+    """Merge concurrent requests into micro-batches for the process pool
+
+    The pool is replaced when the model manager swaps in another active
+    version; results carry the version of the pool that scored them. A pool
+    that lost a process (OOM kill, crash) is replaced on the next batch.
+    """
+
+    def __init__(self, manager, processes, max_batch=512, max_wait=0.002):
+        self.manager = manager
+        self.processes = processes
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        # Batches handed to the pool and not finished yet; requests wait in the queue beyond that
+        self.in_flight = asyncio.Semaphore(2 * processes)
+        self.model_set = None
+        self.executor = None
+
+    def _pool(self):
+        """The pool for the active models, forked again after a version swap"""
+        model_set = self.manager.current()
+        if model_set is not self.model_set:
+            previous = self.executor
+            self.executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                mp_context=multiprocessing.get_context('fork'),
+                                                initializer=_init_worker, initargs=(model_set.models,))
+            self.model_set = model_set
+            logger.info(f"Scoring with model version {model_set.version}")
+            if previous is not None:
+                # Batches already handed to the old pool still finish there
+                previous.shutdown(wait=False)
+        return self.executor, self.model_set.version
+
+    def _discard(self, executor):
+        """Drop a broken pool so the next batch forks a fresh one"""
+        if executor is self.executor:
+            logger.error("A scoring process died; forking a new pool")
+            self.executor = None
+            self.model_set = None
+        executor.shutdown(wait=False)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+    async def score(self, features):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((features, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            rows = len(items[0][0])
+            deadline = loop.time() + self.max_wait
+            while rows < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                items.append(item)
+                rows += len(item[0])
+            batch = np.concatenate([features for features, _ in items])
+            await self.in_flight.acquire()
+            executor, version = self._pool()
+            # Several batches may be in flight at once, one per pool process
+            try:
+                task = loop.run_in_executor(executor, _score_batch, batch)
+            except BrokenProcessPool:
+                self._discard(executor)
+                executor, version = self._pool()
+                task = loop.run_in_executor(executor, _score_batch, batch)
+            task.add_done_callback(lambda done, items=items, executor=executor, version=version:
+                                   self._deliver(done, items, executor, version))
+
+    def _deliver(self, done, items, executor, version):
+        self.in_flight.release()
+        error = done.exception()
+        if isinstance(error, BrokenProcessPool):
+            # This batch fails (clients fall back to local scoring); the next one gets a new pool
+            self._discard(executor)
+        offset = 0
+        for features, future in items:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result((done.result()[offset:offset + len(features)], version))
+            offset += len(features)
+
+async def _handle_connection(scorer, reader, writer):
+    try:
+        while True:
+            header = await reader.readexactly(HEADER.size)
+            (count,) = HEADER.unpack(header)
+            payload = await reader.readexactly(count * FEATURES * 8)
+            features = np.frombuffer(payload, dtype='<f8').reshape(count, FEATURES)
+            try:
+                risks, version = await scorer.score(features)
+                version = version.encode()
+                writer.write(HEADER.pack(count) + HEADER.pack(len(version)) + version
+                             + np.ascontiguousarray(risks, dtype='<f8').tobytes())
+            except Exception as e:
+                message = str(e).encode()
+                writer.write(HEADER.pack(ERROR_MARKER) + HEADER.pack(len(message)) + message)
+            await writer.drain()
+    except asyncio.IncompleteReadError:
+        pass
+    finally:
+        writer.close()
+
+async def _serve(socket_path, scorer):
+    server = await asyncio.start_unix_server(
+        lambda r, w: _handle_connection(scorer, r, w), path=socket_path
+    )
+    os.chmod(socket_path, 0o660)
+    logger.info(f"Inference server listening on {socket_path}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    batcher = asyncio.create_task(scorer.run())
+    async with server:
+        await stop.wait()
+    batcher.cancel()
+
+def serve(socket_path, processes, max_batch=512, max_wait=0.002):
+    """Serve the active registry models until SIGINT/SIGTERM, following version changes"""
+    from model_manager import ModelManager
+    manager = ModelManager(os.environ.get("HEALTHSENSE_MODEL_DIR", "model_registry"),
+                           poll_interval=float(os.environ.get("HEALTHSENSE_MODEL_POLL_INTERVAL", 30)))
+    manager.current()
+    manager.watch()
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    scorer = BatchScorer(manager, processes, max_batch, max_wait)
+    try:
+        asyncio.run(_serve(socket_path, scorer))
+    finally:
+        scorer.shutdown()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+class InferenceClient:
+    """Thread-safe client that micro-batches scoring calls from one web worker
+
+    One batch is in flight at a time and at most max_pending calls wait for
+    it; a call that cannot be queued within the timeout raises TimeoutError.
+    """
+
+    def __init__(self, socket_path, max_batch=256, max_wait=0.001, timeout=5.0, max_pending=1024):
+        self.socket_path = socket_path
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._sock = None
+        self._thread = threading.Thread(target=self._run, name='healthsense-inference-client', daemon=True)
+        self._thread.start()
+
+    def score(self, features):
+        """Score one [glucose, bp_systolic, bp_diastolic, spo2, heart_rate] row; returns (risks, model version)"""
+        future = Future()
+        self._put(features, future)
+        risks, version = future.result(self.timeout)
+        return tuple(risks[0].tolist()), version
+
+    def score_many(self, rows):
+        """Score an (n, 5) feature array in one request; returns (n, 3) risks and the model version"""
+        future = Future()
+        self._put(rows, future)
+        return future.result(self.timeout)
+
+    def _put(self, features, future):
+        try:
+            self._queue.put((features, future), timeout=self.timeout)
+        except queue.Full:
+            raise TimeoutError("Inference client queue is full") from None
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+    def _recv_exactly(self, size):
+        chunks = []
+        while size:
+            chunk = self._sock.recv(size)
+            if not chunk:
+                raise ConnectionError("Inference server closed the connection")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def _request(self, rows):
+        if self._sock is None:
+            self._sock = self._connect()
+        features = np.asarray(rows, dtype='<f8').reshape(-1, FEATURES)
+        self._sock.sendall(HEADER.pack(len(features)) + features.tobytes())
+        (count,) = HEADER.unpack(self._recv_exactly(HEADER.size))
+        if count == ERROR_MARKER:
+            (length,) = HEADER.unpack(self._recv_exactly(HEADER.size))
+            raise RuntimeError(self._recv_exactly(length).decode())
+        (length,) = HEADER.unpack(self._recv_exactly(HEADER.size))
+        version = self._recv_exactly(length).decode()
+        return np.frombuffer(self._recv_exactly(count * RISKS * 8), dtype='<f8').reshape(count, RISKS), version
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            try:
+                while len(items) < self.max_batch:
+                    items.append(self._queue.get(timeout=self.max_wait))
+            except queue.Empty:
+                pass
+            try:
+                blocks = [np.asarray(features, dtype='<f8').reshape(-1, FEATURES) for features, _ in items]
+                risks, version = self._request(np.concatenate(blocks))
+                offset = 0
+                for block, (_, future) in zip(blocks, items):
+                    future.set_result((risks[offset:offset + len(block)], version))
+                    offset += len(block)
+            except Exception as e:
+                if isinstance(e, OSError) and self._sock is not None:
+                    self._sock.close()
+                    self._sock = None
+                for _, future in items:
+                    future.set_exception(e)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='HealthSense host-local inference server')
+    parser.add_argument('--socket', default=os.environ.get('HEALTHSENSE_INFERENCE_SOCKET',
+                                                           '/tmp/healthsense-inference.sock'),
+                        help='Unix socket path to listen on')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='Scoring processes')
+    parser.add_argument('--max-batch', type=int, default=512, help='Maximum rows per scoring batch')
+    parser.add_argument('--max-wait-ms', type=float, default=2.0,
+                        help='How long to wait for more requests before scoring a batch')
+    args = parser.parse_args()
+    serve(args.socket, args.processes, args.max_batch, args.max_wait_ms / 1000.0)
@@ -0,0 +1,261 @@
+"""Shared ingest pipeline for readings from devices, gateways and manual entry"""
+import logging
+
+import numpy as np
+
+from app import app, socketio, db, health_data, predictions, alerts, model_manager, remember
+from models import HealthData, Prediction, Alert
+from caching import bump_data_version, bump_data_versions
+from alert_events import classify_new_alerts, classify_alert_batch, publish_alert_events
+from ml_models import get_health_alerts
+from inference import score_reading, score_readings
+from anomaly import update_baseline, update_baselines
+from ward import record_reading
+from streams import publish, lagging_sids, DASHBOARD_ROOM
+from shards import on_shard, shard_for, group_by_shard
+import edge
+import lanes
+
+logger = logging.getLogger(__name__)
+
+def process_health_data(new_health_data):
+    """Store a reading, score it, raise alerts and broadcast the result
+
+    Returns the new Prediction and the list of new Alert objects.
+    """
+    # Run ML predictions with the models active right now
+    risks, model_version = score_reading(model_manager.current(), new_health_data)
+
+    # Everything about this reading is stored on its device's shard
+    with on_shard(shard_for(new_health_data.device_id)):
+        # Alerts: absolute thresholds, then deviations from the device's own baseline
+        new_prediction, new_alerts = _stage_reading(new_health_data, risks, model_version,
+                                                    update_baseline(new_health_data))
+
+        # Work out which alerts escalate an already open one
+        alert_events = classify_new_alerts(new_health_data.device_id, new_alerts)
+
+        # Let cached read responses for this device go stale
+        bump_data_version(new_health_data.device_id)
+
+        # Commit changes to database
+        db.session.commit()
+
+        # Publishing reloads the committed rows, so it stays on the shard
+        _publish_reading(new_health_data, new_prediction, new_alerts, alert_events)
+    return new_prediction, new_alerts
+
+def submit_health_data(new_health_data):
+    """process_health_data, handed to the edge write queue or the device's ingest lane when running"""
+    if edge.write_queue is not None:
+        return edge.write_queue.submit(new_health_data)
+    if lanes.ingest_lanes is not None:
+        return lanes.ingest_lanes.submit(new_health_data)
+    return process_health_data(new_health_data)
+
+def submit_health_data_groups(groups):
+    """process_health_data_groups, handed to the edge write queue or the ingest lanes when running
+
+    Returns, per group of readings, (Prediction, alerts) per reading or
+    the exception the group failed with.
+    """
+    if edge.write_queue is not None:
+        futures = [edge.write_queue.enqueue(readings) for readings in groups]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+    if lanes.ingest_lanes is not None:
+        return lanes.ingest_lanes.submit_groups(groups)
+    return process_health_data_groups(groups)
+
+def process_health_data_groups(groups):
+    """process_health_data_batch for several submissions in one transaction
+
+    If the shared transaction fails, each submission is retried on its own,
+    so one bad submission does not fail the others. Returns, per
+    submission, (Prediction, alerts) per reading or the exception it
+    failed with.
+    """
+    readings = [reading for group in groups for reading in group]
+    try:
+        staged = process_health_data_batch(readings)
+    except Exception as e:
+        db.session.rollback()
+        if len(groups) == 1:
+            return [e]
+        logger.warning(f"Storing {len(readings)} readings failed, retrying {len(groups)} submissions one by one: {e}")
+        return [process_health_data_groups([group])[0] for group in groups]
+
+    results = []
+    offset = 0
+    for group in groups:
+        results.append(staged[offset:offset + len(group)])
+        offset += len(group)
+    return results
+
+def process_health_data_batch(readings):
+    """process_health_data for many readings in one scoring call and one commit
+
+    Readings are staged in order, so alerts and baselines see them as if
+    they had arrived one by one. Baselines, open alerts and data versions
+    are read and written with set-based queries, and nothing is flushed
+    until the commit. With several shards, each shard's readings are
+    committed separately. Readings already stored (a resent batch) are
+    not stored again; their stored prediction and alerts are returned.
+    Returns (Prediction, alerts) per reading.
+    """
+    if not readings:
+        return []
+    features = np.array([[r.glucose, r.bp_systolic, r.bp_diastolic, r.spo2, r.heart_rate] for r in readings],
+                        dtype=np.float64)
+    risks, model_version = score_readings(model_manager.current(), features)
+    risks = risks.tolist()
+
+    groups = group_by_shard(reading.device_id for reading in readings)
+    if len(groups) == 1:
+        with on_shard(next(iter(groups))):
+            return _process_shard_batch(readings, risks, model_version)
+    staged = [None] * len(readings)
+    for shard, positions in groups.items():
+        with on_shard(shard):
+            results = _process_shard_batch([readings[i] for i in positions], [risks[i] for i in positions],
+                                           model_version)
+        for position, result in zip(positions, results):
+            staged[position] = result
+    return staged
+
+def _process_shard_batch(readings, risks, model_version):
+    """Stage, commit and publish scored readings that all belong to the current shard"""
+    # Readings stored by an earlier attempt keep their rows; only new ones are staged
+    seen = {row_id for (row_id,) in db.session.query(HealthData.id)
+            .filter(HealthData.id.in_({reading.id for reading in readings}))}
+    new_positions = []
+    for position, reading in enumerate(readings):
+        if reading.id not in seen:
+            seen.add(reading.id)
+            new_positions.append(position)
+    if len(new_positions) == len(readings):
+        return _stage_and_commit(readings, risks, model_version)
+    fresh = _stage_and_commit([readings[i] for i in new_positions], [risks[i] for i in new_positions],
+                              model_version)
+    results = _stored_results(readings)
+    for position, result in zip(new_positions, fresh):
+        results[position] = result
+    return results
+
+def _stored_results(readings):
+    """(Prediction, alerts) per reading as already stored, for readings sent twice"""
+    ids = list({reading.id for reading in readings})
+    stored_predictions = {p.health_data_id: p for p in Prediction.query.filter(Prediction.health_data_id.in_(ids))}
+    stored_alerts = {}
+    for alert in Alert.query.filter(Alert.health_data_id.in_(ids)):
+        stored_alerts.setdefault(alert.health_data_id, []).append(alert)
+    for obj in (*stored_predictions.values(), *(a for found in stored_alerts.values() for a in found)):
+        db.session.expunge(obj)
+    return [(stored_predictions.get(reading.id), stored_alerts.get(reading.id, [])) for reading in readings]
+
+def _stage_and_commit(readings, risks, model_version):
+    """Stage, commit and publish scored readings that are not stored yet"""
+    if not readings:
+        return []
+    baseline_alerts = update_baselines(readings)
+
+    with db.session.no_autoflush:
+        staged = [_stage_reading(reading, tuple(row), model_version, extra)
+                  for reading, row, extra in zip(readings, risks, baseline_alerts)]
+        alert_events = classify_alert_batch([(reading.device_id, new_alerts)
+                                             for reading, (_, new_alerts) in zip(readings, staged)])
+        bump_data_versions(reading.device_id for reading in readings)
+    ids = [reading.id for reading in readings]
+    db.session.commit()
+
+    # The commit expired every object; reload each table with one query instead of one per object
+    HealthData.query.filter(HealthData.id.in_(ids)).all()
+    Prediction.query.filter(Prediction.health_data_id.in_(ids)).all()
+    Alert.query.filter(Alert.health_data_id.in_(ids)).all()
+
+    # Detach the loaded rows, so a later commit or rollback in this session (the
+    # next shard, a retried submission) cannot expire them under their holders
+    for reading, (new_prediction, new_alerts) in zip(readings, staged):
+        for obj in (reading, new_prediction, *new_alerts):
+            db.session.expunge(obj)
+
+    for reading, (new_prediction, new_alerts), events in zip(readings, staged, alert_events):
+        _publish_reading(reading, new_prediction, new_alerts, events)
+    return staged
+
+def _stage_reading(new_health_data, risks, model_version, baseline_alerts):
+    """Add a scored reading, its prediction and its alerts to the session
+
+    baseline_alerts are the reading's anomaly alert dicts.
+    """
+    diabetes_risk, heart_disease_risk, hypoxia_risk = risks
+
+    # Store data in database
+    db.session.add(new_health_data)
+    edge.record_outbox(db, new_health_data)
+
+    # Create Prediction object
+    new_prediction = Prediction(
+        health_data_id=new_health_data.id,
+        diabetes_risk=diabetes_risk,
+        heart_disease_risk=heart_disease_risk,
+        hypoxia_risk=hypoxia_risk,
+        model_version=model_version
+    )
+
+    # Store prediction in database
+    db.session.add(new_prediction)
+
+    # Check for alerts: absolute thresholds, then deviations from the device's own baseline
+    new_alerts = []
+    for alert_data in get_health_alerts(new_health_data) + baseline_alerts:
+        new_alert = Alert(
+            health_data_id=new_health_data.id,
+            message=alert_data["message"],
+            condition=alert_data["condition"],
+            severity=alert_data["severity"]
+        )
+        # Store in database
+        db.session.add(new_alert)
+        new_alerts.append(new_alert)
+
+    return new_prediction, new_alerts
+
+def _publish_reading(new_health_data, new_prediction, new_alerts, alert_events):
+    """Fan a committed reading out to the column store, shadow scoring and clients"""
+    # Also keep in memory for transition period; only committed rows, so a
+    # rolled-back and retried batch leaves no stale or duplicate entries
+    remember(health_data, new_health_data, 1000)  # Limit storage size for MVP
+    remember(predictions, new_prediction, 1000)
+    for new_alert in new_alerts:
+        remember(alerts, new_alert, 100)  # Limit alerts for MVP
+    # Mirror committed readings into the columnar store when it serves reads
+    if app.config['HEALTHSENSE_READINGS_BACKEND'] == 'columnar':
+        from timeseries_store import get_store
+        try:
+            get_store().append(new_health_data)
+        except Exception as e:
+            logger.error(f"Error appending reading to column store: {e}")
+
+    # Score the reading with the candidate models off the request path
+    model_manager.shadow(new_health_data)
+
+    # Send data to connected dashboards, skipping sockets that are not keeping up
+    socketio.emit('new_health_data', {
+        'health_data': new_health_data.to_dict(),
+        'prediction': new_prediction.to_dict(),
+        'alerts': [a.to_dict() for a in new_alerts]
+    }, to=DASHBOARD_ROOM, skip_sid=lagging_sids(socketio))
+    publish(new_health_data.device_id, 'reading', {
+        'health_data': new_health_data.to_dict(),
+        'prediction': new_prediction.to_dict()
+    })
+    publish_alert_events(new_health_data.device_id, alert_events)
+
+    # Queue a summary frame for ward walls watching this device
+    record_reading(new_health_data, new_prediction, new_alerts)
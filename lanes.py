@@ -0,0 +1,182 @@
+"""Ordered ingest lanes: per-device sequencing for concurrent ingest
+
+Without lanes, every request thread (and the gateway ingest thread) stores
+its reading itself. Two readings from the same device that arrive close
+together can then be committed out of order. Their baseline updates and
+alert classifications can also interleave, and the later one wins.
+
+With HEALTHSENSE_INGEST_LANES=N (default 4), a serving process runs N
+writer threads. Each device is assigned to one lane by a stable hash of
+its id. A lane commits its queue in arrival order, taking up to
+HEALTHSENSE_INGEST_LANE_BATCH readings per transaction. So:
+
+- one device's readings are stored, scored against its baseline and
+  classified into alert episodes strictly in the order they arrived, and
+  its per-device state is only ever written by its own lane, without locks;
+- different devices run on different lanes at the same time, and their
+  transactions overlap on the database;
+- a request still waits for its own reading and gets its prediction back.
+  A gateway batch is split across lanes and waits for all of them; each
+  of its submissions (one per gateway connection) succeeds or fails on
+  its own.
+
+Lanes order readings within one process. With several workers, a device's
+readings stay in order as long as they reach the same worker, which is
+true for a gateway connection. The edge profile's single writer
+(edge.write_queue) already orders all readings, so lanes are not started
+there. Set HEALTHSENSE_INGEST_LANES=0 to store readings on the calling
+thread as before.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+INGEST_LANES = int(os.environ.get("HEALTHSENSE_INGEST_LANES", 4))
+# Readings per lane transaction, how long a lane waits for more, and
+# queued submissions per lane before submitters block
+LANE_BATCH = int(os.environ.get("HEALTHSENSE_INGEST_LANE_BATCH", 100))
+LANE_WAIT = float(os.environ.get("HEALTHSENSE_INGEST_LANE_WAIT_MS", 0)) / 1000.0
+LANE_PENDING = int(os.environ.get("HEALTHSENSE_INGEST_LANE_PENDING", 1000))
+
+# The running IngestLanes, if any (see start_ingest_lanes)
+ingest_lanes = None
+
+class WriteQueue(threading.Thread):
+    """One ingest writer: commits readings from any thread in batches, in submission order
+
+    Used for each ingest lane and for the edge profile's single writer.
+    """
+
+    def __init__(self, app, max_batch, max_wait, max_pending, name='healthsense-writer'):
+        super().__init__(name=name, daemon=True)
+        self.app = app
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.submissions = queue.Queue(maxsize=max_pending)
+        self.batches = 0
+        self.committed = 0
+
+    def submit(self, reading):
+        """process_health_data through the queue; returns (Prediction, alerts) once committed"""
+        return self.submit_many([reading])[0]
+
+    def submit_many(self, readings):
+        """Queue readings and wait for their commit; returns (Prediction, alerts) per reading"""
+        if not readings:
+            return []
+        return self.enqueue(readings).result()
+
+    def enqueue(self, readings):
+        """Queue readings without waiting; the Future resolves to (Prediction, alerts) per reading"""
+        future = Future()
+        self.submissions.put((readings, future))
+        return future
+
+    def _next_batch(self):
+        """Block for one submission, then gather more until the batch is full or max_wait passes"""
+        batch = [self.submissions.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self.submissions.get(timeout=remaining) if remaining > 0 else self.submissions.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def run(self):
+        from ingest import process_health_data_groups
+
+        while True:
+            batch = self._next_batch()
+            # Submissions share one transaction; if it fails each is retried on its own.
+            # Results are handed over after the app context (and its session) has closed
+            try:
+                with self.app.app_context():
+                    results = process_health_data_groups([readings for readings, _ in batch])
+            except Exception as e:
+                # Fail this batch's submitters; the writer keeps serving later ones
+                logger.error(f"{self.name} failed a batch of {len(batch)} submissions: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            for (readings, future), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    self.committed += len(readings)
+                    future.set_result(result)
+
+def lane_for(device_id, count):
+    """The lane a device's readings go through; stable across processes and restarts"""
+    return zlib.crc32(device_id.encode('utf-8')) % count
+
+class IngestLanes:
+    """A fixed set of ordered writer threads, one lane per device"""
+
+    def __init__(self, app, count=None, max_batch=None, max_wait=None, max_pending=None):
+        count = count or INGEST_LANES
+        self.lanes = [WriteQueue(app, max_batch or LANE_BATCH, LANE_WAIT if max_wait is None else max_wait,
+                                 max_pending or LANE_PENDING, name=f'healthsense-ingest-lane-{i}')
+                      for i in range(count)]
+
+    def start(self):
+        for lane in self.lanes:
+            lane.start()
+
+    def submit(self, reading):
+        """process_health_data on the device's lane; returns (Prediction, alerts) once committed"""
+        return self.lanes[lane_for(reading.device_id, len(self.lanes))].submit(reading)
+
+    def submit_groups(self, groups):
+        """Store several submissions, each split over its devices' lanes, and wait for all of them
+
+        Returns, per submission, (Prediction, alerts) per reading or the
+        exception it failed with. A failed submission may have been partly
+        committed by its other lanes; readings stored already are skipped
+        when it is sent again.
+        """
+        pending = []
+        for readings in groups:
+            positions = {}
+            for position, reading in enumerate(readings):
+                positions.setdefault(lane_for(reading.device_id, len(self.lanes)), []).append(position)
+            pending.append([(lane_positions, self.lanes[lane].enqueue([readings[i] for i in lane_positions]))
+                            for lane, lane_positions in positions.items()])
+
+        results = []
+        for readings, parts in zip(groups, pending):
+            staged = [None] * len(readings)
+            error = None
+            for lane_positions, future in parts:
+                try:
+                    lane_results = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                for position, result in zip(lane_positions, lane_results):
+                    staged[position] = result
+            results.append(error if error is not None else staged)
+        return results
+
+    def stats(self):
+        """Queued submissions, batches and committed readings per lane"""
+        return [{'lane': i, 'queued': lane.submissions.qsize(), 'batches': lane.batches,
+                 'committed': lane.committed} for i, lane in enumerate(self.lanes)]
+
+def start_ingest_lanes(app):
+    global ingest_lanes
+    ingest_lanes = IngestLanes(app)
+    ingest_lanes.start()
+    return ingest_lanes
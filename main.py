@@ -1,10 +1,19 @@
-from app import app, socketio  # noqa: F401
+import os
+
+# Patch blocking I/O before anything else imports it (gevent/eventlet modes)
+from serving import patch_for_async_mode
+patch_for_async_mode()
+
+from app import app, socketio, start_services  # noqa: F401
 
 # Import views to register routes
 from views import *  # noqa: F401
 
+# Start background services (model preload, registry watcher, retention, gateway)
+start_services(app)
+
 # Run the app if executed directly
 if __name__ == '__main__':
-    socketio.run(app, host='0.0.0.0', port=5000, debug=True)
     port = int(os.environ.get('PORT', 5000))
-    socketio.run(app, host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
+    debug = os.environ.get('FLASK_DEBUG', '1') == '1'
+    socketio.run(app, host='0.0.0.0', port=port, debug=debug)
@@ -0,0 +1,199 @@
+"""HealthSense schema migration tool
+
+Creates missing tables, columns and indexes in the configured database, and
+drops indexes that a wider one has replaced. Run it once per deploy, before
+starting the web workers:
+
+    SQLALCHEMY_DATABASE_URI=<db> python migrate.py upgrade
+
+Also copies an existing (legacy) HealthSense database into a freshly created
+compact-schema database:
+
+    HEALTHSENSE_SCHEMA_MODE=compact SQLALCHEMY_DATABASE_URI=<new db> \\
+        python migrate.py compact --source <old db>
+
+Rows are streamed in keyset-ordered batches. Unless --keep-ids is given,
+every primary key is replaced by a UUIDv7 derived from the row's timestamp and
+its old id, so rows land in time order and a re-run produces the same ids.
+"""
+import argparse
+import logging
+import os
+import sys
+
+from sqlalchemy import Column, Index, MetaData, Table, create_engine, inspect, select, text, tuple_
+
+logger = logging.getLogger(__name__)
+
+# Indexes made redundant by a wider one on the same leading columns, as
+# {table: [(name, columns, replacement)]}; each is dropped once its
+# replacement exists, so ingest stops maintaining both
+RETIRED_INDEXES = {
+    'health_data': [('ix_health_data_device_timestamp', ('device_id', 'timestamp'),
+                     'ix_health_data_device_timestamp_vitals')],
+    'predictions': [('ix_predictions_health_data_id', ('health_data_id',),
+                     'ix_predictions_health_data_id_risks')],
+}
+
+def ensure_indexes(engine, metadata, tables=None):
+    """Create indexes declared on the models that an existing database lacks, and drop retired ones
+
+    db.create_all() only creates indexes together with new tables.
+    """
+    created = []
+    for table in tables or metadata.sorted_tables:
+        for index in table.indexes:
+            if not inspect(engine).has_index(table.name, index.name):
+                index.create(bind=engine)
+                created.append(index.name)
+                logger.info(f"Created index {index.name}")
+        for name, columns, replacement in RETIRED_INDEXES.get(table.name, ()):
+            inspector = inspect(engine)
+            if inspector.has_index(table.name, name) and inspector.has_index(table.name, replacement):
+                # A detached copy of the table, so the retired index never joins the models' metadata
+                detached = Table(table.name, MetaData(), *(Column(column) for column in columns))
+                Index(name, *detached.c).drop(bind=engine)
+                logger.info(f"Dropped index {name}, covered by {replacement}")
+    return created
+
+def ensure_columns(engine, metadata, tables=None):
+    """Add nullable columns declared on the models that existing tables lack"""
+    added = []
+    inspector = inspect(engine)
+    for table in tables or metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            with engine.begin() as conn:
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            added.append(f"{table.name}.{column.name}")
+            logger.info(f"Added column {table.name}.{column.name}")
+    return added
+
+def upgrade(app=None):
+    """Bring the configured database (and every device shard) up to the models' schema
+
+    With HEALTHSENSE_SHARDS set, the primary database gets the global tables
+    and each shard gets the per-device tables.
+    """
+    if app is None:
+        from app import app
+    from app import db
+    from shards import GLOBAL_TABLES, SHARDS, shard_engine
+    import models  # noqa: F401  (registers the tables on db.metadata)
+
+    added, created = [], []
+    with app.app_context():
+        if not SHARDS:
+            targets = [(db.engine, None)]
+        else:
+            global_tables = [t for t in db.metadata.sorted_tables if t.name in GLOBAL_TABLES]
+            device_tables = [t for t in db.metadata.sorted_tables if t.name not in GLOBAL_TABLES]
+            targets = [(db.engine, global_tables)] + [(shard_engine(db, name), device_tables) for name in SHARDS]
+        for engine, tables in targets:
+            db.metadata.create_all(engine, tables=tables)
+            added += ensure_columns(engine, db.metadata, tables)
+            created += ensure_indexes(engine, db.metadata, tables)
+    logger.info("Database schema is up to date")
+    return added, created
+
+def _keyset_batches(conn, table, batch_size):
+    """Yield batches of rows ordered by (timestamp, id), then rows without a timestamp by id
+
+    A NULL timestamp never compares greater than the last key, so those
+    rows get a pass of their own.
+    """
+    passes = (
+        ((table.c.timestamp, table.c.id), table.c.timestamp.is_not(None)),
+        ((table.c.id,), table.c.timestamp.is_(None)),
+    )
+    for order, selection in passes:
+        last = None
+        while True:
+            query = select(table).where(selection).order_by(*order).limit(batch_size)
+            if last is not None:
+                query = query.where(tuple_(*order) > last)
+            rows = conn.execute(query).mappings().all()
+            if not rows:
+                break
+            yield rows
+            last = tuple(rows[-1][column.name] for column in order)
+
+def _parent_timestamps(conn, health_table, rows):
+    """Map health_data ids referenced by rows to the parent's timestamp"""
+    parent_ids = {row['health_data_id'] for row in rows}
+    query = select(health_table.c.id, health_table.c.timestamp).where(health_table.c.id.in_(parent_ids))
+    return dict(conn.execute(query).all())
+
+def migrate_compact(source_uri, batch_size=5000, rekey=True):
+    """Copy all health tables from source_uri into the configured database"""
+    from app import app, db
+    from models import COMPACT_SCHEMA, HealthData, Prediction, Alert, uuid7_from
+
+    if not COMPACT_SCHEMA:
+        raise RuntimeError("Set HEALTHSENSE_SCHEMA_MODE=compact for the target database")
+
+    source_engine = create_engine(source_uri)
+    source = MetaData()
+    source.reflect(bind=source_engine, only=['health_data', 'predictions', 'alerts'])
+    health_table = source.tables['health_data']
+
+    def health_key(row):
+        return uuid7_from(row['timestamp'], row['id']) if rekey else row['id']
+
+    counts = {}
+    with app.app_context(), source_engine.connect() as conn:
+        for model in (HealthData, Prediction, Alert):
+            table = source.tables[model.__tablename__]
+            copied = 0
+            for rows in _keyset_batches(conn, table, batch_size):
+                records = [dict(row) for row in rows]
+                if rekey:
+                    parents = {}
+                    if model is not HealthData:
+                        parents = _parent_timestamps(conn, health_table, rows)
+                    for record in records:
+                        record['id'] = uuid7_from(record['timestamp'], record['id'])
+                        if model is not HealthData:
+                            parent_ts = parents.get(record['health_data_id'])
+                            record['health_data_id'] = health_key(
+                                {'timestamp': parent_ts, 'id': record['health_data_id']}
+                            )
+                db.session.execute(model.__table__.insert(), records)
+                db.session.commit()
+                copied += len(records)
+                logger.info(f"{model.__tablename__}: copied {copied} rows")
+            counts[model.__tablename__] = copied
+    return counts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='HealthSense schema migration tool')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('upgrade', help='Create missing tables, columns and indexes')
+
+    compact = subparsers.add_parser('compact', help='Copy a legacy database into a compact-schema database')
+    compact.add_argument('--source', required=True, help='SQLAlchemy URI of the database to copy from')
+    compact.add_argument('--batch-size', type=int, default=5000, help='Rows per insert batch')
+    compact.add_argument('--keep-ids', action='store_true',
+                         help='Keep existing UUIDs instead of re-keying with time-ordered UUIDv7')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'upgrade':
+        added, created = upgrade()
+        print(f"{len(added)} columns added, {len(created)} indexes created")
+    elif args.command == 'compact':
+        if os.environ.get('HEALTHSENSE_SCHEMA_MODE') != 'compact':
+            parser.error('HEALTHSENSE_SCHEMA_MODE=compact must be set for the target database')
+        counts = migrate_compact(args.source, batch_size=args.batch_size, rekey=not args.keep_ids)
+        for table, copied in counts.items():
+            print(f"{table}: {copied} rows")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,35 +1,152 @@
+import hashlib
 import logging
 import numpy as np
 import pickle
 import os
 import random
-from sklearn.linear_model import LogisticRegression
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.svm import SVC
+import threading
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
-def create_mock_models():
-    """Create mock ML models for the MVP phase"""
-    # Mock diabetes model (Logistic Regression)
-    diabetes_model = LogisticRegression()
-    X = np.random.rand(100, 2)  # mock features (glucose, BMI)
-    y = np.random.randint(0, 2, 100)  # binary outcome
-    diabetes_model.fit(X, y)
-    
-    # Mock heart disease model (Random Forest)
-    heart_model = RandomForestClassifier(n_estimators=10)
-    X = np.random.rand(100, 3)  # mock features (bp_systolic, bp_diastolic, heart_rate)
-    y = np.random.randint(0, 2, 100)  # binary outcome
-    heart_model.fit(X, y)
-    
-    # Mock hypoxia model (SVM)
-    hypoxia_model = SVC(probability=True)
-    X = np.random.rand(100, 2)  # mock features (spo2, heart_rate)
-    y = np.random.randint(0, 2, 100)  # binary outcome
-    hypoxia_model.fit(X, y)
-    
-    return diabetes_model, heart_model, hypoxia_model
+# Readings are quantized to this step before scoring so repeated vitals hit the
+# prediction cache (0 disables caching and quantization)
+PREDICTION_QUANTUM = float(os.environ.get("HEALTHSENSE_PREDICTION_QUANTUM", 1.0))
+PREDICTION_CACHE_SIZE = int(os.environ.get("HEALTHSENSE_PREDICTION_CACHE_SIZE", 65536))
+# Precompute every probability for the small integer feature spaces
+PREDICTION_LOOKUP_TABLES = os.environ.get("HEALTHSENSE_PREDICTION_LOOKUP_TABLES", "1") == "1"
+
+def model_version(model):
+    """Identify a model for cache invalidation
+
+    Registry models are tagged with their version (see ModelSet). Any other
+    model is identified by a hash of its pickled content, computed once and
+    kept on the model; an id() could be reused by a later model.
+    """
+    version = getattr(model, 'healthsense_version', None)
+    if version is None:
+        version = 'sha1:' + hashlib.sha1(pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()
+        model.healthsense_version = version
+    return version
+
+def quantize(value):
+    return round(value / PREDICTION_QUANTUM) * PREDICTION_QUANTUM
+
+class PredictionCache:
+    """Per-model probability cache keyed on quantized feature tuples
+
+    A bounded LRU serves repeated feature tuples. When the model has a
+    declared integer grid (and the quantum is 1) a lookup table with every
+    probability on the grid is computed in one vectorized call, so in-range
+    readings never reach the model. Both are dropped when the model changes.
+    """
+
+    def __init__(self, name, to_features, grid=None, maxsize=PREDICTION_CACHE_SIZE):
+        self.name = name
+        self.to_features = to_features
+        self.grid = grid
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._version = None
+        self._table = None
+        self.hits = 0
+        self.misses = 0
+        self.table_hits = 0
+
+    def _reset(self, model, version):
+        self._entries.clear()
+        self._table = None
+        self._version = version
+        if self.grid and PREDICTION_LOOKUP_TABLES and PREDICTION_QUANTUM == 1:
+            axes = [np.arange(lo, hi + 1, dtype=np.float64) for lo, hi in self.grid]
+            points = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, len(axes))
+            probabilities = model.predict_proba(self.to_features(points))[:, 1]
+            self._table = probabilities.reshape([len(axis) for axis in axes])
+
+    def _table_lookup(self, key):
+        index = []
+        for value, (lo, hi) in zip(key, self.grid):
+            if not lo <= value <= hi:
+                return None
+            index.append(int(value) - lo)
+        return float(self._table[tuple(index)])
+
+    def probability(self, model, key):
+        version = model_version(model)
+        with self._lock:
+            if version != self._version:
+                self._reset(model, version)
+            if self._table is not None:
+                value = self._table_lookup(key)
+                if value is not None:
+                    self.table_hits += 1
+                    return value
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+        value = float(model.predict_proba(self.to_features(np.array([key], dtype=np.float64)))[0][1])
+        with self._lock:
+            self.misses += 1
+            if version == self._version:
+                self._entries[key] = value
+                if len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return value
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.table_hits
+            return {
+                'hits': self.hits,
+                'table_hits': self.table_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.table_hits) / lookups if lookups else None,
+                'entries': len(self._entries),
+                'table_size': int(self._table.size) if self._table is not None else 0
+            }
+
+def _diabetes_features(points):
+    return np.column_stack([points[:, 0], np.full(len(points), 0.5)])  # glucose and a dummy feature
+
+prediction_caches = {
+    'diabetes': PredictionCache('diabetes', _diabetes_features, grid=((0, 600),)),  # glucose mg/dL
+    'heart_disease': PredictionCache('heart_disease', lambda points: points),
+    'hypoxia': PredictionCache('hypoxia', lambda points: points, grid=((50, 100), (20, 250))),  # SpO2 %, BPM
+}
+
+def prediction_cache_stats():
+    """Hit-rate metrics for each model's prediction cache in this process"""
+    return {name: cache.stats() for name, cache in prediction_caches.items()}
+
+def warm_up(models):
+    """Build the prediction caches' lookup tables for models ahead of their first reading"""
+    diabetes_model, heart_model, hypoxia_model = models
+    predict_diabetes(diabetes_model, 100)
+    predict_heart_disease(heart_model, 120, 80, 70)
+    predict_hypoxia(hypoxia_model, 98, 70)
+
+def _probability(name, model, values):
+    cache = prediction_caches[name]
+    if PREDICTION_QUANTUM <= 0:
+        features = cache.to_features(np.array([values], dtype=np.float64))
+        return float(model.predict_proba(features)[0][1])
+    return cache.probability(model, tuple(quantize(v) for v in values))
+
+def create_mock_models(seed=0):
+    """Create the built-in models, fitted on seeded synthetic readings
+
+    Every worker builds identical models; train.py fits models on stored
+    readings instead.
+    """
+    from train import derive_labels, fit_models, synthetic_readings
+    features = synthetic_readings(2000, seed)
+    labels = derive_labels(features, np.random.default_rng(seed))
+    models, _ = fit_models(features, labels, seed=seed)
+    return models
 
 def load_models():
     """Load ML models from files or create mock models if not available"""
@@ -52,21 +169,37 @@ def load_models():
 def predict_diabetes(model, glucose):
     """Predict diabetes risk based on glucose level"""
     # In a real app, more features would be used
-    features = np.array([[glucose, 0.5]])  # glucose and a dummy feature
-    probability = model.predict_proba(features)[0][1]
-    return float(probability)
+    return _probability('diabetes', model, (glucose,))
 
 def predict_heart_disease(model, bp_systolic, bp_diastolic, heart_rate):
     """Predict heart disease risk based on blood pressure and heart rate"""
-    features = np.array([[bp_systolic, bp_diastolic, heart_rate]])
-    probability = model.predict_proba(features)[0][1]
-    return float(probability)
+    return _probability('heart_disease', model, (bp_systolic, bp_diastolic, heart_rate))
 
 def predict_hypoxia(model, spo2, heart_rate):
     """Predict hypoxia risk based on SpO2 and heart rate"""
-    features = np.array([[spo2, heart_rate]])
-    probability = model.predict_proba(features)[0][1]
-    return float(probability)
+    return _probability('hypoxia', model, (spo2, heart_rate))
+
+def predict_batch(models, features):
+    """Score many readings at once
+
+    features is an (n, 5) array of [glucose, bp_systolic, bp_diastolic,
+    spo2, heart_rate] rows; returns an (n, 3) array of diabetes, heart
+    disease and hypoxia risk.
+    """
+    diabetes_model, heart_model, hypoxia_model = models
+    features = np.asarray(features, dtype=np.float64).reshape(-1, 5)
+    risks = np.empty((len(features), 3))
+    if not len(features):
+        return risks
+    if PREDICTION_QUANTUM > 0:
+        # Quantized like the single-reading path, so both store the same risks
+        features = np.round(features / PREDICTION_QUANTUM) * PREDICTION_QUANTUM
+    risks[:, 0] = diabetes_model.predict_proba(
+        np.column_stack([features[:, 0], np.full(len(features), 0.5)])  # glucose and a dummy feature
+    )[:, 1]
+    risks[:, 1] = heart_model.predict_proba(features[:, [1, 2, 4]])[:, 1]
+    risks[:, 2] = hypoxia_model.predict_proba(features[:, [3, 4]])[:, 1]
+    return risks
 
 def get_health_alerts(health_data):
     """Generate health alerts based on sensor readings"""
@@ -0,0 +1,336 @@
+"""Model registry, hot-swap and shadow scoring for HealthSense
+
+Model versions live in a registry directory shared by all workers on a host
+(or mounted from shared storage):
+
+    <registry>/<version>/models.pkl      pickled (diabetes, heart, hypoxia) models
+    <registry>/<version>/metadata.json   free-form training metadata
+    <registry>/active                    name of the version serving requests
+    <registry>/candidate                 optional version scored in shadow mode
+
+Every worker runs a ModelManager that polls the pointer files. When one
+changes, the new version is loaded in the background (after a random delay,
+so workers do not all load at once) and swapped in with a single reference
+assignment; requests keep using the old models until then. Predictions from
+a candidate are computed off the request path and stored in
+shadow_predictions.
+
+    python model_manager.py list
+    python model_manager.py activate <version>
+    python model_manager.py shadow <version>
+    python model_manager.py unshadow
+"""
+import argparse
+import json
+import logging
+import os
+import pickle
+import queue
+import random
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from ml_models import load_models, predict_batch, warm_up
+from shards import shard_for
+
+logger = logging.getLogger(__name__)
+
+BUILTIN_VERSION = 'builtin'
+ACTIVE_POINTER = 'active'
+CANDIDATE_POINTER = 'candidate'
+
+class ModelSet:
+    """One loaded model version"""
+    __slots__ = ('version', 'models', 'metadata')
+
+    def __init__(self, version, models, metadata=None):
+        self.version = version
+        self.models = tuple(models)
+        self.metadata = metadata or {}
+        # Tag the models so per-model prediction caches reset on a swap
+        for model in self.models:
+            model.healthsense_version = version
+
+def save_model_set(registry_dir, version, models, metadata=None):
+    """Write a model version to the registry"""
+    directory = os.path.join(registry_dir, version)
+    os.makedirs(directory, exist_ok=True)
+    # Per-process temporary name: workers may save the built-in version at once
+    tmp_path = os.path.join(directory, f'models.pkl.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(tuple(models), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, os.path.join(directory, 'models.pkl'))
+    with open(os.path.join(directory, 'metadata.json'), 'w') as f:
+        json.dump({'version': version, 'created_at': datetime.utcnow().isoformat(), **(metadata or {})}, f, indent=2)
+    return directory
+
+def load_model_set(registry_dir, version):
+    """Read a model version from the registry"""
+    directory = os.path.join(registry_dir, version)
+    with open(os.path.join(directory, 'models.pkl'), 'rb') as f:
+        models = pickle.load(f)
+    metadata = {}
+    if os.path.exists(os.path.join(directory, 'metadata.json')):
+        with open(os.path.join(directory, 'metadata.json')) as f:
+            metadata = json.load(f)
+    return ModelSet(version, models, metadata)
+
+def read_pointer(registry_dir, name):
+    try:
+        with open(os.path.join(registry_dir, name)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def set_pointer(registry_dir, name, version):
+    """Atomically point active/candidate at a version (None clears it)"""
+    path = os.path.join(registry_dir, name)
+    if version is None:
+        if os.path.exists(path):
+            os.unlink(path)
+        return
+    if not os.path.exists(os.path.join(registry_dir, version, 'models.pkl')):
+        raise ValueError(f"Model version {version!r} is not in the registry")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(version)
+    os.replace(tmp_path, path)
+
+def list_versions(registry_dir):
+    if not os.path.isdir(registry_dir):
+        return []
+    return sorted(name for name in os.listdir(registry_dir)
+                  if os.path.exists(os.path.join(registry_dir, name, 'models.pkl')))
+
+class ShadowScorer(threading.Thread):
+    """Scores readings with the candidate models in the background
+
+    The request path only enqueues; when the queue is full readings are
+    dropped from shadow scoring rather than slowing ingest down.
+    """
+
+    def __init__(self, app, manager, max_queue=10000, batch_size=256):
+        super().__init__(name='healthsense-shadow-scorer', daemon=True)
+        self.app = app
+        self.manager = manager
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.scored = 0
+        self.dropped = 0
+
+    def submit(self, reading):
+        features = (reading.glucose, reading.bp_systolic, reading.bp_diastolic, reading.spo2, reading.heart_rate)
+        try:
+            self.queue.put_nowait((reading.id, features, shard_for(reading.device_id)))
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        from app import db
+        from models import ShadowPrediction, new_id
+        from shards import on_shard
+
+        while True:
+            items = [self.queue.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            candidate = self.manager.candidate()
+            if candidate is None:
+                continue
+            try:
+                risks = predict_batch(candidate.models, np.array([features for _, features, _ in items]))
+                now = datetime.utcnow().isoformat()
+                # Shadow predictions are stored on the shard of their reading
+                by_shard = {}
+                for (reading_id, _, shard), row in zip(items, risks):
+                    by_shard.setdefault(shard, []).append({
+                        'id': new_id(),
+                        'health_data_id': reading_id,
+                        'model_version': candidate.version,
+                        'diabetes_risk': float(row[0]),
+                        'heart_disease_risk': float(row[1]),
+                        'hypoxia_risk': float(row[2]),
+                        'timestamp': now
+                    })
+                with self.app.app_context():
+                    for shard, rows in by_shard.items():
+                        with on_shard(shard):
+                            db.session.execute(ShadowPrediction.__table__.insert(), rows)
+                            db.session.commit()
+                self.scored += len(items)
+            except Exception as e:
+                logger.error(f"Error in shadow scoring: {e}")
+
+class ModelManager:
+    """Holds the active (and candidate) models of one worker process"""
+
+    def __init__(self, registry_dir, poll_interval=30.0):
+        self.registry_dir = registry_dir
+        self.poll_interval = poll_interval
+        self._active = None
+        self._candidate = None
+        self._pointers = {}
+        self._lock = threading.Lock()
+        self.shadow_scorer = None
+
+    def current(self):
+        """The ModelSet serving requests, loaded on first use"""
+        if self._active is None:
+            self.refresh(initial=True)
+        return self._active
+
+    def candidate(self):
+        """The ModelSet being shadow-scored, if any"""
+        return self._candidate
+
+    def _load(self, version):
+        if version is None:
+            return None
+        if version == BUILTIN_VERSION or not os.path.exists(os.path.join(self.registry_dir, version)):
+            if version != BUILTIN_VERSION:
+                logger.error(f"Model version {version!r} not found in {self.registry_dir}")
+            return self._builtin()
+        return load_model_set(self.registry_dir, version)
+
+    def _builtin(self):
+        """The built-in models, fitted by the first worker and unpickled by the rest
+
+        They are seeded, so a saved copy is identical to a fresh fit as long
+        as scikit-learn has not been upgraded in between.
+        """
+        import sklearn
+
+        try:
+            model_set = load_model_set(self.registry_dir, BUILTIN_VERSION)
+            if model_set.metadata.get('sklearn_version') == sklearn.__version__:
+                return model_set
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Ignoring saved built-in models: {e}")
+        model_set = ModelSet(BUILTIN_VERSION, load_models())
+        try:
+            save_model_set(self.registry_dir, BUILTIN_VERSION, model_set.models,
+                           {'source': 'synthetic', 'sklearn_version': sklearn.__version__})
+        except OSError as e:
+            logger.warning(f"Could not save built-in models to {self.registry_dir}: {e}")
+        return model_set
+
+    def _read_pointers(self):
+        return {
+            ACTIVE_POINTER: read_pointer(self.registry_dir, ACTIVE_POINTER) or BUILTIN_VERSION,
+            CANDIDATE_POINTER: read_pointer(self.registry_dir, CANDIDATE_POINTER),
+        }
+
+    def refresh(self, initial=False):
+        """Load and swap in models whose registry pointers changed"""
+        with self._lock:
+            if initial and self._active is not None:
+                # Another thread finished the first load while this one waited
+                return
+            for name, version in self._read_pointers().items():
+                if not initial and self._pointers.get(name) == version:
+                    continue
+                try:
+                    model_set = self._load(version)
+                except Exception as e:
+                    logger.error(f"Error loading model version {version!r}: {e}")
+                    if name == ACTIVE_POINTER and self._active is None:
+                        model_set = self._builtin()
+                    else:
+                        continue
+                self._pointers[name] = version
+                if name == ACTIVE_POINTER:
+                    self._active = model_set
+                    logger.info(f"Serving model version {model_set.version}")
+                else:
+                    self._candidate = model_set
+                    if model_set is not None:
+                        logger.info(f"Shadow scoring model version {model_set.version}")
+
+    def shadow(self, reading):
+        """Queue a reading for candidate scoring (no-op without a candidate)"""
+        if self._candidate is not None and self.shadow_scorer is not None:
+            self.shadow_scorer.submit(reading)
+
+    def start(self, app, preload=False):
+        """Start the registry watcher and the shadow scorer threads
+
+        With preload the models are loaded in the background now rather than
+        by the first request that needs them.
+        """
+        self.shadow_scorer = ShadowScorer(app, self)
+        self.shadow_scorer.start()
+        self.watch()
+        if preload:
+            threading.Thread(target=self._preload, name='healthsense-model-preload', daemon=True).start()
+
+    def _preload(self):
+        try:
+            warm_up(self.current().models)
+        except Exception as e:
+            logger.error(f"Error preloading models: {e}")
+
+    def watch(self):
+        """Start polling the registry pointers (unless poll_interval is 0)"""
+        if self.poll_interval > 0:
+            threading.Thread(target=self._watch, name='healthsense-model-watcher', daemon=True).start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            # Until the first use loads the models there is nothing to swap
+            if self._active is not None and self._read_pointers() != self._pointers:
+                # Spread loads across workers so they do not all hit disk and CPU at once
+                time.sleep(random.uniform(0, self.poll_interval / 2))
+                try:
+                    self.refresh()
+                except Exception as e:
+                    logger.error(f"Error refreshing models: {e}")
+
+    def status(self):
+        active = self.current()
+        candidate = self._candidate
+        return {
+            'active': {'version': active.version, 'metadata': active.metadata},
+            'candidate': {'version': candidate.version, 'metadata': candidate.metadata} if candidate else None,
+            'shadow': {
+                'queued': self.shadow_scorer.queue.qsize(),
+                'scored': self.shadow_scorer.scored,
+                'dropped': self.shadow_scorer.dropped
+            } if self.shadow_scorer else None
+        }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='HealthSense model registry')
+    parser.add_argument('--registry', default=os.environ.get('HEALTHSENSE_MODEL_DIR', 'model_registry'),
+                        help='Model registry directory')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list', help='List versions and pointers')
+    activate = subparsers.add_parser('activate', help='Serve a version on all workers')
+    activate.add_argument('version')
+    shadow = subparsers.add_parser('shadow', help='Shadow-score a candidate version')
+    shadow.add_argument('version')
+    subparsers.add_parser('unshadow', help='Stop shadow scoring')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        active = read_pointer(args.registry, ACTIVE_POINTER)
+        candidate = read_pointer(args.registry, CANDIDATE_POINTER)
+        for version in list_versions(args.registry):
+            marker = ' (active)' if version == active else ' (candidate)' if version == candidate else ''
+            print(f"{version}{marker}")
+    elif args.command == 'activate':
+        set_pointer(args.registry, ACTIVE_POINTER, args.version)
+        if read_pointer(args.registry, CANDIDATE_POINTER) == args.version:
+            set_pointer(args.registry, CANDIDATE_POINTER, None)
+    elif args.command == 'shadow':
+        set_pointer(args.registry, CANDIDATE_POINTER, args.version)
+    elif args.command == 'unshadow':
+        set_pointer(args.registry, CANDIDATE_POINTER, None)
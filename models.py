@@ -1,12 +1,115 @@
 from datetime import datetime
+import hashlib
+import os
+import time
 import uuid
-from app import db
+from sqlalchemy.types import TypeDecorator
+from app import app, db
+
+SCHEMA_MODE = app.config.get("HEALTHSENSE_SCHEMA_MODE", "legacy")
+COMPACT_SCHEMA = SCHEMA_MODE == "compact"
+
+# Alert vocabularies; compact mode stores the index into these tuples, so new
+# values must only ever be appended
+ALERT_CONDITIONS = (
+    'high_glucose',
+    'low_glucose',
+    'high_blood_pressure',
+    'low_oxygen',
+    'high_heart_rate',
+    'low_heart_rate',
+    'baseline_deviation',
+)
+ALERT_SEVERITIES = ('low', 'medium', 'high')
+
+def uuid7(timestamp_ms=None, entropy=None):
+    """Generate a time-ordered UUID (RFC 9562 version 7)"""
+    if timestamp_ms is None:
+        timestamp_ms = time.time_ns() // 1_000_000
+    rand = int.from_bytes(entropy if entropy is not None else os.urandom(10), 'big')
+    value = (timestamp_ms & ((1 << 48) - 1)) << 80
+    value |= 0x7 << 76
+    value |= ((rand >> 62) & 0xFFF) << 64
+    value |= 0b10 << 62
+    value |= rand & ((1 << 62) - 1)
+    return uuid.UUID(int=value)
+
+def uuid7_from(timestamp, seed):
+    """Deterministic UUIDv7 for an existing row (used when re-keying data)"""
+    try:
+        timestamp_ms = int(datetime.fromisoformat(timestamp).timestamp() * 1000)
+    except (TypeError, ValueError):
+        timestamp_ms = 0
+    entropy = hashlib.sha1(str(seed).encode()).digest()[:10]
+    return str(uuid7(timestamp_ms, entropy))
+
+# Namespace of the name-based ids given to gateway frames
+FRAME_ID_NAMESPACE = uuid.UUID('6f1c1d3e-5a0b-4c8e-9a53-2f4f0f6c9b7d')
+
+def frame_id(device_id, seq, timestamp_ms):
+    """Deterministic primary key for a gateway frame, so a resent frame maps to the same row
+
+    In compact mode the id is a UUIDv7 on the frame's own timestamp (0 for
+    frames stamped on receipt) with entropy from the frame's identity.
+    """
+    seed = f"{device_id}|{seq}|{timestamp_ms}"
+    if COMPACT_SCHEMA:
+        return str(uuid7(timestamp_ms, hashlib.sha1(seed.encode()).digest()[:10]))
+    return str(uuid.uuid5(FRAME_ID_NAMESPACE, seed))
+
+def new_id():
+    """Primary key for a new row in the configured schema mode"""
+    if COMPACT_SCHEMA:
+        return str(uuid7())
+    return str(uuid.uuid4())
+
+class CodedString(TypeDecorator):
+    """String column stored as a small integer code into a fixed vocabulary"""
+    impl = db.SmallInteger
+    cache_ok = True
+
+    def __init__(self, codes):
+        super().__init__()
+        self.codes = tuple(codes)
+        self._lookup = {code: index for index, code in enumerate(self.codes)}
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        try:
+            return self._lookup[value]
+        except KeyError:
+            raise ValueError(f"Unknown value {value!r}, expected one of {self.codes}")
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return self.codes[value]
+
+# Column types for the selected schema mode. Compact mode keeps ids as strings
+# on the Python side (they travel through JSON and URLs) but stores them as a
+# native 16-byte UUID where the database supports one.
+if COMPACT_SCHEMA:
+    IdType = db.Uuid(as_uuid=False)
+    ConditionType = CodedString(ALERT_CONDITIONS)
+    SeverityType = CodedString(ALERT_SEVERITIES)
+else:
+    IdType = db.String(36)
+    ConditionType = db.String(50)
+    SeverityType = db.String(20)
 
 class HealthData(db.Model):
     """Database model to hold health data from wearable devices"""
     __tablename__ = 'health_data'
+    __table_args__ = (
+        db.Index('ix_health_data_timestamp', 'timestamp'),
+        # Serves per-device time ranges and covers cohort analytics (see
+        # analytics.py): runs are read in index order without table lookups
+        db.Index('ix_health_data_device_timestamp_vitals', 'device_id', 'timestamp', 'id',
+                 'glucose', 'bp_systolic', 'bp_diastolic', 'spo2', 'heart_rate'),
+    )
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = db.Column(IdType, primary_key=True, default=new_id)
     device_id = db.Column(db.String(50), nullable=False)
     glucose = db.Column(db.Float, nullable=False)  # mg/dL
     bp_systolic = db.Column(db.Float, nullable=False)  # mmHg
@@ -21,7 +124,7 @@ class HealthData(db.Model):
     
     def __init__(self, device_id, glucose, bp_systolic, bp_diastolic, 
                  spo2, heart_rate, timestamp=None):
-        self.id = str(uuid.uuid4())
+        self.id = new_id()
         self.device_id = device_id
         self.glucose = glucose
         self.bp_systolic = bp_systolic
@@ -45,21 +148,27 @@ class HealthData(db.Model):
 class Prediction(db.Model):
     """Database model to hold disease predictions"""
     __tablename__ = 'predictions'
+    __table_args__ = (
+        db.Index('ix_predictions_health_data_id_risks', 'health_data_id',
+                 'diabetes_risk', 'heart_disease_risk', 'hypoxia_risk'),
+    )
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    health_data_id = db.Column(db.String(36), db.ForeignKey('health_data.id'), nullable=False)
+    id = db.Column(IdType, primary_key=True, default=new_id)
+    health_data_id = db.Column(IdType, db.ForeignKey('health_data.id'), nullable=False)
     diabetes_risk = db.Column(db.Float, nullable=False)  # probability (0-1)
     heart_disease_risk = db.Column(db.Float, nullable=False)  # probability (0-1)
     hypoxia_risk = db.Column(db.Float, nullable=False)  # probability (0-1)
+    model_version = db.Column(db.String(64))  # registry version that produced the risks
     timestamp = db.Column(db.String(30), default=lambda: datetime.utcnow().isoformat())
     
     def __init__(self, health_data_id, diabetes_risk, heart_disease_risk, 
-                 hypoxia_risk, timestamp=None):
-        self.id = str(uuid.uuid4())
+                 hypoxia_risk, timestamp=None, model_version=None):
+        self.id = new_id()
         self.health_data_id = health_data_id
         self.diabetes_risk = diabetes_risk
         self.heart_disease_risk = heart_disease_risk
         self.hypoxia_risk = hypoxia_risk
+        self.model_version = model_version
         self.timestamp = timestamp or datetime.utcnow().isoformat()
     
     def to_dict(self):
@@ -69,27 +178,34 @@ class Prediction(db.Model):
             'diabetes_risk': self.diabetes_risk,
             'heart_disease_risk': self.heart_disease_risk,
             'hypoxia_risk': self.hypoxia_risk,
+            'model_version': self.model_version,
             'timestamp': self.timestamp
         }
 
 class Alert(db.Model):
     """Database model to hold health alerts"""
     __tablename__ = 'alerts'
+    __table_args__ = (
+        db.Index('ix_alerts_acknowledged_timestamp', 'acknowledged', 'timestamp'),
+        db.Index('ix_alerts_acknowledged_condition_timestamp', 'acknowledged', 'condition', 'timestamp'),
+        db.Index('ix_alerts_acknowledged_severity_timestamp', 'acknowledged', 'severity', 'timestamp'),
+        db.Index('ix_alerts_health_data_id', 'health_data_id'),
+    )
     
     SEVERITY_LOW = 'low'
     SEVERITY_MEDIUM = 'medium'
     SEVERITY_HIGH = 'high'
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    health_data_id = db.Column(db.String(36), db.ForeignKey('health_data.id'), nullable=False)
+    id = db.Column(IdType, primary_key=True, default=new_id)
+    health_data_id = db.Column(IdType, db.ForeignKey('health_data.id'), nullable=False)
     message = db.Column(db.String(255), nullable=False)
-    condition = db.Column(db.String(50), nullable=False)  # e.g., 'high_glucose', 'low_spo2'
-    severity = db.Column(db.String(20), nullable=False)  # low, medium, high
+    condition = db.Column(ConditionType, nullable=False)  # e.g., 'high_glucose', 'low_spo2'
+    severity = db.Column(SeverityType, nullable=False)  # low, medium, high
     timestamp = db.Column(db.String(30), default=lambda: datetime.utcnow().isoformat())
     acknowledged = db.Column(db.Boolean, default=False)
     
     def __init__(self, health_data_id, message, condition, severity, timestamp=None):
-        self.id = str(uuid.uuid4())
+        self.id = new_id()
         self.health_data_id = health_data_id
         self.message = message
         self.condition = condition
@@ -107,3 +223,167 @@ class Alert(db.Model):
             'timestamp': self.timestamp,
             'acknowledged': self.acknowledged
         }
+
+# Vital sign columns shared by readings, rollups and archives
+VITAL_FIELDS = ('glucose', 'bp_systolic', 'bp_diastolic', 'spo2', 'heart_rate')
+
+class HealthDataRollup(db.Model):
+    """Hourly per-device aggregate of readings compacted by the retention job"""
+    __tablename__ = 'health_data_rollups'
+    __table_args__ = (
+        db.UniqueConstraint('device_id', 'bucket_start', name='uq_rollup_device_bucket'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    device_id = db.Column(db.String(50), nullable=False)
+    bucket_start = db.Column(db.String(30), nullable=False)  # ISO hour, e.g. 2025-04-14T10:00:00
+    count = db.Column(db.Integer, nullable=False, default=0)
+    glucose_sum = db.Column(db.Float, nullable=False, default=0.0)
+    glucose_min = db.Column(db.Float)
+    glucose_max = db.Column(db.Float)
+    bp_systolic_sum = db.Column(db.Float, nullable=False, default=0.0)
+    bp_systolic_min = db.Column(db.Float)
+    bp_systolic_max = db.Column(db.Float)
+    bp_diastolic_sum = db.Column(db.Float, nullable=False, default=0.0)
+    bp_diastolic_min = db.Column(db.Float)
+    bp_diastolic_max = db.Column(db.Float)
+    spo2_sum = db.Column(db.Float, nullable=False, default=0.0)
+    spo2_min = db.Column(db.Float)
+    spo2_max = db.Column(db.Float)
+    heart_rate_sum = db.Column(db.Float, nullable=False, default=0.0)
+    heart_rate_min = db.Column(db.Float)
+    heart_rate_max = db.Column(db.Float)
+
+    def __init__(self, device_id, bucket_start):
+        self.device_id = device_id
+        self.bucket_start = bucket_start
+        self.count = 0
+        for field in VITAL_FIELDS:
+            setattr(self, f'{field}_sum', 0.0)
+
+    def add(self, count, sums, mins, maxs):
+        """Fold a batch of readings (per-field sum/min/max) into this bucket"""
+        self.count += count
+        for field in VITAL_FIELDS:
+            setattr(self, f'{field}_sum', getattr(self, f'{field}_sum') + sums[field])
+            current_min = getattr(self, f'{field}_min')
+            current_max = getattr(self, f'{field}_max')
+            setattr(self, f'{field}_min', mins[field] if current_min is None else min(current_min, mins[field]))
+            setattr(self, f'{field}_max', maxs[field] if current_max is None else max(current_max, maxs[field]))
+
+    def to_dict(self):
+        result = {
+            'device_id': self.device_id,
+            'bucket_start': self.bucket_start,
+            'count': self.count
+        }
+        for field in VITAL_FIELDS:
+            total = getattr(self, f'{field}_sum')
+            result[field] = {
+                'mean': total / self.count if self.count else None,
+                'min': getattr(self, f'{field}_min'),
+                'max': getattr(self, f'{field}_max')
+            }
+        return result
+
+class DeviceVersion(db.Model):
+    """Per-device data version, bumped on ingest and alert acknowledgment"""
+    __tablename__ = 'device_versions'
+
+    device_id = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.String(30), nullable=False)
+
+    def __init__(self, device_id, version=1, updated_at=None):
+        self.device_id = device_id
+        self.version = version
+        self.updated_at = updated_at or datetime.utcnow().isoformat()
+
+    def to_dict(self):
+        return {
+            'device_id': self.device_id,
+            'version': self.version,
+            'updated_at': self.updated_at
+        }
+
+class ReplicaHeartbeat(db.Model):
+    """Time last written on the primary, read back from the replica to measure its lag"""
+    __tablename__ = 'replica_heartbeat'
+
+    id = db.Column(db.Integer, primary_key=True)
+    beat_at = db.Column(db.Float, nullable=False)
+
+class SyncCursor(db.Model):
+    """How far an edge box has shipped its readings to the central server"""
+    __tablename__ = 'sync_cursors'
+
+    name = db.Column(db.String(50), primary_key=True)
+    # rowid cursor of databases from before the outbox; only read once, to fill the outbox
+    last_rowid = db.Column(db.Integer, nullable=False, default=0)
+    last_seq = db.Column(db.Integer)  # last sync_outbox.seq the server accepted
+    updated_at = db.Column(db.String(30), nullable=False)
+
+class SyncOutbox(db.Model):
+    """Readings an edge box has not shipped yet, in insertion order
+
+    seq is AUTOINCREMENT: it only grows, is never reused after deletes and
+    is not renumbered by VACUUM. Rows are deleted once shipped.
+    """
+    __tablename__ = 'sync_outbox'
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    health_data_id = db.Column(IdType, nullable=False, index=True)
+
+class DeviceBaseline(db.Model):
+    """Per-device EWMA baseline of every vital, used for anomaly detection"""
+    __tablename__ = 'device_baselines'
+
+    device_id = db.Column(db.String(50), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    state = db.Column(db.LargeBinary(80), nullable=False)  # five means then five variances, <f8
+    updated_at = db.Column(db.String(30), nullable=False)
+
+    def __init__(self, device_id, count=0, state=None, updated_at=None):
+        self.device_id = device_id
+        self.count = count
+        self.state = state or bytes(80)
+        self.updated_at = updated_at or datetime.utcnow().isoformat()
+
+    def to_dict(self):
+        from anomaly import VITALS, unpack_state
+        mean, var = unpack_state(self.state)
+        return {
+            'device_id': self.device_id,
+            'count': self.count,
+            'mean': dict(zip(VITALS, mean.tolist())),
+            'std': dict(zip(VITALS, (var ** 0.5).tolist())),
+            'updated_at': self.updated_at
+        }
+
+class ShadowPrediction(db.Model):
+    """Predictions from a candidate model version scored in shadow mode"""
+    __tablename__ = 'shadow_predictions'
+    __table_args__ = (
+        db.Index('ix_shadow_predictions_version_reading', 'model_version', 'health_data_id'),
+    )
+
+    id = db.Column(IdType, primary_key=True, default=new_id)
+    # No foreign key: shadow rows must not block retention of readings
+    health_data_id = db.Column(IdType, nullable=False)
+    model_version = db.Column(db.String(64), nullable=False)
+    diabetes_risk = db.Column(db.Float, nullable=False)
+    heart_disease_risk = db.Column(db.Float, nullable=False)
+    hypoxia_risk = db.Column(db.Float, nullable=False)
+    timestamp = db.Column(db.String(30), default=lambda: datetime.utcnow().isoformat())
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'health_data_id': self.health_data_id,
+            'model_version': self.model_version,
+            'diabetes_risk': self.diabetes_risk,
+            'heart_disease_risk': self.heart_disease_risk,
+            'hypoxia_risk': self.hypoxia_risk,
+            'timestamp': self.timestamp
+        }
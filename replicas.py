@@ -0,0 +1,165 @@
+"""Read-replica routing for dashboard and report queries
+
+With HEALTHSENSE_REPLICA_URI set, views decorated with @read_replica run
+their queries on the `replica` bind instead of the primary, so dashboards
+and reports do not compete with ingest for the primary's connections, locks
+and I/O. Everything else (ingest, acknowledgments, CLI tools) uses the
+primary. Inside a read-only view a query still goes to the primary when:
+
+- the request has already written (flushed, or executed INSERT/UPDATE/DELETE)
+- the replica is lagging more than HEALTHSENSE_REPLICA_MAX_LAG seconds, or
+  its lag is unknown because the last check failed
+- the client wrote something the replica may not have yet (read-your-writes)
+
+Lag is measured by a heartbeat. Every HEALTHSENSE_REPLICA_CHECK_INTERVAL
+seconds each worker writes the current time to replica_heartbeat on the
+primary and reads the row back from the replica. The newest heartbeat the
+replica has marks a point in time. Every commit before it is visible there.
+The lag is the time from that point to the commit of the heartbeat just
+written: the stretch of primary commits the replica has not applied yet.
+
+Read-your-writes: views decorated with @read_your_writes (the alert
+acknowledgment endpoints) store the time in the client's session cookie
+when they wrote. Until the replica's heartbeat passes that time, the
+client's reads go to the primary. An operator who acknowledges an alert
+therefore sees it acknowledged on the next poll. Other writes, such as
+device ingest, set no cookie.
+
+For tests and development, point HEALTHSENSE_REPLICA_URI at the primary
+database itself. Routing and the lag checks then run against a replica that
+never lags.
+"""
+import logging
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import g, has_request_context, session as client_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+REPLICA_BIND = 'replica'
+# Replica connection string (unset: every query goes to the primary)
+REPLICA_URI = os.environ.get("HEALTHSENSE_REPLICA_URI")
+# Seconds of replica lag above which reads fall back to the primary
+REPLICA_MAX_LAG = float(os.environ.get("HEALTHSENSE_REPLICA_MAX_LAG", 5))
+# Seconds between heartbeat checks
+REPLICA_CHECK_INTERVAL = float(os.environ.get("HEALTHSENSE_REPLICA_CHECK_INTERVAL", 2))
+
+LAST_WRITE_KEY = 'healthsense_last_write'
+
+# Latest heartbeat check: replica lag in seconds (None: unknown) and the
+# newest primary time the replica is known to include
+_replica = {'lag': None, 'synced_at': None, 'checked_at': None, 'error': None}
+
+class RoutingSession(Session):
+    """Session that sends read-only views' queries to the replica bind"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        if bind is not None or not has_request_context() or not g.get('healthsense_read_only'):
+            return engine
+        engines = self._db.engines
+        if engine is not engines.get(None) or REPLICA_BIND not in engines:
+            return engine
+        if self._flushing or getattr(clause, 'is_dml', False) or self.new or self.dirty or self.deleted:
+            g.healthsense_wrote = True
+        if g.get('healthsense_wrote') or not replica_usable():
+            return engine
+        g.healthsense_replica_reads = g.get('healthsense_replica_reads', 0) + 1
+        return engines[REPLICA_BIND]
+
+def replica_usable():
+    """Whether the current client may read from the replica right now"""
+    lag = _replica['lag']
+    if lag is None or lag > REPLICA_MAX_LAG:
+        return False
+    last_write = client_session.get(LAST_WRITE_KEY)
+    return last_write is None or (_replica['synced_at'] or 0) >= last_write
+
+def read_replica(view):
+    """Run a read-only view's queries on the replica when it is fresh enough"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.healthsense_read_only = True
+        return view(*args, **kwargs)
+    return wrapper
+
+def read_your_writes(view):
+    """Send the client's reads to the primary until the replica has this view's writes"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.healthsense_read_your_writes = True
+        return view(*args, **kwargs)
+    return wrapper
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _mark_write(session, flush_context):
+    if has_request_context():
+        g.healthsense_wrote = True
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _mark_bulk_write(orm_execute_state):
+    if has_request_context() and (orm_execute_state.is_insert or orm_execute_state.is_update
+                                  or orm_execute_state.is_delete):
+        g.healthsense_wrote = True
+
+def init_app(app):
+    """Remember in the client's session cookie when a @read_your_writes view wrote"""
+    @app.after_request
+    def remember_write(response):
+        if g.get('healthsense_wrote') and g.get('healthsense_read_your_writes'):
+            client_session[LAST_WRITE_KEY] = time.time()
+        return response
+
+def check_replica():
+    """Write a heartbeat on the primary and see how far the replica has got"""
+    from sqlalchemy import select, update
+    from app import db
+    from models import ReplicaHeartbeat
+
+    table = ReplicaHeartbeat.__table__
+    beat = time.time()
+    try:
+        with db.engines[None].begin() as conn:
+            updated = conn.execute(update(table).where(table.c.id == 1).values(beat_at=beat)).rowcount
+            if not updated:
+                conn.execute(table.insert().values(id=1, beat_at=beat))
+        committed = time.time()
+        with db.engines[REPLICA_BIND].connect() as conn:
+            seen = conn.execute(select(table.c.beat_at).where(table.c.id == 1)).scalar()
+    except Exception as e:
+        if _replica['error'] is None:
+            logger.warning(f"Replica check failed, reading from the primary: {e}")
+        _replica.update(lag=None, checked_at=time.time(), error=str(e))
+        return _replica
+    now = time.time()
+    # Commits up to `seen` are on the replica; those after it, up to our
+    # heartbeat's commit, may not be
+    lag = None if seen is None else max(0.0, committed - seen)
+    if lag is not None and lag > REPLICA_MAX_LAG and (_replica['lag'] or 0) <= REPLICA_MAX_LAG:
+        logger.warning(f"Replica is {lag:.1f}s behind, reading from the primary")
+    _replica.update(lag=lag, synced_at=seen, checked_at=now, error=None)
+    return _replica
+
+class ReplicaMonitor(threading.Thread):
+    """Checks replica lag every REPLICA_CHECK_INTERVAL seconds"""
+
+    def __init__(self, app, interval=None):
+        super().__init__(name='healthsense-replica-monitor', daemon=True)
+        self.app = app
+        self.interval = interval or REPLICA_CHECK_INTERVAL
+
+    def run(self):
+        while True:
+            with self.app.app_context():
+                check_replica()
+            time.sleep(self.interval)
+
+def replica_status():
+    status = dict(_replica)
+    status.update(configured=REPLICA_URI is not None, max_lag=REPLICA_MAX_LAG)
+    return status
@@ -0,0 +1,199 @@
+"""Offline re-scoring of historical readings with a registry model version
+
+    python rescore.py <version> [--processes 4] [--batch-size 5000]
+
+The readings are split into --processes key ranges of roughly equal size,
+ordered by (timestamp, id). Each range is handled by its own process and
+database connection. Each process streams its range in keyset-ordered
+chunks. It scores every chunk with one vectorized call per model, then
+replaces the chunk's predictions in a single short transaction. After each
+chunk it records a checkpoint, so an interrupted run resumes where it
+stopped:
+
+    <checkpoint dir>/<version>/plan.json     the key ranges of the run
+    <checkpoint dir>/<version>/part-N.json   last key and row count per range
+
+Replacing predictions is idempotent, so a chunk that is re-run after a crash
+between its commit and its checkpoint does no harm. With device shards,
+every shard is split into its own ranges (part-<shard>-N.json). SQLite serializes
+writers, so use one process there; server databases scale with --processes.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import create_engine, func, select, tuple_
+
+logger = logging.getLogger(__name__)
+
+FEATURE_COLUMNS = ('glucose', 'bp_systolic', 'bp_diastolic', 'spo2', 'heart_rate')
+
+def _write_json(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def plan_ranges(conn, health_table, parts):
+    """Split readings into key ranges of roughly equal row counts
+
+    Returns parts+1 boundaries; range i covers keys in (b[i], b[i+1]], with
+    None meaning unbounded.
+    """
+    order = (health_table.c.timestamp, health_table.c.id)
+    total = conn.execute(select(func.count()).select_from(health_table)).scalar()
+    boundaries = [None]
+    for i in range(1, parts):
+        row = conn.execute(select(*order).order_by(*order).offset(total * i // parts).limit(1)).first()
+        if row is not None and (boundaries[-1] is None or tuple(row) > tuple(boundaries[-1])):
+            boundaries.append(list(row))
+    boundaries.append(None)
+    return boundaries
+
+def rescore_range(database_uri, models, version, part, lower, upper, checkpoint_path, batch_size):
+    """Re-score one key range, resuming from its checkpoint; returns rows scored"""
+    from ml_models import predict_batch
+    from models import HealthData, Prediction, DeviceVersion, new_id
+
+    health_table = HealthData.__table__
+    prediction_table = Prediction.__table__
+    version_table = DeviceVersion.__table__
+    order = (health_table.c.timestamp, health_table.c.id)
+    columns = [health_table.c.id, health_table.c.device_id, health_table.c.timestamp,
+               *[health_table.c[name] for name in FEATURE_COLUMNS]]
+
+    checkpoint = _read_json(checkpoint_path) or {'last': lower, 'scored': 0, 'done': False}
+    if checkpoint['done']:
+        return checkpoint['scored']
+
+    engine = create_engine(database_uri)
+    started = time.monotonic()
+    try:
+        while True:
+            query = select(*columns).order_by(*order).limit(batch_size)
+            if checkpoint['last'] is not None:
+                query = query.where(tuple_(*order) > tuple(checkpoint['last']))
+            if upper is not None:
+                query = query.where(tuple_(*order) <= tuple(upper))
+
+            with engine.begin() as conn:
+                rows = conn.execute(query).all()
+                if not rows:
+                    break
+                ids = [row[0] for row in rows]
+                risks = predict_batch(models, np.array([row[3:] for row in rows], dtype=np.float64))
+                conn.execute(prediction_table.delete().where(prediction_table.c.health_data_id.in_(ids)))
+                conn.execute(prediction_table.insert(), [
+                    {
+                        'id': new_id(),
+                        'health_data_id': row[0],
+                        'diabetes_risk': float(risk[0]),
+                        'heart_disease_risk': float(risk[1]),
+                        'hypoxia_risk': float(risk[2]),
+                        'model_version': version,
+                        'timestamp': row[2]
+                    }
+                    for row, risk in zip(rows, risks)
+                ])
+                # Let cached history responses for these devices go stale
+                conn.execute(version_table.update()
+                             .where(version_table.c.device_id.in_({row[1] for row in rows}))
+                             .values(version=version_table.c.version + 1,
+                                     updated_at=datetime.utcnow().isoformat()))
+
+            checkpoint['last'] = [rows[-1][2], rows[-1][0]]
+            checkpoint['scored'] += len(rows)
+            _write_json(checkpoint_path, checkpoint)
+            rate = checkpoint['scored'] / max(time.monotonic() - started, 1e-9)
+            logger.info(f"Range {part}: {checkpoint['scored']} readings re-scored ({rate:.0f}/s)")
+    finally:
+        engine.dispose()
+
+    checkpoint['done'] = True
+    _write_json(checkpoint_path, checkpoint)
+    return checkpoint['scored']
+
+def rescore(version, processes=1, batch_size=5000, checkpoint_dir='rescore_checkpoints', restart=False):
+    """Re-score all readings with a model version; returns rows scored per range"""
+    from app import app
+    from models import HealthData
+    from ml_models import load_models
+    from model_manager import BUILTIN_VERSION, load_model_set
+    from shards import SHARDS
+
+    # Load the models once so every range is scored by identical models
+    if version == BUILTIN_VERSION:
+        models = load_models()
+    else:
+        models = load_model_set(os.environ.get("HEALTHSENSE_MODEL_DIR", "model_registry"), version).models
+    # Every shard is split into its own key ranges
+    databases = dict(SHARDS) or {None: app.config['SQLALCHEMY_DATABASE_URI']}
+    run_dir = os.path.join(checkpoint_dir, version)
+    os.makedirs(run_dir, exist_ok=True)
+    plan_path = os.path.join(run_dir, 'plan.json')
+
+    plan = None if restart else _read_json(plan_path)
+    if plan is None:
+        for name in os.listdir(run_dir):
+            os.unlink(os.path.join(run_dir, name))
+        plan = {}
+        for shard, database_uri in databases.items():
+            engine = create_engine(database_uri)
+            with engine.connect() as conn:
+                boundaries = plan_ranges(conn, HealthData.__table__, processes)
+            engine.dispose()
+            if shard is None:
+                plan['boundaries'] = boundaries
+            else:
+                plan.setdefault('shards', {})[shard] = boundaries
+        _write_json(plan_path, plan)
+    else:
+        logger.info(f"Resuming re-score of {version} from {run_dir}")
+
+    jobs = []
+    for shard, database_uri in databases.items():
+        boundaries = plan['boundaries'] if shard is None else plan['shards'][shard]
+        prefix = 'part' if shard is None else f'part-{shard}'
+        jobs.extend(
+            (database_uri, models, version, part, boundaries[part], boundaries[part + 1],
+             os.path.join(run_dir, f'{prefix}-{part}.json'), batch_size)
+            for part in range(len(boundaries) - 1)
+        )
+    if len(jobs) == 1:
+        return [rescore_range(*jobs[0])]
+    with ProcessPoolExecutor(max_workers=len(jobs), mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = [executor.submit(rescore_range, *job) for job in jobs]
+        return [future.result() for future in futures]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Re-score historical readings with a model version')
+    parser.add_argument('version', help="Registry model version (or 'builtin')")
+    parser.add_argument('--processes', type=int, default=1, help='Parallel key ranges / processes')
+    parser.add_argument('--batch-size', type=int, default=5000, help='Readings per chunk and transaction')
+    parser.add_argument('--checkpoint-dir', default='rescore_checkpoints', help='Where progress is recorded')
+    parser.add_argument('--restart', action='store_true', help='Ignore existing checkpoints for this version')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    started = time.monotonic()
+    counts = rescore(args.version, args.processes, args.batch_size, args.checkpoint_dir, args.restart)
+    elapsed = time.monotonic() - started
+    print(f"Re-scored {sum(counts)} readings with {args.version} in {elapsed:.1f}s")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,360 @@
+"""Data retention, rollup compaction and archiving for HealthSense
+
+Policies are configured per table with HEALTHSENSE_RETENTION, e.g.
+"health_data=30,predictions=30,alerts=90" (days, 0 keeps rows forever):
+
+- health_data: raw readings older than the policy are folded into hourly
+  rollups, written together with their predictions to compressed columnar
+  archive files under HEALTHSENSE_ARCHIVE_DIR, then deleted.
+- predictions: predictions (including shadow predictions) older than the
+  policy are deleted once their reading is gone (archived or deleted), so
+  a reading that is still served keeps its risks.
+- alerts: acknowledged alerts older than the policy are deleted. Readings
+  still referenced by an alert are kept until the alert itself expires.
+
+On an edge box, readings still in the sync outbox (not yet accepted by the
+central server) are kept, together with their alerts, whatever their age.
+
+Archive files live under <archive>/<device>/<day>/. A by-day index,
+<archive>/@days/<day>/<device> (empty marker files), lets reads across
+all devices open only the days they need.
+
+The job works in small batches, each in its own short transaction, and sleeps
+between batches so it never holds long locks or starves ingest.
+"""
+import argparse
+import fcntl
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from timeseries_store import device_dir_name
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLICIES = {'health_data': 30, 'predictions': 30, 'alerts': 90}
+
+ARCHIVE_COLUMNS = ('id', 'device_id', 'timestamp', 'glucose', 'bp_systolic', 'bp_diastolic',
+                   'spo2', 'heart_rate', 'diabetes_risk', 'heart_disease_risk', 'hypoxia_risk')
+
+def parse_policies(value):
+    """Parse "table=days,..." into a policy dict, falling back to defaults"""
+    policies = dict(DEFAULT_POLICIES)
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        table, _, days = item.partition('=')
+        table = table.strip()
+        if table not in DEFAULT_POLICIES:
+            raise ValueError(f"Unknown retention table: {table}")
+        policies[table] = int(days)
+    return policies
+
+def cutoff_for(days, now=None):
+    """ISO timestamp before which rows fall outside a retention window"""
+    if not days:
+        return None
+    now = now or datetime.utcnow()
+    return (now - timedelta(days=days)).isoformat()
+
+# Device directory names always escape '@', so the index never collides with one
+DAY_INDEX = '@days'
+
+def _device_dir(archive_dir, device_id):
+    return os.path.join(archive_dir, device_dir_name(device_id))
+
+def index_archive(archive_dir):
+    """Build the by-day index for an archive written before it existed; no-op once it exists"""
+    index_dir = os.path.join(archive_dir, DAY_INDEX)
+    if os.path.isdir(index_dir) or not os.path.isdir(archive_dir):
+        return
+    tmp_dir = f"{index_dir}.{os.getpid()}.tmp"
+    for device_dir in glob.glob(os.path.join(archive_dir, '*')):
+        if os.path.basename(device_dir).startswith('@') or not os.path.isdir(device_dir):
+            continue
+        for day in os.listdir(device_dir):
+            os.makedirs(os.path.join(tmp_dir, day), exist_ok=True)
+            open(os.path.join(tmp_dir, day, os.path.basename(device_dir)), 'a').close()
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        os.rename(tmp_dir, index_dir)
+    except OSError:
+        # Another process built it first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    else:
+        logger.info(f"Indexed archive {archive_dir} by day")
+
+def write_archive(archive_dir, device_id, day, columns):
+    """Atomically write one compressed columnar archive file and index it by day"""
+    directory = os.path.join(_device_dir(archive_dir, device_id), day)
+    os.makedirs(directory, exist_ok=True)
+    index_dir = os.path.join(archive_dir, DAY_INDEX, day)
+    os.makedirs(index_dir, exist_ok=True)
+    open(os.path.join(index_dir, device_dir_name(device_id)), 'a').close()
+    digest = hashlib.sha1(''.join(columns['id']).encode()).hexdigest()[:16]
+    path = os.path.join(directory, f"{columns['timestamp'][0].replace(':', '')}_{digest}.npz")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, **{name: np.asarray(columns[name]) for name in ARCHIVE_COLUMNS})
+    os.replace(tmp_path, path)
+    return path
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except FileNotFoundError:
+        return []
+
+def read_archive(archive_dir, start_time, end_time=None, device_id=None, limit=None):
+    """Return archived readings with timestamps in [start_time, end_time)
+
+    Days are read newest first; with limit, reading stops after the day
+    that brings the count to limit, so the newest limit readings are
+    complete. Returns (readings, predictions) shaped like the history API
+    output.
+    """
+    start_day = start_time[:10]
+    end_day = end_time[:10] if end_time else None
+    if device_id is not None:
+        days = _listdir(_device_dir(archive_dir, device_id))
+    else:
+        index_archive(archive_dir)
+        days = _listdir(os.path.join(archive_dir, DAY_INDEX))
+    days = sorted((day for day in days if day >= start_day and not (end_day and day > end_day)), reverse=True)
+
+    readings = {}
+    predictions = {}
+    for day in days:
+        if limit and len(readings) >= limit:
+            break
+        if device_id is not None:
+            device_dirs = [_device_dir(archive_dir, device_id)]
+        else:
+            device_dirs = [os.path.join(archive_dir, name)
+                           for name in _listdir(os.path.join(archive_dir, DAY_INDEX, day))]
+        for device_dir in device_dirs:
+            day_dir = os.path.join(device_dir, day)
+            for path in sorted(glob.glob(os.path.join(day_dir, '*.npz'))):
+                with np.load(path) as archive:
+                    columns = {name: archive[name] for name in ARCHIVE_COLUMNS}
+                mask = columns['timestamp'] >= start_time
+                if end_time:
+                    mask &= columns['timestamp'] < end_time
+                for i in np.flatnonzero(mask):
+                    reading_id = str(columns['id'][i])
+                    # Files are written before the delete commits, so a retried
+                    # batch can be archived twice; ids make that harmless
+                    if reading_id in readings:
+                        continue
+                    readings[reading_id] = {
+                        'id': reading_id,
+                        'device_id': str(columns['device_id'][i]),
+                        'glucose': float(columns['glucose'][i]),
+                        'bp_systolic': float(columns['bp_systolic'][i]),
+                        'bp_diastolic': float(columns['bp_diastolic'][i]),
+                        'spo2': float(columns['spo2'][i]),
+                        'heart_rate': float(columns['heart_rate'][i]),
+                        'timestamp': str(columns['timestamp'][i])
+                    }
+                    if not np.isnan(columns['diabetes_risk'][i]):
+                        predictions[reading_id] = {
+                            'health_data_id': reading_id,
+                            'diabetes_risk': float(columns['diabetes_risk'][i]),
+                            'heart_disease_risk': float(columns['heart_disease_risk'][i]),
+                            'hypoxia_risk': float(columns['hypoxia_risk'][i])
+                        }
+    return sorted(readings.values(), key=lambda r: r['timestamp']), predictions
+
+def _rollup_batch(readings):
+    """Group a batch of readings into per-(device, hour) sum/min/max aggregates"""
+    from models import VITAL_FIELDS
+
+    groups = {}
+    for reading in readings:
+        key = (reading.device_id, reading.timestamp[:13] + ':00:00')
+        groups.setdefault(key, []).append(reading)
+
+    aggregates = {}
+    for key, rows in groups.items():
+        values = {field: np.array([getattr(r, field) for r in rows], dtype=np.float64) for field in VITAL_FIELDS}
+        aggregates[key] = (
+            len(rows),
+            {field: float(v.sum()) for field, v in values.items()},
+            {field: float(v.min()) for field, v in values.items()},
+            {field: float(v.max()) for field, v in values.items()},
+        )
+    return aggregates
+
+def archive_readings_batch(archive_dir, cutoff, batch_size):
+    """Compact, archive and delete one batch of expired readings
+
+    Returns the number of readings archived.
+    """
+    from app import db
+    from models import HealthData, HealthDataRollup, Prediction, Alert, SyncOutbox
+
+    index_archive(archive_dir)
+    referenced = db.session.query(Alert.health_data_id)
+    unshipped = db.session.query(SyncOutbox.health_data_id)
+    readings = (HealthData.query
+                .filter(HealthData.timestamp < cutoff)
+                .filter(~HealthData.id.in_(referenced))
+                .filter(~HealthData.id.in_(unshipped))
+                .order_by(HealthData.timestamp)
+                .limit(batch_size)
+                .all())
+    if not readings:
+        return 0
+
+    reading_ids = [r.id for r in readings]
+    risks = {p.health_data_id: p for p in Prediction.query.filter(Prediction.health_data_id.in_(reading_ids))}
+
+    # Write archive files first: if the transaction below fails the rows stay
+    # in the database and the duplicate archive entries are ignored on read
+    by_file = {}
+    for reading in readings:
+        by_file.setdefault((reading.device_id, reading.timestamp[:10]), []).append(reading)
+    for (device_id, day), rows in by_file.items():
+        columns = {name: [] for name in ARCHIVE_COLUMNS}
+        for reading in rows:
+            prediction = risks.get(reading.id)
+            for name in ARCHIVE_COLUMNS[:8]:
+                columns[name].append(getattr(reading, name))
+            for name in ARCHIVE_COLUMNS[8:]:
+                columns[name].append(getattr(prediction, name) if prediction else np.nan)
+        write_archive(archive_dir, device_id, day, columns)
+
+    for (device_id, bucket_start), (count, sums, mins, maxs) in _rollup_batch(readings).items():
+        rollup = HealthDataRollup.query.filter_by(device_id=device_id, bucket_start=bucket_start).first()
+        if rollup is None:
+            rollup = HealthDataRollup(device_id, bucket_start)
+            db.session.add(rollup)
+        rollup.add(count, sums, mins, maxs)
+
+    Prediction.query.filter(Prediction.health_data_id.in_(reading_ids)).delete(synchronize_session=False)
+    HealthData.query.filter(HealthData.id.in_(reading_ids)).delete(synchronize_session=False)
+    db.session.commit()
+    return len(readings)
+
+def _reading_gone(model):
+    """Criterion for rows whose reading has been archived or deleted"""
+    from app import db
+    from models import HealthData
+    return ~db.session.query(HealthData.id).filter(HealthData.id == model.health_data_id).exists()
+
+def prune_batch(model, cutoff, batch_size, *criteria):
+    """Delete one batch of rows older than cutoff, returning the count"""
+    from app import db
+
+    ids = [row[0] for row in (db.session.query(model.id)
+                              .filter(model.timestamp < cutoff, *criteria)
+                              .limit(batch_size))]
+    if ids:
+        model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+    return len(ids)
+
+def run_retention(policies, archive_dir, batch_size=500, pause=0.2, now=None):
+    """Apply all retention policies once on every shard, batch by batch
+
+    Returns a dict of rows removed per table.
+    """
+    from shards import on_shard, shard_names
+
+    removed = {'health_data': 0, 'predictions': 0, 'alerts': 0}
+    for shard in shard_names():
+        with on_shard(shard):
+            for table, count in _run_retention_on_shard(policies, archive_dir, batch_size, pause, now).items():
+                removed[table] += count
+    return removed
+
+def _run_retention_on_shard(policies, archive_dir, batch_size, pause, now):
+    from app import db
+    from models import Prediction, ShadowPrediction, Alert, SyncOutbox
+
+    def drain(step):
+        total = 0
+        while True:
+            done = step()
+            total += done
+            if done < batch_size:
+                return total
+            time.sleep(pause)
+
+    removed = {'health_data': 0, 'predictions': 0, 'alerts': 0}
+
+    cutoff = cutoff_for(policies.get('alerts'), now)
+    if cutoff:
+        unshipped = db.session.query(SyncOutbox.health_data_id)
+        removed['alerts'] = drain(lambda: prune_batch(Alert, cutoff, batch_size, Alert.acknowledged.is_(True),
+                                                      ~Alert.health_data_id.in_(unshipped)))
+
+    cutoff = cutoff_for(policies.get('health_data'), now)
+    if cutoff:
+        removed['health_data'] = drain(lambda: archive_readings_batch(archive_dir, cutoff, batch_size))
+
+    cutoff = cutoff_for(policies.get('predictions'), now)
+    if cutoff:
+        removed['predictions'] = drain(lambda: prune_batch(Prediction, cutoff, batch_size,
+                                                           _reading_gone(Prediction)))
+        removed['predictions'] += drain(lambda: prune_batch(ShadowPrediction, cutoff, batch_size,
+                                                            _reading_gone(ShadowPrediction)))
+
+    return removed
+
+class RetentionJob(threading.Thread):
+    """Background thread that applies retention policies periodically
+
+    Only one process per archive directory runs the job at a time; other
+    gunicorn workers skip a cycle when the lock is held.
+    """
+
+    def __init__(self, app, interval, batch_size=500, pause=0.2):
+        super().__init__(name='healthsense-retention', daemon=True)
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run_once(self):
+        archive_dir = self.app.config['HEALTHSENSE_ARCHIVE_DIR']
+        os.makedirs(archive_dir, exist_ok=True)
+        with open(os.path.join(archive_dir, '.retention.lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.debug("Retention job already running in another process")
+                return None
+            with self.app.app_context():
+                removed = run_retention(self.app.config['HEALTHSENSE_RETENTION'], archive_dir,
+                                        self.batch_size, self.pause)
+            logger.info(f"Retention job finished: {removed}")
+            return removed
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Error running retention job: {e}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply HealthSense retention policies once')
+    parser.add_argument('--batch-size', type=int, default=500, help='Rows per transaction')
+    parser.add_argument('--pause', type=float, default=0.2, help='Seconds to sleep between batches')
+    args = parser.parse_args()
+
+    from app import app
+    removed = RetentionJob(app, interval=0, batch_size=args.batch_size, pause=args.pause).run_once()
+    print(removed if removed is not None else 'Retention job is already running')
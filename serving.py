@@ -0,0 +1,56 @@
+"""Serving mode selection for HealthSense
+
+HEALTHSENSE_ASYNC_MODE picks how the web process handles concurrency:
+
+- threading (default): one OS thread per request/socket, blocking I/O.
+- gevent / eventlet: cooperative greenlets, so one process can hold
+  thousands of idle device and dashboard connections. Sockets, locks and
+  (through psycogreen) psycopg2 queries become non-blocking; CPU-bound model
+  scoring should then run in the inference process pool
+  (HEALTHSENSE_INFERENCE_PROCESSES) so it does not stall the event loop.
+
+patch_for_async_mode() must run before anything imports socket, threading
+or psycopg2, which is why main.py calls it first.
+
+HEALTHSENSE_SOCKETIO_MESSAGE_QUEUE (e.g. redis://host:6379/0) connects the
+Socket.IO servers of all workers, so an event emitted to a room in one
+worker reaches the room's sockets in every worker. It needs the `redis`
+package (or `kombu` for other brokers).
+"""
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+ASYNC_MODES = ('threading', 'gevent', 'eventlet')
+ASYNC_MODE = os.environ.get("HEALTHSENSE_ASYNC_MODE", "threading")
+SOCKETIO_MESSAGE_QUEUE = os.environ.get("HEALTHSENSE_SOCKETIO_MESSAGE_QUEUE")
+
+if ASYNC_MODE not in ASYNC_MODES:
+    raise ValueError(f"HEALTHSENSE_ASYNC_MODE must be one of {ASYNC_MODES}, got {ASYNC_MODE!r}")
+
+_patched = False
+
+def patch_for_async_mode():
+    """Monkey-patch blocking I/O for the gevent and eventlet serving modes"""
+    global _patched
+    if _patched or ASYNC_MODE == 'threading':
+        return
+    _patched = True
+
+    if ASYNC_MODE == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+    else:
+        import eventlet
+        eventlet.monkey_patch()
+
+    # Make psycopg2 yield to the event loop while waiting on PostgreSQL
+    try:
+        if ASYNC_MODE == 'gevent':
+            from psycogreen.gevent import patch_psycopg
+        else:
+            from psycogreen.eventlet import patch_psycopg
+        patch_psycopg()
+    except ImportError:
+        logger.warning("psycogreen is not installed; database calls will block the event loop")
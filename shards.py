@@ -0,0 +1,423 @@
+"""Device sharding: each device's data lives in one of several databases
+
+With HEALTHSENSE_SHARDS set, e.g. "s0=postgresql://db0/hs,s1=postgresql://db1/hs",
+the readings, predictions, alerts, baselines, rollups and data versions of
+a device are stored in the shard that owns its device_id. Owners come from
+a consistent hash ring with HEALTHSENSE_SHARD_VNODES points per shard.
+Adding a shard therefore moves only about 1/N of the devices, all of them
+to the new shard.
+
+Code selects a shard with `with on_shard(name):`. Every query of the
+session then goes to that shard, except queries on GLOBAL_TABLES, which
+stay in the primary database (SQLALCHEMY_DATABASE_URI):
+
+- Ingest stores each reading on its device's owner.
+- Queries for one device go to its owner.
+- Population queries (alerts overview, cohort analytics, the device list,
+  the latest reading) run on every shard in parallel with scatter(), and
+  their results are merged.
+
+The read replica (replicas.py) mirrors only the primary, so with shards
+configured, device queries never go to it.
+
+The primary can also be listed as a shard. That is how an existing
+database starts sharding: list it as the first shard, add the new ones,
+deploy the new setting to every worker, then run
+
+    python shards.py rebalance [--dry-run] [--drain old=<uri>]
+
+This moves every device whose owner changed, batch by batch. Each batch is
+copied to the new owner and then deleted from the old one. The command can
+be re-run after an interruption. `--drain` also empties a shard that has
+been removed from HEALTHSENSE_SHARDS.
+
+    python shards.py status
+    python shards.py locate <device_id>
+
+For local testing the shards can be SQLite files:
+HEALTHSENSE_SHARDS="s0=sqlite:////tmp/hs-s0.db,s1=sqlite:////tmp/hs-s1.db"
+"""
+import argparse
+import bisect
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+
+import sqlalchemy as sa
+from flask import current_app
+
+from replicas import RoutingSession
+
+logger = logging.getLogger(__name__)
+
+# Tables that stay in the primary database; all others are per shard
+GLOBAL_TABLES = ('replica_heartbeat', 'sync_cursors')
+# Points per shard on the hash ring; more points spread devices more evenly
+SHARD_VNODES = int(os.environ.get("HEALTHSENSE_SHARD_VNODES", 64))
+# Threads running scatter() queries, shared by all requests of a worker
+SHARD_WORKERS = int(os.environ.get("HEALTHSENSE_SHARD_WORKERS", 16))
+
+def parse_shards(value):
+    """Parse "name=uri,name=uri" into an ordered {name: uri} dict"""
+    shards = {}
+    # Split only at commas that start a new "name=", so URIs may contain commas
+    for item in re.split(r',\s*(?=[\w-]+=)', (value or '').strip()):
+        if not item.strip():
+            continue
+        name, _, uri = item.partition('=')
+        name, uri = name.strip(), uri.strip()
+        if not name or not uri:
+            raise ValueError(f"Shards must be given as name=uri, got {item!r}")
+        if name in shards:
+            raise ValueError(f"Shard {name} is listed twice")
+        shards[name] = uri
+    return shards
+
+SHARDS = parse_shards(os.environ.get("HEALTHSENSE_SHARDS"))
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+class HashRing:
+    """Consistent hash ring mapping keys to shard names"""
+
+    def __init__(self, names, vnodes=SHARD_VNODES):
+        points = sorted((_hash(f"{name}#{i}"), name) for name in names for i in range(vnodes))
+        self._points = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def owner(self, key):
+        index = bisect.bisect(self._points, _hash(str(key)))
+        return self._names[index % len(self._names)]
+
+    def shares(self):
+        """Fraction of the key space each shard owns"""
+        shares = {name: 0 for name in self._names}
+        previous = self._points[-1] - 2 ** 64
+        for point, name in zip(self._points, self._names):
+            shares[name] += (point - previous) / 2 ** 64
+            previous = point
+        return shares
+
+ring = HashRing(SHARDS) if SHARDS else None
+
+def shard_for(device_id):
+    """Shard owning a device (None when sharding is off)"""
+    return ring.owner(device_id) if ring is not None else None
+
+def shard_names():
+    """Every shard, or [None] (the primary database) when sharding is off"""
+    return list(SHARDS) or [None]
+
+def shard_bind(name):
+    return f"shard:{name}"
+
+def binds_config():
+    """SQLALCHEMY_BINDS entries for the configured shards"""
+    from db_health import engine_options
+    return {shard_bind(name): {"url": uri, **engine_options(uri)} for name, uri in SHARDS.items()}
+
+def shard_engine(db, name):
+    return db.engines[shard_bind(name) if name is not None else None]
+
+def group_by_shard(device_ids):
+    """Positions of device_ids grouped by owning shard, in arrival order"""
+    groups = {}
+    for position, device_id in enumerate(device_ids):
+        groups.setdefault(shard_for(device_id), []).append(position)
+    return groups
+
+# Shard selection
+
+_current_shard = ContextVar('healthsense_shard', default=None)
+
+@contextmanager
+def on_shard(name):
+    """Send the session's queries to one shard inside the block"""
+    token = _current_shard.set(name)
+    try:
+        yield
+    finally:
+        _current_shard.reset(token)
+
+def current_shard():
+    return _current_shard.get()
+
+def _is_global(mapper, clause):
+    table = None
+    if mapper is not None:
+        table = sa.inspect(mapper).local_table
+    elif isinstance(clause, sa.Table):
+        table = clause
+    elif isinstance(clause, sa.sql.dml.UpdateBase) and isinstance(clause.table, sa.Table):
+        table = clause.table
+    return table is not None and table.name in GLOBAL_TABLES
+
+class ShardedSession(RoutingSession):
+    """Session that sends queries to the shard selected with on_shard()"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        shard = _current_shard.get()
+        if shard is None or bind is not None or _is_global(mapper, clause):
+            return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        return self._db.engines[shard_bind(shard)]
+
+# Scatter-gather
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=SHARD_WORKERS, thread_name_prefix='healthsense-shard')
+        return _pool
+
+def scatter(fn, shards=None):
+    """Run fn() on each shard and return [(shard, result)] in shard order
+
+    With several shards the calls run in parallel, each in its own app
+    context and session, so fn must return plain data rather than ORM
+    objects. A single shard runs in the calling thread and session.
+
+    The worker threads have no request context, so replica routing
+    (replicas.py) does not apply to them. It would not route shard queries
+    anyway: the replica only mirrors the primary, and on_shard() sends
+    every device table to the shard's own engine.
+    """
+    names = shard_names() if shards is None else list(shards)
+    if len(names) <= 1:
+        results = []
+        for name in names:
+            with on_shard(name):
+                results.append((name, fn()))
+        return results
+
+    app = current_app._get_current_object()
+
+    def run(name):
+        with app.app_context(), on_shard(name):
+            return fn()
+
+    return list(zip(names, _executor().map(run, names)))
+
+def merge_sorted(results, key, limit=None, reverse=False):
+    """Merge the per-shard result lists of scatter() into one sorted list"""
+    merged = sorted((row for _, rows in results for row in rows), key=key, reverse=reverse)
+    return merged if limit is None else merged[:limit]
+
+def shard_status():
+    """The configured shards and the share of devices each owns"""
+    shares = ring.shares() if ring is not None else {}
+    return [
+        {'name': name, 'url': sa.engine.make_url(uri).render_as_string(hide_password=True),
+         'ring_share': round(shares.get(name, 0), 4)}
+        for name, uri in SHARDS.items()
+    ]
+
+# Rebalancing
+
+def _device_tables():
+    from models import HealthData, Prediction, Alert, ShadowPrediction, DeviceVersion, DeviceBaseline, \
+        HealthDataRollup
+    return (HealthData.__table__, (Prediction.__table__, Alert.__table__, ShadowPrediction.__table__),
+            DeviceVersion.__table__, DeviceBaseline.__table__, HealthDataRollup.__table__)
+
+def stored_devices(engine):
+    """Every device id with rows in a shard"""
+    readings, _, versions, baselines, rollups = _device_tables()
+    devices = set()
+    with engine.connect() as conn:
+        for table in (versions, baselines, rollups, readings):
+            devices.update(row[0] for row in conn.execute(sa.select(table.c.device_id).distinct()))
+    return devices
+
+def _missing_ids(conn, table, rows):
+    ids = [row['id'] for row in rows]
+    existing = set()
+    for start in range(0, len(ids), 500):
+        existing.update(conn.execute(sa.select(table.c.id).where(table.c.id.in_(ids[start:start + 500]))).scalars())
+    return [dict(row) for row in rows if row['id'] not in existing]
+
+def move_devices(source, target, device_ids, batch_size=1000):
+    """Move all rows of some devices from one shard engine to another
+
+    Readings are moved batch by batch with their predictions, alerts and
+    shadow predictions. Each batch is committed on the target, then deleted
+    from the source. Rows the target already has are skipped, so an
+    interrupted move can simply be run again; only a crash between the
+    two commits of the per-device step can fold a rollup in twice. Data
+    versions are bumped so cached responses for the devices go stale.
+    Returns rows moved per table.
+    """
+    readings, children, versions, baselines, rollups = _device_tables()
+    device_ids = list(device_ids)
+    moved = {table.name: 0 for table in (readings, *children, versions, baselines, rollups)}
+
+    for start in range(0, len(device_ids), 500):
+        chunk = device_ids[start:start + 500]
+        while True:
+            with source.connect() as src:
+                rows = src.execute(sa.select(readings).where(readings.c.device_id.in_(chunk))
+                                   .order_by(readings.c.id).limit(batch_size)).mappings().all()
+                if not rows:
+                    break
+                ids = [row['id'] for row in rows]
+                related = [(table, src.execute(sa.select(table).where(table.c.health_data_id.in_(ids))).mappings().all())
+                           for table in children]
+            with target.begin() as dst:
+                for table, table_rows in ((readings, rows), *related):
+                    new_rows = _missing_ids(dst, table, table_rows)
+                    if new_rows:
+                        dst.execute(table.insert(), new_rows)
+                    moved[table.name] += len(table_rows)
+            with source.begin() as src:
+                for table in children:
+                    src.execute(table.delete().where(table.c.health_data_id.in_(ids)))
+                src.execute(readings.delete().where(readings.c.id.in_(ids)))
+
+        # Per-device rows: rollups are folded into the target's, the baseline
+        # with more readings wins, and the data version moves past both
+        now = datetime.utcnow().isoformat()
+        with source.connect() as src:
+            source_rows = {table: src.execute(sa.select(table).where(table.c.device_id.in_(chunk))).mappings().all()
+                           for table in (versions, baselines, rollups)}
+        with target.begin() as dst:
+            for row in source_rows[rollups]:
+                existing = dst.execute(sa.select(rollups).where(rollups.c.device_id == row['device_id'],
+                                                                rollups.c.bucket_start == row['bucket_start'])
+                                       ).mappings().first()
+                if existing is None:
+                    dst.execute(rollups.insert(), [{k: v for k, v in row.items() if k != 'id'}])
+                else:
+                    dst.execute(rollups.update().where(rollups.c.id == existing['id']).values(**_fold_rollup(existing, row)))
+            for row in source_rows[baselines]:
+                existing = dst.execute(sa.select(baselines.c.count).where(baselines.c.device_id == row['device_id'])
+                                       ).scalar()
+                if existing is None:
+                    dst.execute(baselines.insert(), [dict(row)])
+                elif existing < row['count']:
+                    dst.execute(baselines.update().where(baselines.c.device_id == row['device_id'])
+                                .values(count=row['count'], state=row['state'], updated_at=row['updated_at']))
+            for row in source_rows[versions]:
+                existing = dst.execute(sa.select(versions.c.version).where(versions.c.device_id == row['device_id'])
+                                       ).scalar()
+                if existing is None:
+                    dst.execute(versions.insert(), [{**row, 'version': row['version'] + 1, 'updated_at': now}])
+                else:
+                    dst.execute(versions.update().where(versions.c.device_id == row['device_id'])
+                                .values(version=max(existing, row['version']) + 1, updated_at=now))
+        with source.begin() as src:
+            for table in (versions, baselines, rollups):
+                src.execute(table.delete().where(table.c.device_id.in_(chunk)))
+                moved[table.name] += len(source_rows[table])
+    return moved
+
+def _fold_rollup(existing, row):
+    from models import VITAL_FIELDS
+    values = {'count': existing['count'] + row['count']}
+    for field in VITAL_FIELDS:
+        values[f'{field}_sum'] = existing[f'{field}_sum'] + row[f'{field}_sum']
+        for suffix, pick in (('min', min), ('max', max)):
+            candidates = [v for v in (existing[f'{field}_{suffix}'], row[f'{field}_{suffix}']) if v is not None]
+            values[f'{field}_{suffix}'] = pick(candidates) if candidates else None
+    return values
+
+def plan_rebalance(sources):
+    """Devices stored outside their owning shard, as {(source, target): [device ids]}"""
+    moves = {}
+    for name, engine in sources.items():
+        for device_id in sorted(stored_devices(engine)):
+            owner = shard_for(device_id)
+            if owner != name:
+                moves.setdefault((name, owner), []).append(device_id)
+    return moves
+
+def rebalance(drain=None, dry_run=False, batch_size=1000):
+    """Move every device to the shard that owns it now; returns the moves made
+
+    drain maps names to URIs of shards no longer in HEALTHSENSE_SHARDS whose
+    devices must be moved out as well.
+    """
+    from app import app, db
+    from db_health import engine_options
+
+    if not SHARDS:
+        raise RuntimeError("HEALTHSENSE_SHARDS is not set")
+    report = []
+    with app.app_context():
+        sources = {name: shard_engine(db, name) for name in SHARDS}
+        drained = {}
+        for name, uri in (drain or {}).items():
+            if name in SHARDS:
+                raise ValueError(f"Shard {name} is still configured; remove it from HEALTHSENSE_SHARDS to drain it")
+            drained[name] = sources[name] = sa.create_engine(uri, **engine_options(uri))
+        try:
+            for (source, target), device_ids in plan_rebalance(sources).items():
+                entry = {'from': source, 'to': target, 'devices': len(device_ids)}
+                if not dry_run:
+                    logger.info(f"Moving {len(device_ids)} devices from {source} to {target}")
+                    entry['rows'] = move_devices(sources[source], sources[target], device_ids, batch_size)
+                report.append(entry)
+        finally:
+            for engine in drained.values():
+                engine.dispose()
+    return report
+
+def status():
+    """Devices and readings stored per shard, and devices stored on the wrong one"""
+    from sqlalchemy import func
+    from app import app, db
+    from models import HealthData
+
+    shards = shard_status()
+    with app.app_context():
+        for entry in shards:
+            engine = shard_engine(db, entry['name'])
+            devices = stored_devices(engine)
+            with engine.connect() as conn:
+                entry['readings'] = conn.execute(sa.select(func.count()).select_from(HealthData.__table__)).scalar()
+            entry['devices'] = len(devices)
+            entry['misplaced_devices'] = sum(1 for device_id in devices if shard_for(device_id) != entry['name'])
+    return shards
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='HealthSense device shards')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('status', help='Show devices and readings per shard')
+    locate = subparsers.add_parser('locate', help='Show the shard owning a device')
+    locate.add_argument('device_id')
+    move = subparsers.add_parser('rebalance', help='Move devices to the shards that own them')
+    move.add_argument('--dry-run', action='store_true', help='Only count the devices to move')
+    move.add_argument('--drain', action='append', default=[], metavar='NAME=URI',
+                      help='Also empty a shard removed from HEALTHSENSE_SHARDS (repeatable)')
+    move.add_argument('--batch-size', type=int, default=1000, help='Readings per copy/delete transaction')
+    args = parser.parse_args(argv)
+
+    if not SHARDS:
+        parser.error('HEALTHSENSE_SHARDS is not set')
+    if args.command == 'status':
+        print(json.dumps(status(), indent=2))
+    elif args.command == 'locate':
+        print(shard_for(args.device_id))
+    elif args.command == 'rebalance':
+        logging.basicConfig(level=logging.INFO)
+        report = rebalance(parse_shards(','.join(args.drain)), args.dry_run, args.batch_size)
+        for entry in report:
+            rows = f": {entry['rows']}" if 'rows' in entry else ''
+            print(f"{entry['from']} -> {entry['to']}: {entry['devices']} devices{rows}")
+        if not report:
+            print("Every device is on its shard")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,6 +3,21 @@
 // Chart objects
 let glucoseChart, bpChart, spo2Chart, heartRateChart;
 
+// Time window shown on the charts and live readings kept in memory per chart
+// (one hour at 10 Hz); older live readings are covered by the server history
+const CHART_WINDOW_MS = 24 * 60 * 60 * 1000;
+const LIVE_CAPACITY = 36000;
+
+// API timestamps are naive UTC ISO strings; without a zone Date.parse would
+// read them as local time (ward.js appends 'Z' for the same reason)
+function parseApiTime(timestamp) {
+    return Date.parse(/(Z|[+-]\d{2}:?\d{2})$/i.test(timestamp) ? timestamp : timestamp + 'Z');
+}
+
+// Chart data models, one per chart, and whether a redraw is already queued
+const chartModels = [];
+let renderPending = false;
+
 // Chart colors
 const chartColors = {
     glucose: {
@@ -33,6 +48,197 @@ function initializeCharts() {
     initBPChart();
     initSpO2Chart();
     initHeartRateChart();
+    
+    chartModels.push(
+        new ChartModel(glucoseChart, ['glucose']),
+        new ChartModel(bpChart, ['bp_systolic', 'bp_diastolic']),
+        new ChartModel(spo2Chart, ['spo2']),
+        new ChartModel(heartRateChart, ['heart_rate'])
+    );
+}
+
+// Shared x axis: epoch milliseconds shown as clock times
+function timeAxis() {
+    return {
+        type: 'linear',
+        ticks: {
+            maxTicksLimit: 8,
+            callback: value => new Date(value).toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'})
+        },
+        grid: {
+            color: 'rgba(255, 255, 255, 0.1)'
+        }
+    };
+}
+
+// Fixed-capacity ring buffer of timestamps and one or more value series
+class RingBuffer {
+    constructor(capacity, width) {
+        this.capacity = capacity;
+        this.width = width;
+        this.times = new Float64Array(capacity);
+        this.values = new Float64Array(capacity * width);
+        this.start = 0;
+        this.length = 0;
+    }
+    
+    push(time, values) {
+        const index = (this.start + this.length) % this.capacity;
+        this.times[index] = time;
+        for (let i = 0; i < this.width; i++) {
+            this.values[index * this.width + i] = values[i];
+        }
+        if (this.length < this.capacity) {
+            this.length++;
+        } else {
+            this.start = (this.start + 1) % this.capacity;
+        }
+    }
+    
+    // Drop entries older than a timestamp (entries arrive in time order)
+    dropBefore(time) {
+        while (this.length && this.times[this.start] < time) {
+            this.start = (this.start + 1) % this.capacity;
+            this.length--;
+        }
+    }
+    
+    // Copy entries newer than `after` into plain typed arrays
+    slice(after) {
+        let first = 0;
+        while (first < this.length && this.times[(this.start + first) % this.capacity] <= after) {
+            first++;
+        }
+        const count = this.length - first;
+        const times = new Float64Array(count);
+        const series = Array.from({length: this.width}, () => new Float64Array(count));
+        for (let i = 0; i < count; i++) {
+            const index = (this.start + first + i) % this.capacity;
+            times[i] = this.times[index];
+            for (let j = 0; j < this.width; j++) {
+                series[j][i] = this.values[index * this.width + j];
+            }
+        }
+        return {times, series};
+    }
+}
+
+// Server history plus live readings of one chart, decimated when drawn
+class ChartModel {
+    constructor(chart, fields) {
+        this.chart = chart;
+        this.fields = fields;
+        this.history = {times: fields.map(() => new Float64Array(0)), series: fields.map(() => new Float64Array(0))};
+        this.live = new RingBuffer(LIVE_CAPACITY, fields.length);
+        this.dirty = false;
+    }
+    
+    setHistory(columns) {
+        // Downsampled history carries its own timestamps per vital
+        const times = this.fields.map(field => Float64Array.from(
+            columns.timestamps ? columns.timestamps[field] : columns.timestamp, parseApiTime));
+        this.history = {times, series: this.fields.map(field => Float64Array.from(columns[field]))};
+        // Live readings now covered by the history are no longer needed
+        const historyEnd = this.historyEnd();
+        if (historyEnd > -Infinity) {
+            this.live.dropBefore(historyEnd);
+        }
+        this.dirty = true;
+    }
+    
+    historyEnd() {
+        return Math.max(...this.history.times.map(times => times.length ? times[times.length - 1] : -Infinity));
+    }
+    
+    push(time, values) {
+        this.live.push(time, values);
+        this.dirty = true;
+    }
+    
+    render() {
+        const history = this.history;
+        const live = this.live.slice(this.historyEnd());
+        const cutoff = Date.now() - CHART_WINDOW_MS;
+        
+        // Decimate to about one point per horizontal pixel
+        const threshold = Math.max(Math.floor(this.chart.width || 300), 3);
+        this.fields.forEach((field, i) => {
+            const times = concatTyped(history.times[i], live.times);
+            const values = concatTyped(history.series[i], live.series[i]);
+            let first = 0;
+            while (first < times.length && times[first] < cutoff) {
+                first++;
+            }
+            this.chart.data.datasets[i].data = lttb(times.subarray(first), values.subarray(first), threshold);
+        });
+        this.chart.update('none');
+        this.dirty = false;
+    }
+}
+
+function concatTyped(a, b) {
+    if (!b.length) return a;
+    if (!a.length) return b;
+    const result = new Float64Array(a.length + b.length);
+    result.set(a);
+    result.set(b, a.length);
+    return result;
+}
+
+// Largest-Triangle-Three-Buckets downsampling to `threshold` {x, y} points
+function lttb(times, values, threshold) {
+    const count = times.length;
+    if (threshold >= count || threshold < 3) {
+        return Array.from(times, (x, i) => ({x, y: values[i]}));
+    }
+    const points = [{x: times[0], y: values[0]}];
+    const bucketSize = (count - 2) / (threshold - 2);
+    let previous = 0;
+    for (let bucket = 0; bucket < threshold - 2; bucket++) {
+        // Average of the next bucket is the third triangle vertex
+        const nextStart = Math.floor((bucket + 1) * bucketSize) + 1;
+        const nextEnd = Math.min(Math.floor((bucket + 2) * bucketSize) + 1, count);
+        let avgX = 0, avgY = 0;
+        for (let i = nextStart; i < nextEnd; i++) {
+            avgX += times[i];
+            avgY += values[i];
+        }
+        const nextCount = Math.max(nextEnd - nextStart, 1);
+        avgX /= nextCount;
+        avgY /= nextCount;
+        
+        // Keep the point of this bucket spanning the largest triangle
+        const start = Math.floor(bucket * bucketSize) + 1;
+        const end = Math.floor((bucket + 1) * bucketSize) + 1;
+        let maxArea = -1, chosen = start;
+        for (let i = start; i < end; i++) {
+            const area = Math.abs((times[previous] - avgX) * (values[i] - values[previous]) -
+                                  (times[previous] - times[i]) * (avgY - values[previous]));
+            if (area > maxArea) {
+                maxArea = area;
+                chosen = i;
+            }
+        }
+        points.push({x: times[chosen], y: values[chosen]});
+        previous = chosen;
+    }
+    points.push({x: times[count - 1], y: values[count - 1]});
+    return points;
+}
+
+// Redraw changed charts once on the next animation frame, however many
+// readings arrived since the last one
+function scheduleRender() {
+    if (renderPending) return;
+    renderPending = true;
+    requestAnimationFrame(() => {
+        renderPending = false;
+        chartModels.forEach(model => {
+            if (model.dirty) {
+                model.render();
+            }
+        });
+    });
 }
 
 // Initialize Glucose Chart
@@ -41,7 +247,6 @@ function initGlucoseChart() {
     glucoseChart = new Chart(ctx, {
         type: 'line',
         data: {
-            labels: [],
             datasets: [{
                 label: 'Glucose (mg/dL)',
                 data: [],
@@ -49,12 +254,17 @@ function initGlucoseChart() {
                 backgroundColor: chartColors.glucose.backgroundColor,
                 borderWidth: 2,
                 tension: 0.1,
+                pointRadius: 0,
                 fill: true
             }]
         },
         options: {
             responsive: true,
             maintainAspectRatio: false,
+            // Points are pre-decimated {x, y} objects, redrawn at most once per frame
+            animation: false,
+            parsing: false,
+            normalized: true,
             scales: {
                 y: {
                     beginAtZero: false,
@@ -64,11 +274,7 @@ function initGlucoseChart() {
                         color: 'rgba(255, 255, 255, 0.1)'
                     }
                 },
-                x: {
-                    grid: {
-                        color: 'rgba(255, 255, 255, 0.1)'
-                    }
-                }
+                x: timeAxis()
             },
             plugins: {
                 legend: {
@@ -116,7 +322,6 @@ function initBPChart() {
     bpChart = new Chart(ctx, {
         type: 'line',
         data: {
-            labels: [],
             datasets: [
                 {
                     label: 'Systolic (mmHg)',
@@ -125,6 +330,7 @@ function initBPChart() {
                     backgroundColor: chartColors.bpSystolic.backgroundColor,
                     borderWidth: 2,
                     tension: 0.1,
+                    pointRadius: 0,
                     fill: true
                 },
                 {
@@ -134,6 +340,7 @@ function initBPChart() {
                     backgroundColor: chartColors.bpDiastolic.backgroundColor,
                     borderWidth: 2,
                     tension: 0.1,
+                    pointRadius: 0,
                     fill: true
                 }
             ]
@@ -141,6 +348,10 @@ function initBPChart() {
         options: {
             responsive: true,
             maintainAspectRatio: false,
+            // Points are pre-decimated {x, y} objects, redrawn at most once per frame
+            animation: false,
+            parsing: false,
+            normalized: true,
             scales: {
                 y: {
                     beginAtZero: false,
@@ -150,11 +361,7 @@ function initBPChart() {
                         color: 'rgba(255, 255, 255, 0.1)'
                     }
                 },
-                x: {
-                    grid: {
-                        color: 'rgba(255, 255, 255, 0.1)'
-                    }
-                }
+                x: timeAxis()
             },
             plugins: {
                 legend: {
@@ -172,7 +379,6 @@ function initSpO2Chart() {
     spo2Chart = new Chart(ctx, {
         type: 'line',
         data: {
-            labels: [],
             datasets: [{
                 label: 'SpO₂ (%)',
                 data: [],
@@ -180,12 +386,17 @@ function initSpO2Chart() {
                 backgroundColor: chartColors.spo2.backgroundColor,
                 borderWidth: 2,
                 tension: 0.1,
+                pointRadius: 0,
                 fill: true
             }]
         },
         options: {
             responsive: true,
             maintainAspectRatio: false,
+            // Points are pre-decimated {x, y} objects, redrawn at most once per frame
+            animation: false,
+            parsing: false,
+            normalized: true,
             scales: {
                 y: {
                     beginAtZero: false,
@@ -195,11 +406,7 @@ function initSpO2Chart() {
                         color: 'rgba(255, 255, 255, 0.1)'
                     }
                 },
-                x: {
-                    grid: {
-                        color: 'rgba(255, 255, 255, 0.1)'
-                    }
-                }
+                x: timeAxis()
             },
             plugins: {
                 legend: {
@@ -234,7 +441,6 @@ function initHeartRateChart() {
     heartRateChart = new Chart(ctx, {
         type: 'line',
         data: {
-            labels: [],
             datasets: [{
                 label: 'Heart Rate (BPM)',
                 data: [],
@@ -242,12 +448,17 @@ function initHeartRateChart() {
                 backgroundColor: chartColors.heartRate.backgroundColor,
                 borderWidth: 2,
                 tension: 0.1,
+                pointRadius: 0,
                 fill: true
             }]
         },
         options: {
             responsive: true,
             maintainAspectRatio: false,
+            // Points are pre-decimated {x, y} objects, redrawn at most once per frame
+            animation: false,
+            parsing: false,
+            normalized: true,
             scales: {
                 y: {
                     beginAtZero: false,
@@ -257,11 +468,7 @@ function initHeartRateChart() {
                         color: 'rgba(255, 255, 255, 0.1)'
                     }
                 },
-                x: {
-                    grid: {
-                        color: 'rgba(255, 255, 255, 0.1)'
-                    }
-                }
+                x: timeAxis()
             },
             plugins: {
                 legend: {
@@ -303,94 +510,35 @@ function initHeartRateChart() {
     });
 }
 
-// Update charts with new data point
+// Add a new reading to the charts
 function updateCharts(healthData) {
-    // Format timestamp
-    const timestamp = new Date(healthData.timestamp);
-    const timeLabel = timestamp.toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'});
-    
-    // Add data to glucose chart
-    addDataPoint(glucoseChart, timeLabel, healthData.glucose);
-    
-    // Add data to BP chart
-    addBPDataPoint(bpChart, timeLabel, healthData.bp_systolic, healthData.bp_diastolic);
-    
-    // Add data to SpO2 chart
-    addDataPoint(spo2Chart, timeLabel, healthData.spo2);
-    
-    // Add data to heart rate chart
-    addDataPoint(heartRateChart, timeLabel, healthData.heart_rate);
-}
-
-// Update historical charts with multiple data points
-function updateHistoricalCharts(historyData) {
-    if (!historyData || historyData.length === 0) return;
-    
-    // Sort data by timestamp
-    historyData.sort((a, b) => new Date(a.timestamp) - new Date(b.timestamp));
-    
-    // Clear existing data
-    clearChartData(glucoseChart);
-    clearChartData(bpChart);
-    clearChartData(spo2Chart);
-    clearChartData(heartRateChart);
-    
-    // Add each data point
-    historyData.forEach(data => {
-        const timestamp = new Date(data.timestamp);
-        const timeLabel = timestamp.toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'});
-        
-        addDataPoint(glucoseChart, timeLabel, data.glucose, false);
-        addBPDataPoint(bpChart, timeLabel, data.bp_systolic, data.bp_diastolic, false);
-        addDataPoint(spo2Chart, timeLabel, data.spo2, false);
-        addDataPoint(heartRateChart, timeLabel, data.heart_rate, false);
+    const time = parseApiTime(healthData.timestamp);
+    chartModels.forEach(model => {
+        model.push(time, model.fields.map(field => healthData[field]));
     });
-    
-    // Update all charts
-    glucoseChart.update();
-    bpChart.update();
-    spo2Chart.update();
-    heartRateChart.update();
+    scheduleRender();
 }
 
-// Function to add a data point to a chart
-function addDataPoint(chart, label, value, update = true) {
-    chart.data.labels.push(label);
-    chart.data.datasets[0].data.push(value);
-    
-    // Limit data points to keep chart readable
-    if (chart.data.labels.length > 20) {
-        chart.data.labels.shift();
-        chart.data.datasets[0].data.shift();
-    }
-    
-    if (update) {
-        chart.update();
-    }
-}
-
-// Function to add BP data points (systolic and diastolic)
-function addBPDataPoint(chart, label, systolic, diastolic, update = true) {
-    chart.data.labels.push(label);
-    chart.data.datasets[0].data.push(systolic);
-    chart.data.datasets[1].data.push(diastolic);
+// Replace the charts' history with readings from /api/history.
+// Accepts either a list of reading objects or the columnar history format
+// (parallel arrays: {timestamp: [...], glucose: [...], ...}), which may be
+// downsampled by the server ({timestamps: {glucose: [...], ...}, glucose: [...], ...}).
+function updateHistoricalCharts(historyData) {
+    if (!historyData) return;
     
-    // Limit data points to keep chart readable
-    if (chart.data.labels.length > 20) {
-        chart.data.labels.shift();
-        chart.data.datasets[0].data.shift();
-        chart.data.datasets[1].data.shift();
-    }
+    const columns = Array.isArray(historyData) ? rowsToColumns(historyData) : historyData;
+    if (!columns.timestamp && !columns.timestamps) return;
     
-    if (update) {
-        chart.update();
-    }
+    chartModels.forEach(model => model.setHistory(columns));
+    scheduleRender();
 }
 
-// Function to clear all data from a chart
-function clearChartData(chart) {
-    chart.data.labels = [];
-    chart.data.datasets.forEach(dataset => {
-        dataset.data = [];
+// Convert a list of reading objects to sorted parallel arrays
+function rowsToColumns(rows) {
+    const sorted = rows.slice().sort((a, b) => parseApiTime(a.timestamp) - parseApiTime(b.timestamp));
+    const columns = {};
+    ['timestamp', 'glucose', 'bp_systolic', 'bp_diastolic', 'spo2', 'heart_rate'].forEach(key => {
+        columns[key] = sorted.map(row => row[key]);
     });
+    return columns;
 }
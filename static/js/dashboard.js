@@ -15,8 +15,9 @@ document.addEventListener('DOMContentLoaded', function() {
     const heartDiseaseRisk = document.getElementById('heart-disease-risk');
     const hypoxiaRisk = document.getElementById('hypoxia-risk');
     
-    // Alerts container
+    // Alerts container and the alert elements currently shown, by alert id
     const alertsContainer = document.getElementById('alerts-container');
+    const alertElements = new Map();
     
     // Initialize charts
     initializeCharts();
@@ -28,22 +29,33 @@ document.addEventListener('DOMContentLoaded', function() {
     
     // Set up refresh intervals
     setInterval(fetchHistoricalData, 60000); // Update historical data every minute
-    setInterval(fetchAlerts, 30000); // Update alerts every 30 seconds
+    
+    // Readings and alert events are only sent to sockets in the dashboard room
+    socket.on('connect', function() {
+        socket.emit('dashboard_subscribe');
+    });
     
     // Socket event for real-time data
     socket.on('new_health_data', function(data) {
         console.log('Received real-time data:', data);
         updateDashboardWithData(data.health_data, data.prediction);
         updateCharts(data.health_data);
-        
-        // Check for new alerts
-        if (data.alerts && data.alerts.length > 0) {
-            data.alerts.forEach(alert => {
-                addAlert(alert);
-            });
-        }
     });
     
+    // Alert lifecycle events pushed by the server
+    socket.on('alert_created', function(alert) {
+        addAlert(alert);
+    });
+    socket.on('alert_escalated', function(alert) {
+        addAlert(alert, true);
+    });
+    socket.on('alert_acknowledged', function(data) {
+        data.ids.forEach(removeAlert);
+    });
+    
+    // Events may have been missed while disconnected, so resync on reconnect
+    socket.io.on('reconnect', fetchAlerts);
+    
     // Function to fetch latest health data
     function fetchLatestData() {
         fetch('/api/latest')
@@ -72,7 +84,9 @@ document.addEventListener('DOMContentLoaded', function() {
     
     // Function to fetch historical data
     function fetchHistoricalData() {
-        fetch('/api/history?hours=24&limit=100')
+        // Let the server downsample to about two points per horizontal pixel
+        const points = Math.ceil((glucoseChart.width || 600) * 2);
+        fetch(`/api/history?hours=24&format=columnar&points=${points}`, {cache: 'no-cache'})
             .then(response => response.json())
             .then(data => {
                 if (data.status === 'success') {
@@ -84,22 +98,21 @@ document.addEventListener('DOMContentLoaded', function() {
             });
     }
     
-    // Function to fetch active alerts
+    // Function to fetch active alerts and reconcile them with those shown
     function fetchAlerts() {
-        fetch('/api/alerts?acknowledged=false')
+        fetch('/api/alerts?acknowledged=false', {cache: 'no-cache'})
             .then(response => response.json())
             .then(data => {
                 if (data.status === 'success') {
-                    // Clear current alerts
-                    alertsContainer.innerHTML = '';
+                    const activeIds = new Set(data.alerts.map(alert => alert.id));
                     
-                    // Add each alert
+                    // Drop alerts acknowledged elsewhere, add new ones
+                    Array.from(alertElements.keys())
+                        .filter(id => !activeIds.has(id))
+                        .forEach(removeAlert);
                     data.alerts.forEach(alert => {
                         addAlert(alert);
                     });
-                    
-                    // Update alert count
-                    updateAlertCount(data.alerts.length);
                 }
             })
             .catch(error => {
@@ -116,7 +129,7 @@ document.addEventListener('DOMContentLoaded', function() {
         heartRateValue.textContent = healthData.heart_rate;
         
         // Update time
-        const timestamp = new Date(healthData.timestamp);
+        const timestamp = new Date(parseApiTime(healthData.timestamp));
         lastUpdateTime.textContent = timestamp.toLocaleTimeString();
         
         // Set classes based on values (for color-coding)
@@ -185,8 +198,10 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
-    // Function to add an alert to the dashboard
-    function addAlert(alert) {
+    // Function to add an alert to the dashboard (once per alert id)
+    function addAlert(alert, escalated = false) {
+        if (alertElements.has(alert.id)) return;
+        
         const alertElem = document.createElement('div');
         alertElem.className = `alert alert-dismissible fade show`;
         
@@ -200,7 +215,7 @@ document.addEventListener('DOMContentLoaded', function() {
         }
         
         // Format time
-        const timestamp = new Date(alert.timestamp);
+        const timestamp = new Date(parseApiTime(alert.timestamp));
         const timeStr = timestamp.toLocaleTimeString();
         
         // Create alert content
@@ -208,6 +223,7 @@ document.addEventListener('DOMContentLoaded', function() {
             <div class="d-flex justify-content-between align-items-center">
                 <div>
                     <strong>${timeStr}</strong>: ${alert.message}
+                    ${escalated ? '<span class="badge bg-danger ms-2">Escalated</span>' : ''}
                 </div>
                 <div>
                     <button type="button" class="btn-close" data-bs-dismiss="alert" aria-label="Close" 
@@ -216,13 +232,27 @@ document.addEventListener('DOMContentLoaded', function() {
             </div>
         `;
         
-        // Add to container
-        alertsContainer.appendChild(alertElem);
+        // Add to container, newest first
+        alertsContainer.prepend(alertElem);
+        alertElements.set(alert.id, alertElem);
+        alertElem.addEventListener('closed.bs.alert', () => {
+            alertElements.delete(alert.id);
+            updateAlertCount();
+        });
         
         // Update count
         updateAlertCount();
     }
     
+    // Function to remove an alert from the dashboard
+    function removeAlert(alertId) {
+        const alertElem = alertElements.get(alertId);
+        if (!alertElem) return;
+        alertElem.remove();
+        alertElements.delete(alertId);
+        updateAlertCount();
+    }
+    
     // Function to update alert count
     function updateAlertCount(count = null) {
         const alertCount = document.getElementById('alert-count');
@@ -0,0 +1,193 @@
+// HealthSense Ward Wall JS
+//
+// One tile per device. Only tiles on screen are subscribed over the socket,
+// so the server sends frames (at most one per device per interval) just for
+// what is visible. Sparklines are loaded from /api/rollups the first time a
+// tile scrolls into view.
+
+const SPARKLINE_HOURS = 6;
+const SPARKLINE_BUCKET_SECONDS = 600;
+const SPARKLINE_REFRESH_MS = 5 * 60 * 1000;
+const DEVICE_LIST_REFRESH_MS = 60 * 1000;
+
+document.addEventListener('DOMContentLoaded', function() {
+    const socket = io();
+
+    const grid = document.getElementById('ward-grid');
+    const tileTemplate = document.getElementById('ward-tile-template');
+    const deviceCount = document.getElementById('ward-device-count');
+    const watchingCount = document.getElementById('ward-watching-count');
+
+    // Tiles by device id, the ids currently on screen and when each sparkline was loaded
+    const tiles = new Map();
+    const visible = new Set();
+    const sparklineLoadedAt = new Map();
+
+    // Frames received since the last paint, applied together in one animation frame
+    const pendingFrames = new Map();
+    let paintScheduled = false;
+    let subscribeTimer = null;
+
+    const observer = new IntersectionObserver(function(entries) {
+        entries.forEach(entry => {
+            const deviceId = entry.target.dataset.deviceId;
+            if (entry.isIntersecting) {
+                visible.add(deviceId);
+                if (!sparklineLoadedAt.has(deviceId)) {
+                    loadSparkline(deviceId);
+                }
+            } else {
+                visible.delete(deviceId);
+            }
+        });
+        scheduleSubscribe();
+    }, {rootMargin: '200px 0px'});
+
+    // Subscribe again after (re)connecting: the server forgets a closed socket's rooms
+    socket.on('connect', sendSubscriptions);
+
+    socket.on('ward_frame', function(frame) {
+        pendingFrames.set(frame.d, frame);
+        if (!paintScheduled) {
+            paintScheduled = true;
+            requestAnimationFrame(paintFrames);
+        }
+    });
+
+    socket.on('alert_acknowledged', function(data) {
+        const tile = tiles.get(data.device_id);
+        if (tile) {
+            tile.classList.remove('alert-low', 'alert-medium', 'alert-high');
+        }
+    });
+
+    loadDevices();
+    setInterval(loadDevices, DEVICE_LIST_REFRESH_MS);
+    setInterval(refreshSparklines, SPARKLINE_REFRESH_MS / 5);
+
+    // Scrolling fires many intersection changes; send one subscription update after it settles
+    function scheduleSubscribe() {
+        clearTimeout(subscribeTimer);
+        subscribeTimer = setTimeout(sendSubscriptions, 250);
+    }
+
+    function sendSubscriptions() {
+        watchingCount.textContent = visible.size;
+        if (socket.connected) {
+            socket.emit('ward_subscribe', {devices: Array.from(visible)});
+        }
+    }
+
+    // Page through the device list and add a tile for every device not shown yet
+    function loadDevices(cursor) {
+        const url = cursor ? `/api/devices?cursor=${encodeURIComponent(cursor)}` : '/api/devices';
+        fetch(url)
+            .then(response => response.json())
+            .then(data => {
+                if (data.status !== 'success') {
+                    throw new Error(data.message);
+                }
+                data.devices.forEach(device => {
+                    if (!tiles.has(device.device_id)) {
+                        addTile(device.device_id);
+                    }
+                });
+                deviceCount.textContent = tiles.size;
+                if (data.next_cursor) {
+                    loadDevices(data.next_cursor);
+                }
+            })
+            .catch(error => {
+                console.error('Error loading devices:', error);
+            });
+    }
+
+    function addTile(deviceId) {
+        const tile = tileTemplate.content.firstElementChild.cloneNode(true);
+        tile.dataset.deviceId = deviceId;
+        tile.querySelector('.ward-device').textContent = deviceId;
+        grid.appendChild(tile);
+        tiles.set(deviceId, tile);
+        observer.observe(tile);
+    }
+
+    function paintFrames() {
+        paintScheduled = false;
+        pendingFrames.forEach(updateTile);
+        pendingFrames.clear();
+    }
+
+    function updateTile(frame) {
+        const tile = tiles.get(frame.d);
+        if (!tile) {
+            return;
+        }
+        const [glucose, systolic, diastolic, spo2, heartRate] = frame.v;
+        tile.querySelector('.ward-glucose').textContent = glucose;
+        tile.querySelector('.ward-bp').textContent = `${systolic}/${diastolic}`;
+        tile.querySelector('.ward-spo2').textContent = spo2;
+        tile.querySelector('.ward-heart-rate').textContent = heartRate;
+        tile.querySelector('.ward-time').textContent = new Date(frame.t + 'Z').toLocaleTimeString();
+        if (frame.r) {
+            tile.querySelector('.ward-risk').textContent = `Heart risk ${Math.round(frame.r[1] * 100)}%`;
+        }
+        if (frame.a) {
+            tile.classList.remove('alert-low', 'alert-medium', 'alert-high');
+            tile.classList.add(`alert-${frame.a}`);
+        }
+    }
+
+    function refreshSparklines() {
+        const now = Date.now();
+        visible.forEach(deviceId => {
+            if (now - (sparklineLoadedAt.get(deviceId) || 0) >= SPARKLINE_REFRESH_MS) {
+                loadSparkline(deviceId);
+            }
+        });
+    }
+
+    function loadSparkline(deviceId) {
+        sparklineLoadedAt.set(deviceId, Date.now());
+        const params = new URLSearchParams({
+            device_id: deviceId,
+            hours: SPARKLINE_HOURS,
+            bucket: SPARKLINE_BUCKET_SECONDS
+        });
+        fetch(`/api/rollups?${params}`, {cache: 'no-cache'})
+            .then(response => response.json())
+            .then(data => {
+                if (data.status === 'success' && data.rollups.heart_rate) {
+                    drawSparkline(tiles.get(deviceId).querySelector('.ward-sparkline'), data.rollups.heart_rate.mean);
+                }
+            })
+            .catch(error => {
+                console.error(`Error loading sparkline for ${deviceId}:`, error);
+            });
+    }
+
+    function drawSparkline(canvas, values) {
+        const ratio = window.devicePixelRatio || 1;
+        canvas.width = canvas.clientWidth * ratio;
+        canvas.height = canvas.clientHeight * ratio;
+        const context = canvas.getContext('2d');
+        context.clearRect(0, 0, canvas.width, canvas.height);
+        if (values.length < 2) {
+            return;
+        }
+        const min = Math.min(...values);
+        const range = (Math.max(...values) - min) || 1;
+        const step = canvas.width / (values.length - 1);
+        context.strokeStyle = '#e74c3c';
+        context.lineWidth = ratio;
+        context.beginPath();
+        values.forEach((value, i) => {
+            const y = canvas.height - ((value - min) / range) * (canvas.height - 2 * ratio) - ratio;
+            if (i === 0) {
+                context.moveTo(0, y);
+            } else {
+                context.lineTo(i * step, y);
+            }
+        });
+        context.stroke();
+    }
+});
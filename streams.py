@@ -0,0 +1,210 @@
+"""Per-device event streams for SSE and long-poll clients, with backpressure
+
+Each watched device has a stream holding its last HEALTHSENSE_STREAM_REPLAY
+events in a ring buffer: `reading` plus the alert lifecycle events. Each
+event is serialized once and shared by every subscriber. A subscriber is
+only a cursor, the id of the last event it received. It owns no queue, so a
+slow client costs the same memory as a fast one:
+
+- A client that reconnects with `Last-Event-ID` gets the events it missed
+  from the buffer.
+- A client that has fallen further behind than the buffer, or has more than
+  HEALTHSENSE_STREAM_MAX_BATCH events pending, is coalesced to the latest
+  state. It gets a `lagged` event, every pending alert event and the newest
+  `reading`. Intermediate readings are skipped.
+
+Event ids are "<process epoch>-<sequence>". An id from another process, or
+from before a restart, counts as lagged. Streams are created by the first
+subscriber. At most HEALTHSENSE_STREAM_MAX_DEVICES are kept, and the least
+recently used stream without subscribers is dropped first.
+
+Socket.IO clients get the same policy. State events (`new_health_data`,
+`ward_frame`) skip a socket while its engine.io send queue holds more than
+HEALTHSENSE_SOCKET_MAX_BACKLOG packets. The next event carries the latest
+state anyway.
+
+Socket.IO events go to rooms, never to every socket. Dashboards join
+DASHBOARD_ROOM and get every reading and alert event. Ward walls join the
+device_room() of each tile on screen and get only those devices' frames
+and acknowledgments.
+"""
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+# Events kept per device for Last-Event-ID resume
+STREAM_REPLAY = int(os.environ.get("HEALTHSENSE_STREAM_REPLAY", 256))
+# Pending events above which a subscriber is coalesced to the latest state
+STREAM_MAX_BATCH = int(os.environ.get("HEALTHSENSE_STREAM_MAX_BATCH", 64))
+# Devices with a stream in this process
+STREAM_MAX_DEVICES = int(os.environ.get("HEALTHSENSE_STREAM_MAX_DEVICES", 2000))
+# Seconds between SSE keep-alive comments, and the longest long-poll wait
+STREAM_HEARTBEAT = float(os.environ.get("HEALTHSENSE_STREAM_HEARTBEAT", 15))
+# Queued engine.io packets above which a socket skips state events
+SOCKET_MAX_BACKLOG = int(os.environ.get("HEALTHSENSE_SOCKET_MAX_BACKLOG", 100))
+
+EPOCH = uuid.uuid4().hex[:8]
+DASHBOARD_ROOM = 'dashboard'
+STATE_EVENT = 'reading'
+
+_sequence = itertools.count(1)
+
+def format_event_id(seq):
+    return f"{EPOCH}-{seq}"
+
+def parse_event_id(value):
+    """Sequence number of an event id from this process, or None"""
+    epoch, _, seq = (value or '').partition('-')
+    if epoch != EPOCH or not seq.isdigit():
+        return None
+    return int(seq)
+
+class DeviceStream:
+    """Bounded replay buffer of one device's events"""
+
+    def __init__(self, device_id, capacity=None):
+        self.device_id = device_id
+        self.events = deque(maxlen=capacity or STREAM_REPLAY)
+        self.subscribers = 0
+        self.changed = threading.Condition()
+        # Highest sequence no longer in the buffer: cursors below it missed events
+        self.horizon = next(_sequence)
+        self.last_seq = self.horizon
+
+    def publish(self, event, data):
+        payload = json.dumps(data)
+        with self.changed:
+            if len(self.events) == self.events.maxlen:
+                self.horizon = self.events[0][0]
+            self.last_seq = next(_sequence)
+            self.events.append((self.last_seq, event, payload))
+            self.changed.notify_all()
+
+    def read(self, after, timeout):
+        """Events after sequence `after`, waiting up to timeout for one
+
+        Returns (events, cursor, lagged): events as (seq, name, json) tuples
+        and the cursor to pass next time. A None `after` means the client's
+        position is unknown; it gets the latest state.
+        """
+        with self.changed:
+            if after is not None and after >= self.last_seq:
+                self.changed.wait(timeout)
+            cursor = self.last_seq
+            lagged = after is None or after < self.horizon
+            pending = [item for item in self.events if after is None or item[0] > after]
+        if lagged or len(pending) > STREAM_MAX_BATCH:
+            return coalesce(pending), cursor, True
+        return pending, cursor, False
+
+def coalesce(events):
+    """Keep every alert event and only the newest state event, in order"""
+    latest = next((item for item in reversed(events) if item[1] == STATE_EVENT), None)
+    return [item for item in events if item[1] != STATE_EVENT or item is latest]
+
+_streams = OrderedDict()
+_streams_lock = threading.Lock()
+
+def get_stream(device_id):
+    """The device's stream, created (and the oldest idle ones evicted) if needed"""
+    with _streams_lock:
+        stream = _streams.get(device_id)
+        if stream is None:
+            stream = _streams[device_id] = DeviceStream(device_id)
+        _streams.move_to_end(device_id)
+        if len(_streams) > STREAM_MAX_DEVICES:
+            for idle_id in [d for d, s in _streams.items() if not s.subscribers][:len(_streams) - STREAM_MAX_DEVICES]:
+                del _streams[idle_id]
+        return stream
+
+def publish(device_id, event, data):
+    """Add an event to a device's stream if anyone has subscribed to it"""
+    stream = _streams.get(device_id)
+    if stream is not None:
+        stream.publish(event, data)
+
+def _sse_message(seq, event, payload):
+    return f"id: {format_event_id(seq)}\nevent: {event}\ndata: {payload}\n\n"
+
+def sse_events(device_id, last_event_id=None):
+    """Generate a text/event-stream for one device
+
+    Each chunk is produced only after the server has written the previous
+    one, so a slow reader holds just its cursor.
+    """
+    stream = get_stream(device_id)
+    with stream.changed:
+        stream.subscribers += 1
+        after = stream.last_seq if last_event_id is None else parse_event_id(last_event_id)
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            events, cursor, lagged = stream.read(after, STREAM_HEARTBEAT)
+            if lagged:
+                yield f"event: lagged\ndata: {json.dumps({'resumed': after is not None})}\n\n"
+            if not events and not lagged:
+                # Comment line: keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+            for item in events:
+                yield _sse_message(*item)
+            after = cursor
+    finally:
+        with stream.changed:
+            stream.subscribers -= 1
+
+def poll_events(device_id, last_event_id=None, timeout=None):
+    """Long-poll for one device: waits for events after last_event_id
+
+    Without last_event_id the call returns at once with the current cursor.
+    Returns (events as dicts, next event id, lagged).
+    """
+    stream = get_stream(device_id)
+    if last_event_id is None:
+        return [], format_event_id(stream.last_seq), False
+    with stream.changed:
+        stream.subscribers += 1
+    try:
+        timeout = STREAM_HEARTBEAT if timeout is None else min(timeout, STREAM_HEARTBEAT)
+        events, cursor, lagged = stream.read(parse_event_id(last_event_id), timeout)
+    finally:
+        with stream.changed:
+            stream.subscribers -= 1
+    return [
+        {'id': format_event_id(seq), 'event': event, 'data': json.loads(payload)}
+        for seq, event, payload in events
+    ], format_event_id(cursor), lagged
+
+_lagging = ([], 0.0)
+
+def device_room(device_id):
+    """Socket.IO room of the sockets watching one device"""
+    return f'device:{device_id}'
+
+def lagging_sids(socketio, namespace='/'):
+    """Socket.IO sids whose engine.io send queue exceeds SOCKET_MAX_BACKLOG
+
+    Recomputed at most every 100ms, as it visits every connection.
+    """
+    global _lagging
+    sids, computed_at = _lagging
+    now = time.monotonic()
+    if now - computed_at < 0.1:
+        return sids
+    server = socketio.server
+    sids = []
+    for eio_sid, eio_socket in list(server.eio.sockets.items()):
+        if eio_socket.queue.qsize() > SOCKET_MAX_BACKLOG:
+            sid = server.manager.sid_from_eio_sid(eio_sid, namespace)
+            if sid is not None:
+                sids.append(sid)
+    if sids:
+        logger.debug(f"Skipping state events for {len(sids)} lagging sockets")
+    _lagging = (sids, now)
+    return sids
@@ -0,0 +1,61 @@
+"""Test setup: two SQLite device shards, and the primary doubling as its own read replica
+
+Settings are read when the app is imported, so they are set here first.
+"""
+import os
+import sys
+import tempfile
+
+_data_dir = tempfile.mkdtemp(prefix='healthsense-tests-')
+os.environ['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{_data_dir}/primary.db'
+os.environ['HEALTHSENSE_SHARDS'] = f'a=sqlite:///{_data_dir}/a.db,b=sqlite:///{_data_dir}/b.db'
+os.environ['HEALTHSENSE_REPLICA_URI'] = os.environ['SQLALCHEMY_DATABASE_URI']
+os.environ['HEALTHSENSE_COLUMN_STORE_DIR'] = f'{_data_dir}/timeseries'
+os.environ['HEALTHSENSE_ARCHIVE_DIR'] = f'{_data_dir}/archive'
+os.environ['HEALTHSENSE_MODEL_POLL_INTERVAL'] = '0'
+os.environ['HEALTHSENSE_DB_SLOW_QUERY_MS'] = '0'
+for name in ('HEALTHSENSE_PROFILE', 'HEALTHSENSE_SYNC_URL', 'HEALTHSENSE_INFERENCE_URL', 'HEALTHSENSE_SCHEMA_MODE'):
+    os.environ.pop(name, None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+from app import app as flask_app  # noqa: E402
+import views  # noqa: E402,F401  (registers the routes)
+from migrate import upgrade  # noqa: E402
+
+@pytest.fixture(scope='session')
+def app():
+    upgrade(flask_app)
+    return flask_app
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def unsharded(app, monkeypatch):
+    """Sharding switched off, so device tables live in the primary"""
+    import shards
+    monkeypatch.setattr(shards, 'SHARDS', {})
+    monkeypatch.setattr(shards, 'ring', None)
+    upgrade(app)
+    return app
+
+def reading(device_id, **vitals):
+    """A /api/healthdata payload; abnormal vitals unless overridden"""
+    return {'device_id': device_id, 'glucose': 260, 'bp_systolic': 150, 'bp_diastolic': 95,
+            'spo2': 91, 'heart_rate': 105, **vitals}
+
+def devices_on(shard, count, prefix='DEV'):
+    """Device ids owned by a shard"""
+    from shards import shard_for
+    found = []
+    number = 0
+    while len(found) < count:
+        device_id = f'{prefix}{number:04d}'
+        if shard_for(device_id) == shard:
+            found.append(device_id)
+        number += 1
+    return found
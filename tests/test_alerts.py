@@ -0,0 +1,54 @@
+from conftest import devices_on, reading
+
+def _all_pages(client, query, limit):
+    pages, cursor = [], None
+    while True:
+        url = f'/api/alerts?limit={limit}{query}' + (f'&cursor={cursor}' if cursor else '')
+        response = client.get(url)
+        assert response.status_code == 200
+        pages.append([alert['id'] for alert in response.json['alerts']])
+        cursor = response.json['next_cursor']
+        if not cursor:
+            return pages
+
+def _ingest(client, device_ids, count=3):
+    for i in range(count):
+        for device_id in device_ids:
+            response = client.post('/api/healthdata', json=reading(
+                device_id, glucose=250 + i, timestamp=f'2026-03-01T10:00:0{i}'))
+            assert response.status_code == 200
+
+def test_alert_pages_follow_the_cursor_across_shards(client):
+    devices = devices_on('a', 2, prefix='PAGE') + devices_on('b', 2, prefix='PAGE')
+    _ingest(client, devices)
+    everything = client.get('/api/alerts?limit=500').json['alerts']
+    assert {alert['device_id'] for alert in everything} >= set(devices)
+    assert [(a['timestamp'], a['id']) for a in everything] == \
+        sorted(((a['timestamp'], a['id']) for a in everything), reverse=True)
+
+    pages = _all_pages(client, '', limit=3)
+    assert all(len(page) == 3 for page in pages[:-1])
+    assert [alert_id for page in pages for alert_id in page] == [alert['id'] for alert in everything]
+
+def test_alert_pages_for_one_device_and_condition(client):
+    device_id, = devices_on('b', 1, prefix='PAGEONE')
+    _ingest(client, [device_id], count=4)
+    everything = client.get(f'/api/alerts?limit=500&device_id={device_id}').json['alerts']
+    assert everything and {alert['device_id'] for alert in everything} == {device_id}
+
+    pages = _all_pages(client, f'&device_id={device_id}', limit=2)
+    assert [alert_id for page in pages for alert_id in page] == [alert['id'] for alert in everything]
+
+    condition = everything[0]['condition']
+    filtered = [alert['id'] for alert in everything if alert['condition'] == condition]
+    pages = _all_pages(client, f'&device_id={device_id}&condition={condition}', limit=1)
+    assert [alert_id for page in pages for alert_id in page] == filtered
+
+def test_acknowledged_alerts_leave_the_open_pages(client):
+    device_id, = devices_on('a', 1, prefix='PAGEACK')
+    _ingest(client, [device_id], count=2)
+    open_alerts = client.get(f'/api/alerts?limit=500&device_id={device_id}').json['alerts']
+    response = client.post('/api/alerts/acknowledge', json={'ids': [open_alerts[0]['id']]})
+    assert response.json['acknowledged'] == [open_alerts[0]['id']]
+    remaining = [alert_id for page in _all_pages(client, f'&device_id={device_id}', limit=2) for alert_id in page]
+    assert remaining == [alert['id'] for alert in open_alerts[1:]]
@@ -0,0 +1,70 @@
+import importlib
+import json
+
+import pytest
+
+import edge
+from conftest import reading
+from models import SyncOutbox
+
+@pytest.fixture
+def edge_profile(unsharded, monkeypatch):
+    """The edge module as an edge box without HEALTHSENSE_SYNC_URL imports it"""
+    monkeypatch.setenv('HEALTHSENSE_PROFILE', 'edge')
+    monkeypatch.delenv('HEALTHSENSE_SYNC_URL', raising=False)
+    monkeypatch.delenv('HEALTHSENSE_SYNC_OUTBOX', raising=False)
+    importlib.reload(edge)
+    yield unsharded
+    monkeypatch.undo()
+    importlib.reload(edge)
+
+class CentralServer:
+    """Stands in for requests.post to a central server's /api/sync/batch"""
+
+    def __init__(self):
+        self.batches = []
+
+    def post(self, url, data, headers, timeout):
+        assert url == 'http://central.test/api/sync/batch'
+        payload = json.loads(edge.decompress_sync_batch(data))
+        self.batches.append(payload)
+        return self
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {'inserted': {}}
+
+def test_edge_ingest_is_shipped_by_the_sync_command(edge_profile, monkeypatch, capsys):
+    import requests
+    assert edge.SYNC_OUTBOX and not edge.SYNC_URL
+
+    client = edge_profile.test_client()
+    central = CentralServer()
+    monkeypatch.setattr(requests, 'post', central.post)
+    # The first sync also ships readings stored before the outbox was filled
+    assert edge.main(['sync', '--url', 'http://central.test']) == 0
+    central.batches.clear()
+    capsys.readouterr()
+
+    for device_id in ('EDGE1', 'EDGE2'):
+        assert client.post('/api/healthdata', json=reading(device_id)).status_code == 200
+    with edge_profile.app_context():
+        assert SyncOutbox.query.count() >= 2
+
+    assert edge.main(['sync', '--url', 'http://central.test']) == 0
+    assert capsys.readouterr().out.startswith('2 readings synced')
+    shipped = [json.dumps(batch) for batch in central.batches]
+    assert any('EDGE1' in batch for batch in shipped) and any('EDGE2' in batch for batch in shipped)
+    with edge_profile.app_context():
+        assert SyncOutbox.query.count() == 0
+
+    # Nothing new, nothing shipped
+    assert edge.main(['sync', '--url', 'http://central.test']) == 0
+    assert capsys.readouterr().out.startswith('0 readings synced')
+
+def test_sync_command_refuses_to_run_when_ingest_queues_nothing(unsharded, monkeypatch):
+    monkeypatch.setattr(edge, 'SYNC_OUTBOX', False)
+    with pytest.raises(SystemExit):
+        edge.main(['sync', '--url', 'http://central.test'])
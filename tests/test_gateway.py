@@ -0,0 +1,98 @@
+import math
+import socket
+import struct
+
+import pytest
+
+from gateway import ACK, FRAME, MAGIC, GatewayConnection, GatewayServer, decode_frames, encode_frame
+from models import HealthData, frame_id
+from conftest import devices_on
+from shards import on_shard
+
+VITALS = (110.0, 120.0, 80.0, 97.4, 72.0)
+
+def test_decode_frames_round_trip():
+    data = encode_frame('GW1', 7, 1700000000123, VITALS) + encode_frame('GW2', 8, 0, VITALS)
+    readings, rejected = decode_frames(data, now='2026-01-01T00:00:00')
+    assert rejected == 0
+    first, second = readings
+    assert (first.device_id, first.timestamp) == ('GW1', '2023-11-14T22:13:20.123000')
+    assert (first.glucose, first.bp_systolic, first.bp_diastolic, first.spo2, first.heart_rate) == VITALS
+    assert first.id == frame_id('GW1', 7, 1700000000123)
+    # Timestamp 0 means the time of receipt
+    assert second.timestamp == '2026-01-01T00:00:00'
+
+def test_decode_frames_rejects_bad_frames():
+    data = (encode_frame('GW1', 1, 0, (math.nan, *VITALS[1:]))
+            + FRAME.pack(b'', 2, 0, *VITALS)
+            + FRAME.pack(b'SIXTEEN-BYTES-ID', 3, 0, *VITALS)
+            + FRAME.pack(b'GW\xff', 4, 0, *VITALS)
+            + encode_frame('GW1', 5, 0, VITALS))
+    readings, rejected = decode_frames(data)
+    assert rejected == 4
+    assert [r.id for r in readings] == [frame_id('GW1', 5, 0)]
+
+def test_encode_frame_refuses_long_device_ids():
+    with pytest.raises(ValueError):
+        encode_frame('X' * 16, 1, 0, VITALS)
+
+def test_acknowledgment_counts_frames_handled_so_far():
+    server_side, gateway_side = socket.socketpair()
+    try:
+        connection = GatewayConnection(server_side, 'test')
+        connection.acknowledge(3)
+        connection.acknowledge(2)
+        assert ACK.unpack(_recv_exactly(gateway_side, 2 * ACK.size)[ACK.size:]) == (5,)
+    finally:
+        server_side.close()
+        gateway_side.close()
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        assert chunk, 'connection closed'
+        data += chunk
+    return data
+
+def test_gateway_stores_frames_and_skips_resent_ones(app):
+    server = GatewayServer(app, '127.0.0.1', 0, max_wait=0.01)
+    server.start()
+    device_a, = devices_on('a', 1, prefix='GWA')
+    device_b, = devices_on('b', 1, prefix='GWB')
+    frames = b''.join(encode_frame(device_id, seq, 1700000000000 + seq * 1000, VITALS)
+                      for seq in range(3) for device_id in (device_a, device_b))
+    invalid = encode_frame(device_a, 99, 0, (math.inf, *VITALS[1:]))
+    try:
+        with socket.create_connection(('127.0.0.1', server.port), timeout=30) as gateway:
+            gateway.sendall(MAGIC + frames + invalid)
+            handled = 0
+            while handled < 7:
+                handled, = ACK.unpack(_recv_exactly(gateway, ACK.size))
+            assert handled == 7
+
+        # A gateway resends after a reconnect; stored frames are skipped
+        with socket.create_connection(('127.0.0.1', server.port), timeout=30) as gateway:
+            gateway.sendall(MAGIC + frames)
+            handled = 0
+            while handled < 6:
+                handled, = ACK.unpack(_recv_exactly(gateway, ACK.size))
+    finally:
+        server.stop()
+
+    with app.app_context():
+        for shard, device_id in (('a', device_a), ('b', device_b)):
+            with on_shard(shard):
+                stored = HealthData.query.filter_by(device_id=device_id).order_by(HealthData.timestamp).all()
+                assert [r.id for r in stored] == [frame_id(device_id, seq, 1700000000000 + seq * 1000)
+                                                  for seq in range(3)]
+
+def test_gateway_closes_connections_with_an_unknown_header(app):
+    server = GatewayServer(app, '127.0.0.1', 0)
+    server.start()
+    try:
+        with socket.create_connection(('127.0.0.1', server.port), timeout=30) as gateway:
+            gateway.sendall(b'HTTP' + struct.pack('<I', 0))
+            assert gateway.recv(ACK.size) == b''
+    finally:
+        server.stop()
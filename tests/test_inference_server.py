@@ -0,0 +1,52 @@
+import asyncio
+import os
+import signal
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pytest
+
+from inference_server import BatchScorer
+from ml_models import create_mock_models, predict_batch
+from model_manager import ModelSet
+
+FEATURES = np.array([[110.0, 120.0, 80.0, 97.0, 72.0], [250.0, 180.0, 110.0, 88.0, 130.0]])
+
+class FixedManager:
+    def __init__(self, model_set):
+        self.model_set = model_set
+
+    def current(self):
+        return self.model_set
+
+@pytest.fixture(scope='module')
+def model_set():
+    return ModelSet('test-v1', create_mock_models())
+
+def test_scorer_forks_a_new_pool_after_a_worker_dies(model_set):
+    scorer = BatchScorer(FixedManager(model_set), processes=1, max_wait=0)
+
+    async def scenario():
+        runner = asyncio.create_task(scorer.run())
+        try:
+            risks, version = await scorer.score(FEATURES)
+            assert version == 'test-v1'
+            np.testing.assert_allclose(risks, predict_batch(model_set.models, FEATURES))
+
+            broken = scorer.executor
+            for process in list(broken._processes.values()):
+                os.kill(process.pid, signal.SIGKILL)
+            # The batch caught by the dead process fails; clients fall back for it
+            with pytest.raises(BrokenProcessPool):
+                for _ in range(5):
+                    await asyncio.wait_for(scorer.score(FEATURES), 30)
+                    await asyncio.sleep(0.05)
+
+            risks, version = await asyncio.wait_for(scorer.score(FEATURES), 30)
+            assert scorer.executor is not broken
+            np.testing.assert_allclose(risks, predict_batch(model_set.models, FEATURES))
+        finally:
+            runner.cancel()
+            scorer.shutdown()
+
+    asyncio.run(scenario())
@@ -0,0 +1,40 @@
+import pytest
+
+import ingest
+from lanes import IngestLanes, WriteQueue
+
+def test_a_failed_batch_fails_its_submitters_and_the_writer_keeps_going(app, monkeypatch):
+    calls = []
+
+    def process_groups(groups):
+        calls.append(groups)
+        if len(calls) == 1:
+            raise ConnectionError('database went away')
+        return [[(reading, []) for reading in readings] for readings in groups]
+
+    monkeypatch.setattr(ingest, 'process_health_data_groups', process_groups)
+    writer = WriteQueue(app, max_batch=10, max_wait=0, max_pending=10, name='test-writer')
+    writer.start()
+
+    with pytest.raises(ConnectionError):
+        writer.enqueue(['first']).result(timeout=10)
+    assert writer.enqueue(['second', 'third']).result(timeout=10) == [('second', []), ('third', [])]
+    assert writer.is_alive()
+    assert (writer.batches, writer.committed) == (1, 2)
+
+def test_lane_groups_report_a_failed_lane_per_submission(app, monkeypatch):
+    class Reading:
+        def __init__(self, device_id):
+            self.device_id = device_id
+
+    def process_groups(groups):
+        if any(reading.device_id == 'BROKEN' for readings in groups for reading in readings):
+            raise ConnectionError('lane failed')
+        return [[(reading.device_id, []) for reading in readings] for readings in groups]
+
+    monkeypatch.setattr(ingest, 'process_health_data_groups', process_groups)
+    lanes = IngestLanes(app, count=1, max_batch=1, max_wait=0, max_pending=10)
+    lanes.start()
+    failed, stored = lanes.submit_groups([[Reading('BROKEN')], [Reading('FINE')]])
+    assert isinstance(failed, ConnectionError)
+    assert stored == [('FINE', [])]
@@ -0,0 +1,41 @@
+from sqlalchemy import create_engine, inspect, text
+
+from app import db
+from migrate import _keyset_batches, ensure_indexes
+
+def test_upgrade_replaces_indexes_covered_by_wider_ones(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path}/old.db')
+    tables = [db.metadata.tables['health_data'], db.metadata.tables['predictions']]
+    db.metadata.create_all(engine, tables=tables)
+    with engine.begin() as conn:
+        # As left by earlier releases
+        conn.execute(text('DROP INDEX ix_health_data_device_timestamp_vitals'))
+        conn.execute(text('CREATE INDEX ix_health_data_device_timestamp ON health_data (device_id, timestamp)'))
+        conn.execute(text('CREATE INDEX ix_predictions_health_data_id ON predictions (health_data_id)'))
+
+    assert ensure_indexes(engine, db.metadata, tables) == ['ix_health_data_device_timestamp_vitals']
+    inspector = inspect(engine)
+    health_indexes = {index['name'] for index in inspector.get_indexes('health_data')}
+    prediction_indexes = {index['name'] for index in inspector.get_indexes('predictions')}
+    assert 'ix_health_data_device_timestamp_vitals' in health_indexes
+    assert 'ix_health_data_device_timestamp' not in health_indexes
+    assert prediction_indexes == {'ix_predictions_health_data_id_risks'}
+    assert all(index.name not in ('ix_health_data_device_timestamp', 'ix_predictions_health_data_id')
+               for table in tables for index in table.indexes)
+    assert ensure_indexes(engine, db.metadata, tables) == []
+
+def test_keyset_batches_include_rows_without_a_timestamp(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path}/legacy.db')
+    table = db.metadata.tables['health_data']
+    db.metadata.create_all(engine, tables=[table])
+    rows = [{'id': f'id-{i}', 'device_id': 'DEV1', 'glucose': 100, 'bp_systolic': 120, 'bp_diastolic': 80,
+             'spo2': 97, 'heart_rate': 70, 'timestamp': f'2026-01-01T00:00:0{i}' if i % 2 else None}
+            for i in range(7)]
+    with engine.begin() as conn:
+        conn.execute(table.insert(), rows)
+
+    with engine.connect() as conn:
+        batches = list(_keyset_batches(conn, table, batch_size=2))
+    ids = [row['id'] for batch in batches for row in batch]
+    assert ids == ['id-1', 'id-3', 'id-5', 'id-0', 'id-2', 'id-4', 'id-6']
+    assert all(len(batch) <= 2 for batch in batches)
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+import ml_models
+from ml_models import create_mock_models, predict_batch, predict_diabetes, predict_heart_disease, predict_hypoxia
+
+ROWS = [
+    # glucose, bp_systolic, bp_diastolic, spo2, heart_rate
+    (110.4, 121.6, 79.5, 97.4, 72.5),
+    (251.7, 182.2, 118.9, 88.6, 131.3),
+    (65.2, 98.0, 61.4, 93.5, 48.7),
+]
+
+@pytest.fixture(scope='module')
+def models():
+    return create_mock_models()
+
+def _single(models, row):
+    diabetes_model, heart_model, hypoxia_model = models
+    glucose, bp_systolic, bp_diastolic, spo2, heart_rate = row
+    return (predict_diabetes(diabetes_model, glucose),
+            predict_heart_disease(heart_model, bp_systolic, bp_diastolic, heart_rate),
+            predict_hypoxia(hypoxia_model, spo2, heart_rate))
+
+@pytest.mark.parametrize('quantum', [1.0, 0.5, 0.0])
+def test_batch_and_single_reading_scoring_agree(models, monkeypatch, quantum):
+    monkeypatch.setattr(ml_models, 'PREDICTION_QUANTUM', quantum)
+    # Rebuild the caches (and lookup tables) for this quantum
+    for cache in ml_models.prediction_caches.values():
+        monkeypatch.setattr(cache, '_version', None)
+    batch = predict_batch(models, np.array(ROWS))
+    for row, risks in zip(ROWS, batch):
+        assert tuple(risks) == pytest.approx(_single(models, row), rel=1e-9, abs=1e-12)
@@ -0,0 +1,82 @@
+"""Replica routing, with sharding switched off so device tables live in the primary"""
+import pytest
+from sqlalchemy import event
+
+import replicas
+from app import db
+from conftest import reading
+from replicas import REPLICA_BIND, check_replica
+
+@pytest.fixture
+def unsharded(unsharded):
+    with unsharded.app_context():
+        check_replica()
+    return unsharded
+
+@pytest.fixture
+def queries(unsharded):
+    """Statements run on the primary and on the replica since the last reset"""
+    counts = {'primary': 0, 'replica': 0}
+    with unsharded.app_context():
+        engines = {'primary': db.engines[None], 'replica': db.engines[REPLICA_BIND]}
+
+    def counter(name):
+        def count(*args):
+            counts[name] += 1
+        return count
+
+    listeners = [(engine, counter(name)) for name, engine in engines.items()]
+    for engine, listener in listeners:
+        event.listen(engine, 'before_cursor_execute', listener)
+    yield counts
+    for engine, listener in listeners:
+        event.remove(engine, 'before_cursor_execute', listener)
+
+def _reads(client, counts):
+    counts.update(primary=0, replica=0)
+    assert client.get('/api/alerts?device_id=REPLICA1').status_code == 200
+    return dict(counts)
+
+def test_check_replica_measures_lag(unsharded):
+    with unsharded.app_context():
+        status = check_replica()
+    assert status['error'] is None
+    assert 0 <= status['lag'] < replicas.REPLICA_MAX_LAG
+    assert status['synced_at'] is not None
+
+def test_read_only_views_use_the_replica(unsharded, queries):
+    client = unsharded.test_client()
+    counts = _reads(client, queries)
+    assert counts['replica'] > 0 and counts['primary'] == 0
+
+def test_lagging_replica_falls_back_to_the_primary(unsharded, queries, monkeypatch):
+    monkeypatch.setitem(replicas._replica, 'lag', replicas.REPLICA_MAX_LAG + 1)
+    counts = _reads(unsharded.test_client(), queries)
+    assert counts['replica'] == 0 and counts['primary'] > 0
+
+def test_ingest_sets_no_read_your_writes_cookie(unsharded, queries):
+    client = unsharded.test_client()
+    response = client.post('/api/healthdata', json=reading('REPLICA1'))
+    assert response.status_code == 200
+    assert 'Set-Cookie' not in response.headers
+    assert _reads(client, queries)['replica'] > 0
+
+def test_acknowledging_client_reads_its_write_from_the_primary(unsharded, queries, monkeypatch):
+    nurse, other = unsharded.test_client(), unsharded.test_client()
+    assert nurse.post('/api/healthdata', json=reading('REPLICA1')).status_code == 200
+    alert_id = nurse.get('/api/alerts?device_id=REPLICA1').json['alerts'][0]['id']
+    # The replica has not seen anything newer than the last check
+    monkeypatch.setitem(replicas._replica, 'synced_at', 0)
+
+    response = nurse.post(f'/api/alerts/{alert_id}/acknowledge')
+    assert response.status_code == 200
+    assert 'Set-Cookie' in response.headers
+
+    nurse_counts = _reads(nurse, queries)
+    assert nurse_counts['replica'] == 0 and nurse_counts['primary'] > 0
+    assert _reads(other, queries)['replica'] > 0
+
+    # Once the replica's heartbeat passes the write, the nurse is back on it
+    with unsharded.app_context():
+        check_replica()
+    assert _reads(nurse, queries)['replica'] > 0
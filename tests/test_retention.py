@@ -0,0 +1,38 @@
+import os
+
+import numpy as np
+
+from retention import DAY_INDEX, index_archive, read_archive, write_archive
+
+def _columns(device_id, reading_id, timestamp):
+    return {
+        'id': np.array([reading_id]), 'device_id': np.array([device_id]), 'timestamp': np.array([timestamp]),
+        'glucose': np.array([100.0]), 'bp_systolic': np.array([120.0]), 'bp_diastolic': np.array([80.0]),
+        'spo2': np.array([97.0]), 'heart_rate': np.array([70.0]), 'diabetes_risk': np.array([0.1]),
+        'heart_disease_risk': np.array([0.2]), 'hypoxia_risk': np.array([0.3]),
+    }
+
+def test_dot_device_ids_are_archived_inside_the_archive(tmp_path):
+    archive_dir = str(tmp_path / 'archive')
+    for device_id in ('.', '..', 'DEV1'):
+        write_archive(archive_dir, device_id, '2026-01-01',
+                      _columns(device_id, f'reading-{device_id}', '2026-01-01T10:00:00'))
+
+    assert sorted(os.listdir(tmp_path)) == ['archive']
+    for name in os.listdir(os.path.join(archive_dir, DAY_INDEX, '2026-01-01')):
+        assert os.path.isdir(os.path.join(archive_dir, name, '2026-01-01'))
+
+    readings, predictions = read_archive(archive_dir, '2026-01-01T00:00:00', device_id='..')
+    assert [r['id'] for r in readings] == ['reading-..']
+    assert predictions['reading-..']['hypoxia_risk'] == 0.3
+    readings, _ = read_archive(archive_dir, '2026-01-01T00:00:00')
+    assert sorted(r['device_id'] for r in readings) == ['.', '..', 'DEV1']
+
+def test_index_of_an_older_archive_covers_dot_device_ids(tmp_path):
+    archive_dir = str(tmp_path / 'archive')
+    write_archive(archive_dir, '..', '2026-01-02', _columns('..', 'reading-1', '2026-01-02T10:00:00'))
+    os.rename(os.path.join(archive_dir, DAY_INDEX), str(tmp_path / 'old-index'))
+
+    index_archive(archive_dir)
+    readings, _ = read_archive(archive_dir, '2026-01-01T00:00:00')
+    assert [r['id'] for r in readings] == ['reading-1']
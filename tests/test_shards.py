@@ -0,0 +1,66 @@
+import pytest
+
+import shards
+from app import db
+from conftest import devices_on, reading
+from models import Alert, HealthData
+from shards import HashRing, on_shard, parse_shards, shard_engine, shard_for
+
+def test_parse_shards_keeps_commas_inside_uris():
+    parsed = parse_shards('s0=postgresql://db0/hs?options=a,b, s1=sqlite:////tmp/s1.db')
+    assert parsed == {'s0': 'postgresql://db0/hs?options=a,b', 's1': 'sqlite:////tmp/s1.db'}
+    with pytest.raises(ValueError):
+        parse_shards('s0=sqlite://,s0=sqlite://')
+
+def test_ring_placement_is_stable_and_covers_the_key_space():
+    ring = HashRing(['s0', 's1', 's2'])
+    devices = [f'DEV{i}' for i in range(3000)]
+    assert [ring.owner(d) for d in devices] == [HashRing(['s0', 's1', 's2']).owner(d) for d in devices]
+    assert sum(ring.shares().values()) == pytest.approx(1.0)
+    counts = {name: sum(1 for d in devices if ring.owner(d) == name) for name in ('s0', 's1', 's2')}
+    assert min(counts.values()) > 3000 / 3 * 0.6
+
+def test_adding_a_shard_moves_devices_only_to_the_new_shard():
+    before = HashRing(['s0', 's1', 's2'])
+    after = HashRing(['s0', 's1', 's2', 's3'])
+    devices = [f'DEV{i}' for i in range(4000)]
+    moved = [d for d in devices if before.owner(d) != after.owner(d)]
+    assert all(after.owner(d) == 's3' for d in moved)
+    assert 0.15 < len(moved) / len(devices) < 0.35
+
+def test_ingest_stores_each_device_on_its_shard(app, client):
+    device_a, = devices_on('a', 1, prefix='OWN')
+    device_b, = devices_on('b', 1, prefix='OWN')
+    for device_id in (device_a, device_b):
+        assert client.post('/api/healthdata', json=reading(device_id)).status_code == 200
+    with app.app_context():
+        for shard, device_id, other in (('a', device_a, device_b), ('b', device_b, device_a)):
+            with on_shard(shard):
+                assert HealthData.query.filter_by(device_id=device_id).count() == 1
+                assert HealthData.query.filter_by(device_id=other).count() == 0
+
+def test_rebalance_moves_misplaced_devices_back_to_their_owner(app, client):
+    device_id, = devices_on('a', 1, prefix='MOVE')
+    for glucose in (250, 260, 270):
+        assert client.post('/api/healthdata', json=reading(device_id, glucose=glucose)).status_code == 200
+    with app.app_context():
+        with on_shard('a'):
+            alerts = Alert.query.join(HealthData).filter(HealthData.device_id == device_id).count()
+        assert alerts > 0
+        # As if the device had been stored under an older shard list
+        shards.move_devices(shard_engine(db, 'a'), shard_engine(db, 'b'), [device_id])
+        assert shards.plan_rebalance({'a': shard_engine(db, 'a'), 'b': shard_engine(db, 'b')}) \
+            .get(('b', 'a')) == [device_id]
+
+    assert shards.rebalance(dry_run=True)[0]['devices'] >= 1
+    report = shards.rebalance()
+    assert any(entry['from'] == 'b' and entry['to'] == 'a' for entry in report)
+
+    with app.app_context():
+        with on_shard('b'):
+            assert HealthData.query.filter_by(device_id=device_id).count() == 0
+        with on_shard('a'):
+            assert HealthData.query.filter_by(device_id=device_id).count() == 3
+            assert Alert.query.join(HealthData).filter(HealthData.device_id == device_id).count() == alerts
+    assert all(entry['misplaced_devices'] == 0 for entry in shards.status())
+    assert shard_for(device_id) == 'a'
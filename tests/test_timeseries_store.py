@@ -0,0 +1,32 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from timeseries_store import ColumnStore, device_dir_name, device_from_dir_name
+
+def _reading(device_id, timestamp, reading_id):
+    return SimpleNamespace(device_id=device_id, timestamp=timestamp, id=reading_id, glucose=100.0,
+                           bp_systolic=120.0, bp_diastolic=80.0, spo2=97.0, heart_rate=70.0)
+
+@pytest.mark.parametrize('device_id', ['.', '..', '.hidden', 'a/b', '@days', 'DEV 1'])
+def test_device_dir_names_stay_inside_the_root(device_id):
+    name = device_dir_name(device_id)
+    assert name not in ('.', '..') and not name.startswith('.') and '/' not in name
+    assert device_from_dir_name(name) == device_id
+
+def test_dot_device_ids_are_stored_inside_the_root(tmp_path):
+    root = tmp_path / 'store'
+    store = ColumnStore(str(root), segment_capacity=4)
+    for number, device_id in enumerate(['.', '..', 'DEV1']):
+        store.append(_reading(device_id, '2026-01-01T00:00:00', f'reading-{number}'))
+
+    assert sorted(os.listdir(tmp_path)) == ['store']
+    assert sorted(store.device_ids()) == ['.', '..', 'DEV1']
+    assert store.query('2025-12-31T00:00:00', device_id='..')['id'].tolist() == [b'reading-1']
+    assert len(store.query('2025-12-31T00:00:00')['timestamp']) == 3
+
+def test_reading_an_unknown_device_creates_nothing(tmp_path):
+    store = ColumnStore(str(tmp_path))
+    assert len(store.query('2025-12-31T00:00:00', device_id='UNKNOWN')['timestamp']) == 0
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,288 @@
+"""Columnar time-series store for HealthSense readings
+
+Readings are kept per device in append-only segments of memory-mapped NumPy
+columns (one file per column, fixed capacity per segment):
+
+    <root>/<device id>/<segment>/timestamp   int64 microseconds since epoch (UTC)
+    <root>/<device id>/<segment>/id          36-byte reading id
+    <root>/<device id>/<segment>/glucose ... float64 vitals
+    <root>/<device id>/<segment>/meta        int64 [count, sorted, min_ts, max_ts]
+
+The segment header is written after the column values, so readers in other
+processes never see a partially written row. Appends take a per-device file
+lock. Time-range queries on in-order segments are binary searches returning
+views into the mapped files; rollups are vector reductions over those views.
+"""
+import argparse
+import fcntl
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from urllib.parse import quote, unquote
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+VITAL_COLUMNS = ('glucose', 'bp_systolic', 'bp_diastolic', 'spo2', 'heart_rate')
+COLUMN_DTYPES = {
+    'timestamp': np.dtype('<i8'),
+    'id': np.dtype('S36'),
+    **{name: np.dtype('<f8') for name in VITAL_COLUMNS},
+}
+META_COUNT, META_SORTED, META_MIN_TS, META_MAX_TS = range(4)
+
+def to_epoch_us(timestamp):
+    """Convert an ISO timestamp (naive values are UTC) to epoch microseconds"""
+    value = datetime.fromisoformat(timestamp)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    delta = value - datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+def device_dir_name(device_id):
+    """File name for a device's directory: percent-encoded, with a leading dot escaped
+
+    quote() leaves dots alone, so without the escape the ids "." and ".."
+    would name the store root and its parent.
+    """
+    if not device_id:
+        raise ValueError("Device id must not be empty")
+    name = quote(device_id, safe='')
+    return '%2E' + name[1:] if name.startswith('.') else name
+
+def device_from_dir_name(name):
+    return unquote(name)
+
+def to_iso(epoch_us):
+    """Convert an array of epoch microseconds to ISO timestamp strings"""
+    return np.datetime_as_string(np.asarray(epoch_us).astype('datetime64[us]'))
+
+class Segment:
+    """One fixed-capacity block of memory-mapped columns"""
+
+    def __init__(self, path, capacity, create=False):
+        self.path = path
+        if create:
+            os.makedirs(path, exist_ok=True)
+        else:
+            capacity = os.path.getsize(os.path.join(path, 'timestamp')) // COLUMN_DTYPES['timestamp'].itemsize
+        self.capacity = capacity
+        mode = 'w+' if create else 'r+'
+        self.columns = {
+            name: np.memmap(os.path.join(path, name), dtype=dtype, mode=mode, shape=(capacity,))
+            for name, dtype in COLUMN_DTYPES.items()
+        }
+        self.meta = np.memmap(os.path.join(path, 'meta'), dtype='<i8', mode=mode, shape=(4,))
+        if create:
+            self.meta[:] = (0, 1, np.iinfo(np.int64).max, np.iinfo(np.int64).min)
+            self.meta.flush()
+
+    @property
+    def count(self):
+        return int(self.meta[META_COUNT])
+
+    def append(self, timestamp_us, reading_id, vitals):
+        index = self.count
+        self.columns['timestamp'][index] = timestamp_us
+        self.columns['id'][index] = reading_id.encode()
+        for name in VITAL_COLUMNS:
+            self.columns[name][index] = vitals[name]
+        if index and timestamp_us < self.meta[META_MAX_TS]:
+            self.meta[META_SORTED] = 0
+        self.meta[META_MIN_TS] = min(int(self.meta[META_MIN_TS]), timestamp_us)
+        self.meta[META_MAX_TS] = max(int(self.meta[META_MAX_TS]), timestamp_us)
+        self.meta[META_COUNT] = index + 1
+
+    def select(self, start_us, end_us):
+        """Return columns for rows in [start_us, end_us), as views when possible"""
+        count = self.count
+        if not count or self.meta[META_MAX_TS] < start_us or self.meta[META_MIN_TS] >= end_us:
+            return None
+        timestamps = self.columns['timestamp'][:count]
+        if self.meta[META_SORTED]:
+            lo = int(np.searchsorted(timestamps, start_us, side='left'))
+            hi = int(np.searchsorted(timestamps, end_us, side='left'))
+            if lo >= hi:
+                return None
+            return {name: column[lo:hi] for name, column in self.columns.items()}
+        mask = (timestamps >= start_us) & (timestamps < end_us)
+        if not mask.any():
+            return None
+        return {name: column[:count][mask] for name, column in self.columns.items()}
+
+class DeviceSeries:
+    """All segments of one device"""
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self.segments = []
+        self._lock_path = os.path.join(path, '.lock')
+        self.refresh()
+
+    def refresh(self):
+        """Pick up segments created by other processes"""
+        while os.path.exists(os.path.join(self.path, f'{len(self.segments):06d}', 'meta')):
+            self.segments.append(Segment(os.path.join(self.path, f'{len(self.segments):06d}'), self.capacity))
+
+    def append(self, timestamp_us, reading_id, vitals):
+        # Only appends create the directory; reads of unknown devices find no segments
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.refresh()
+            if not self.segments or self.segments[-1].count >= self.segments[-1].capacity:
+                path = os.path.join(self.path, f'{len(self.segments):06d}')
+                self.segments.append(Segment(path, self.capacity, create=True))
+            self.segments[-1].append(timestamp_us, reading_id, vitals)
+
+    def select(self, start_us, end_us):
+        self.refresh()
+        parts = [part for part in (s.select(start_us, end_us) for s in self.segments) if part is not None]
+        if not parts:
+            return None
+        if len(parts) == 1:
+            return parts[0]
+        return {name: np.concatenate([part[name] for part in parts]) for name in COLUMN_DTYPES}
+
+class ColumnStore:
+    """Per-device columnar reading store rooted at a directory
+
+    Every mapped column holds a file descriptor, so only the most recently
+    used max_open_series devices stay mapped.
+    """
+
+    def __init__(self, root, segment_capacity=16384, max_open_series=256):
+        self.root = root
+        self.segment_capacity = segment_capacity
+        self.max_open_series = max_open_series
+        self._series = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def series(self, device_id):
+        with self._lock:
+            series = self._series.get(device_id)
+            if series is None:
+                series = DeviceSeries(os.path.join(self.root, device_dir_name(device_id)), self.segment_capacity)
+                self._series[device_id] = series
+                if len(self._series) > self.max_open_series:
+                    self._series.popitem(last=False)
+            else:
+                self._series.move_to_end(device_id)
+            return series
+
+    def device_ids(self):
+        return [device_from_dir_name(name) for name in os.listdir(self.root) if not name.startswith('.')]
+
+    def append(self, reading):
+        """Append a HealthData-like object"""
+        vitals = {name: getattr(reading, name) for name in VITAL_COLUMNS}
+        self.series(reading.device_id).append(to_epoch_us(reading.timestamp), reading.id, vitals)
+
+    def query(self, start_time, end_time=None, device_id=None):
+        """Return readings in [start_time, end_time) as a dict of column arrays
+
+        Single-device, single-segment results are zero-copy views. The result
+        also carries a 'device_id' column and is ordered by timestamp.
+        """
+        start_us = to_epoch_us(start_time)
+        end_us = to_epoch_us(end_time) if end_time else np.iinfo(np.int64).max
+        device_ids = [device_id] if device_id is not None else self.device_ids()
+
+        parts = []
+        for device in device_ids:
+            columns = self.series(device).select(start_us, end_us)
+            if columns is not None:
+                if len(device_ids) > 1:
+                    # Copy so the views do not keep every device's files mapped
+                    columns = {name: np.array(column) for name, column in columns.items()}
+                columns['device_id'] = np.full(len(columns['timestamp']), device, dtype=object)
+                parts.append(columns)
+
+        if not parts:
+            return {name: np.empty(0, dtype=dtype) for name, dtype in COLUMN_DTYPES.items()} | {
+                'device_id': np.empty(0, dtype=object)}
+        if len(parts) == 1:
+            result = parts[0]
+        else:
+            result = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+        timestamps = result['timestamp']
+        if len(timestamps) > 1 and np.any(timestamps[1:] < timestamps[:-1]):
+            order = np.argsort(timestamps, kind='stable')
+            result = {name: column[order] for name, column in result.items()}
+        return result
+
+def rollup_columns(columns, bucket_seconds):
+    """Aggregate time-ordered columns into fixed buckets with vector reductions"""
+    timestamps = columns['timestamp']
+    if not len(timestamps):
+        return {'bucket_start': [], 'count': []}
+    bucket_us = int(bucket_seconds * 1_000_000)
+    buckets = timestamps // bucket_us
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    counts = np.diff(np.r_[starts, len(timestamps)])
+    result = {
+        'bucket_start': to_iso(buckets[starts] * bucket_us).tolist(),
+        'count': counts.tolist(),
+    }
+    for name in VITAL_COLUMNS:
+        values = np.asarray(columns[name], dtype=np.float64)
+        result[name] = {
+            'mean': (np.add.reduceat(values, starts) / counts).tolist(),
+            'min': np.minimum.reduceat(values, starts).tolist(),
+            'max': np.maximum.reduceat(values, starts).tolist(),
+        }
+    return result
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """Return the process-wide column store configured on the Flask app"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                from app import app
+                _store = ColumnStore(app.config['HEALTHSENSE_COLUMN_STORE_DIR'])
+    return _store
+
+def backfill(batch_size=5000):
+    """Copy readings already in the SQL table into the column store"""
+    from app import app
+    from models import HealthData
+
+    from shards import on_shard, shard_names
+
+    store = get_store()
+    copied = 0
+    with app.app_context():
+        # A device lives on one shard, so its readings still arrive in time order
+        for shard in shard_names():
+            last = None
+            while True:
+                with on_shard(shard):
+                    query = HealthData.query.order_by(HealthData.timestamp, HealthData.id)
+                    if last is not None:
+                        query = query.filter((HealthData.timestamp > last[0]) |
+                                             ((HealthData.timestamp == last[0]) & (HealthData.id > last[1])))
+                    rows = query.limit(batch_size).all()
+                if not rows:
+                    break
+                for row in rows:
+                    store.append(row)
+                copied += len(rows)
+                last = (rows[-1].timestamp, rows[-1].id)
+                logger.info(f"Backfilled {copied} readings")
+    return copied
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='HealthSense columnar reading store')
+    parser.add_argument('command', choices=['backfill'], help='backfill: copy SQL readings into the store')
+    parser.add_argument('--batch-size', type=int, default=5000, help='Rows per database batch')
+    args = parser.parse_args()
+    print(f"Backfilled {backfill(args.batch_size)} readings")
@@ -0,0 +1,236 @@
+"""Training pipeline for the HealthSense risk models
+
+    python train.py <version> [--sample-size 200000] [--cv 5] [--n-jobs -1] [--activate]
+
+Stored readings are streamed from health_data in keyset-ordered chunks. Each
+chunk becomes a float64 feature matrix and is labelled with vectorized
+rules. The labels are soft versions of the alert thresholds: the further a
+vital is past its threshold, the likelier a positive label. The chunk then
+feeds a fixed-size reservoir sample, so memory stays bounded however many
+readings there are. Each model is cross-validated in parallel (n_jobs) and
+fitted on the sample. The models and a training report are written to the
+model registry as a new version.
+
+Everything is seeded: the same readings and seed produce the same models.
+"""
+import argparse
+import logging
+import os
+import pickle
+import sys
+import time
+from contextlib import ExitStack
+
+import numpy as np
+from sklearn.calibration import CalibratedClassifierCV
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import StratifiedKFold, cross_validate
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.svm import SVC
+
+logger = logging.getLogger(__name__)
+
+FEATURE_COLUMNS = ('glucose', 'bp_systolic', 'bp_diastolic', 'spo2', 'heart_rate')
+LABELS = ('diabetes', 'heart_disease', 'hypoxia')
+
+def _diabetes_inputs(features):
+    # Same layout as predict_diabetes: glucose and a constant dummy feature
+    return np.column_stack([features[:, 0], np.full(len(features), 0.5)])
+
+def _diabetes_model(seed):
+    return make_pipeline(StandardScaler(), LogisticRegression(max_iter=1000, random_state=seed))
+
+def _heart_model(seed):
+    return RandomForestClassifier(n_estimators=50, max_depth=10, min_samples_leaf=20, random_state=seed)
+
+def _hypoxia_model(seed):
+    # Platt-scaled SVM probabilities, as SVC(probability=True) gave
+    return make_pipeline(StandardScaler(), CalibratedClassifierCV(SVC(random_state=seed), ensemble=False))
+
+# (label, model inputs from the feature matrix, estimator factory, max training rows)
+MODEL_SPECS = (
+    ('diabetes', _diabetes_inputs, _diabetes_model, None),
+    ('heart_disease', lambda features: features[:, [1, 2, 4]], _heart_model, None),
+    # SVC training is quadratic in the number of rows
+    ('hypoxia', lambda features: features[:, [3, 4]], _hypoxia_model, 10000),
+)
+
+def derive_labels(features, rng):
+    """Sample (n, 3) int8 labels whose probability rises past each alert threshold"""
+    glucose, bp_systolic, bp_diastolic, spo2, heart_rate = features.T
+    scores = np.column_stack([
+        (glucose - 180) / 20,
+        np.maximum.reduce([(bp_systolic - 140) / 10, (bp_diastolic - 90) / 7, (heart_rate - 100) / 10]),
+        (94 - spo2) / 1.5,
+    ])
+    probabilities = 1 / (1 + np.exp(-scores))
+    return (rng.random(probabilities.shape) < probabilities).astype(np.int8)
+
+def synthetic_readings(count, seed=0):
+    """Seeded readings spread over normal and abnormal vital ranges"""
+    rng = np.random.default_rng(seed)
+    return np.column_stack([
+        np.clip(rng.normal(140, 60, count), 40, 450),
+        np.clip(rng.normal(130, 22, count), 80, 220),
+        np.clip(rng.normal(84, 14, count), 40, 140),
+        np.clip(rng.normal(94, 4, count), 70, 100),
+        np.clip(rng.normal(85, 22, count), 30, 190),
+    ])
+
+class Reservoir:
+    """Uniform fixed-size sample of the rows of a stream of chunks"""
+
+    def __init__(self, size, width, rng):
+        self.rows = np.empty((size, width))
+        self.rng = rng
+        self.seen = 0
+
+    def add(self, chunk):
+        size = len(self.rows)
+        fill = min(max(size - self.seen, 0), len(chunk))
+        self.rows[self.seen:self.seen + fill] = chunk[:fill]
+        rest = chunk[fill:]
+        if len(rest):
+            # Row i of the stream replaces a random slot with probability size / (i + 1)
+            first = self.seen + fill
+            slots = self.rng.integers(0, np.arange(first + 1, first + len(rest) + 1))
+            keep = slots < size
+            self.rows[slots[keep]] = rest[keep]
+        self.seen += len(chunk)
+
+    def sample(self):
+        return self.rows[:min(self.seen, len(self.rows))]
+
+def sample_readings(conns, sample_size=200000, chunk_size=50000, seed=0):
+    """Stream labelled readings into a reservoir; returns (features, labels, rows seen)
+
+    conns are connections to every database holding readings (one per shard),
+    streamed one after another into the same reservoir.
+    """
+    from sqlalchemy import select
+    from models import HealthData
+
+    table = HealthData.__table__
+    rng = np.random.default_rng(seed)
+    reservoir = Reservoir(sample_size, len(FEATURE_COLUMNS) + len(LABELS), rng)
+    for conn in conns:
+        last_id = None
+        while True:
+            query = (select(table.c.id, *[table.c[name] for name in FEATURE_COLUMNS])
+                     .order_by(table.c.id).limit(chunk_size))
+            if last_id is not None:
+                query = query.where(table.c.id > last_id)
+            rows = conn.execute(query).all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            features = np.array([row[1:] for row in rows], dtype=np.float64)
+            reservoir.add(np.hstack([features, derive_labels(features, rng)]))
+            logger.info(f"Sampled from {reservoir.seen} readings")
+    sample = reservoir.sample()
+    width = len(FEATURE_COLUMNS)
+    return sample[:, :width], sample[:, width:].astype(np.int8), reservoir.seen
+
+def fit_models(features, labels, seed=0, cv=0, n_jobs=1):
+    """Fit the three risk models; returns (models, per-model report)
+
+    With cv > 1 each model is first cross-validated with n_jobs parallel folds.
+    """
+    rng = np.random.default_rng(seed)
+    models = []
+    report = {}
+    for column, (name, inputs, factory, max_rows) in enumerate(MODEL_SPECS):
+        rows = np.arange(len(features))
+        if max_rows is not None and len(rows) > max_rows:
+            rows = np.sort(rng.choice(rows, max_rows, replace=False))
+        X = inputs(features[rows])
+        y = labels[rows, column]
+        if len(np.unique(y)) < 2:
+            raise ValueError(f"Training data for {name} has a single class; more varied readings are needed")
+
+        entry = {'rows': int(len(rows)), 'positive_rate': float(y.mean())}
+        estimator = factory(seed)
+        if cv > 1 and np.bincount(y).min() >= cv:
+            started = time.monotonic()
+            scores = cross_validate(estimator, X, y, scoring=('roc_auc', 'neg_log_loss'), n_jobs=n_jobs,
+                                    cv=StratifiedKFold(n_splits=cv, shuffle=True, random_state=seed))
+            entry['cv_roc_auc'] = float(scores['test_roc_auc'].mean())
+            entry['cv_log_loss'] = float(-scores['test_neg_log_loss'].mean())
+            entry['cv_seconds'] = round(time.monotonic() - started, 3)
+        elif cv > 1:
+            logger.warning(f"Too few positive or negative {name} labels for {cv}-fold cross-validation")
+
+        parallel = 'n_jobs' in estimator.get_params()
+        if parallel:
+            estimator.set_params(n_jobs=n_jobs)
+        started = time.monotonic()
+        estimator.fit(X, y)
+        entry['fit_seconds'] = round(time.monotonic() - started, 3)
+        if parallel:
+            # Serving scores one reading at a time; worker threads would only add overhead
+            estimator.set_params(n_jobs=None)
+        entry['size_bytes'] = len(pickle.dumps(estimator, protocol=pickle.HIGHEST_PROTOCOL))
+        models.append(estimator)
+        report[name] = entry
+    return tuple(models), report
+
+def train(version, sample_size=200000, chunk_size=50000, cv=5, n_jobs=-1, seed=0, registry_dir=None):
+    """Train on stored readings and save the models as a registry version"""
+    from app import app, db
+    from model_manager import save_model_set
+    from shards import shard_engine, shard_names
+
+    registry_dir = registry_dir or os.environ.get("HEALTHSENSE_MODEL_DIR", "model_registry")
+    started = time.monotonic()
+    with app.app_context(), ExitStack() as stack:
+        conns = [stack.enter_context(shard_engine(db, name).connect()) for name in shard_names()]
+        features, labels, seen = sample_readings(conns, sample_size, chunk_size, seed)
+    sampled_seconds = time.monotonic() - started
+    if not len(features):
+        raise ValueError("No readings stored in health_data to train on")
+
+    models, report = fit_models(features, labels, seed=seed, cv=cv, n_jobs=n_jobs)
+    metadata = {
+        'source': 'health_data',
+        'readings': int(seen),
+        'sample_size': int(len(features)),
+        'seed': seed,
+        'cv_folds': cv,
+        'sample_seconds': round(sampled_seconds, 3),
+        'train_seconds': round(time.monotonic() - started, 3),
+        'models': report,
+    }
+    save_model_set(registry_dir, version, models, metadata)
+    return metadata
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Train the HealthSense risk models on stored readings')
+    parser.add_argument('version', help='Registry version to create')
+    parser.add_argument('--sample-size', type=int, default=200000, help='Readings kept in memory for training')
+    parser.add_argument('--chunk-size', type=int, default=50000, help='Readings read per database round trip')
+    parser.add_argument('--cv', type=int, default=5, help='Cross-validation folds (0 skips cross-validation)')
+    parser.add_argument('--n-jobs', type=int, default=-1, help='Parallel jobs for cross-validation and forests')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--activate', action='store_true', help='Serve the new version on all workers')
+    parser.add_argument('--shadow', action='store_true', help='Shadow-score the new version')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    metadata = train(args.version, args.sample_size, args.chunk_size, args.cv, args.n_jobs, args.seed)
+    print(f"Trained {args.version} on {metadata['sample_size']} of {metadata['readings']} readings "
+          f"in {metadata['train_seconds']:.1f}s")
+    for name, entry in metadata['models'].items():
+        auc = f", CV ROC AUC {entry['cv_roc_auc']:.3f}" if 'cv_roc_auc' in entry else ''
+        print(f"  {name}: {entry['rows']} rows, fit {entry['fit_seconds']:.2f}s, "
+              f"{entry['size_bytes'] / 1024:.0f} KiB{auc}")
+
+    if args.activate or args.shadow:
+        from model_manager import ACTIVE_POINTER, CANDIDATE_POINTER, set_pointer
+        registry_dir = os.environ.get("HEALTHSENSE_MODEL_DIR", "model_registry")
+        set_pointer(registry_dir, ACTIVE_POINTER if args.activate else CANDIDATE_POINTER, args.version)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,29 @@
-from flask import render_template, request, jsonify, redirect, url_for
+from flask import render_template, request, jsonify, redirect, url_for, Response
+import base64
+import hmac
 import json
 import logging
 from datetime import datetime, timedelta
 import time
 
-from app import app, socketio, db, health_data, predictions, alerts
-from app import diabetes_model, heart_model, hypoxia_model
-from models import HealthData, Prediction, Alert
-from ml_models import predict_diabetes, predict_heart_disease, predict_hypoxia, get_health_alerts
+import numpy as np
+from sqlalchemy import and_, or_, select, update
+
+from app import app, socketio, db, health_data, predictions, alerts, model_manager, recent
+from models import HealthData, Prediction, Alert, DeviceBaseline, DeviceVersion, VITAL_FIELDS
+from ingest import submit_health_data
+from caching import conditional, bump_data_version
+from alert_events import publish_acknowledged
+from ml_models import prediction_cache_stats
+from retention import cutoff_for, read_archive
+from timeseries_store import get_store, rollup_columns, to_epoch_us, to_iso
+from analytics import (threshold_episodes, threshold_episodes_columnar, top_devices_by_risk,
+                       merge_rankings, episode_order, risk_order)
+from streams import sse_events, poll_events
+from db_health import health_report
+from replicas import read_replica, read_your_writes, replica_status
+from edge import SYNC_TOKEN, apply_sync_batch, decompress_sync_batch, sync_status
+from shards import scatter, merge_sorted, on_shard, shard_for, current_shard, group_by_shard, shard_status
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +42,11 @@ def reports():
 def device_settings():
     return render_template('device_settings.html')
 
+# Route for the multi-device ward wall
+@app.route('/ward')
+def ward():
+    return render_template('ward.html')
+
 # Route for manual data entry
 @app.route('/manual-entry', methods=['GET', 'POST'])
 def manual_entry():
@@ -53,66 +74,8 @@ def manual_entry():
                 timestamp=data['timestamp']
             )
             
-            # Store data in the database
-            db.session.add(new_health_data)
-            
-            # Also keep in memory for transition period
-            health_data.append(new_health_data)
-            if len(health_data) > 1000:
-                health_data.pop(0)
-            
-            # Run ML predictions
-            diabetes_risk = predict_diabetes(diabetes_model, new_health_data.glucose)
-            heart_disease_risk = predict_heart_disease(
-                heart_model, 
-                new_health_data.bp_systolic, 
-                new_health_data.bp_diastolic, 
-                new_health_data.heart_rate
-            )
-            hypoxia_risk = predict_hypoxia(hypoxia_model, new_health_data.spo2, new_health_data.heart_rate)
-            
-            # Create Prediction object
-            new_prediction = Prediction(
-                health_data_id=new_health_data.id,
-                diabetes_risk=diabetes_risk,
-                heart_disease_risk=heart_disease_risk,
-                hypoxia_risk=hypoxia_risk
-            )
-            
-            # Store prediction in database
-            db.session.add(new_prediction)
-            
-            # Also keep in memory for transition period
-            predictions.append(new_prediction)
-            if len(predictions) > 1000:
-                predictions.pop(0)
-            
-            # Check for alerts
-            health_alerts = get_health_alerts(new_health_data)
-            for alert_data in health_alerts:
-                new_alert = Alert(
-                    health_data_id=new_health_data.id,
-                    message=alert_data["message"],
-                    condition=alert_data["condition"],
-                    severity=alert_data["severity"]
-                )
-                # Store alert in database
-                db.session.add(new_alert)
-                
-                # Also keep in memory for transition period
-                alerts.append(new_alert)
-                if len(alerts) > 100:
-                    alerts.pop(0)
-            
-            # Commit changes to database
-            db.session.commit()
-            
-            # Broadcast data to connected clients
-            socketio.emit('new_health_data', {
-                'health_data': new_health_data.to_dict(),
-                'prediction': new_prediction.to_dict(),
-                'alerts': [a.to_dict() for a in alerts if a.health_data_id == new_health_data.id]
-            })
+            # Store, score and broadcast the reading
+            submit_health_data(new_health_data)
             
             # Redirect to dashboard with success message
             return redirect(url_for('index'))
@@ -141,66 +104,8 @@ def receive_health_data():
             timestamp=data.get('timestamp', datetime.utcnow().isoformat())
         )
         
-        # Store data in database
-        db.session.add(new_health_data)
-        
-        # Also keep in memory for transition period
-        health_data.append(new_health_data)
-        if len(health_data) > 1000:  # Limit storage size for MVP
-            health_data.pop(0)
-        
-        # Run ML predictions
-        diabetes_risk = predict_diabetes(diabetes_model, new_health_data.glucose)
-        heart_disease_risk = predict_heart_disease(
-            heart_model, 
-            new_health_data.bp_systolic, 
-            new_health_data.bp_diastolic, 
-            new_health_data.heart_rate
-        )
-        hypoxia_risk = predict_hypoxia(hypoxia_model, new_health_data.spo2, new_health_data.heart_rate)
-        
-        # Create Prediction object
-        new_prediction = Prediction(
-            health_data_id=new_health_data.id,
-            diabetes_risk=diabetes_risk,
-            heart_disease_risk=heart_disease_risk,
-            hypoxia_risk=hypoxia_risk
-        )
-        
-        # Store prediction in database
-        db.session.add(new_prediction)
-        
-        # Also keep in memory for transition period
-        predictions.append(new_prediction)
-        if len(predictions) > 1000:  # Limit storage size for MVP
-            predictions.pop(0)
-        
-        # Check for alerts
-        health_alerts = get_health_alerts(new_health_data)
-        for alert_data in health_alerts:
-            new_alert = Alert(
-                health_data_id=new_health_data.id,
-                message=alert_data["message"],
-                condition=alert_data["condition"],
-                severity=alert_data["severity"]
-            )
-            # Store in database
-            db.session.add(new_alert)
-            
-            # Keep in memory for transition
-            alerts.append(new_alert)
-            if len(alerts) > 100:  # Limit alerts for MVP
-                alerts.pop(0)
-        
-        # Commit changes to database
-        db.session.commit()
-        
-        # Broadcast data to connected clients
-        socketio.emit('new_health_data', {
-            'health_data': new_health_data.to_dict(),
-            'prediction': new_prediction.to_dict(),
-            'alerts': [a.to_dict() for a in alerts if a.health_data_id == new_health_data.id]
-        })
+        # Store, score and broadcast the reading
+        new_prediction, _ = submit_health_data(new_health_data)
         
         return jsonify({
             'status': 'success',
@@ -218,36 +123,31 @@ def receive_health_data():
 
 # API endpoint to get latest health data
 @app.route('/api/latest', methods=['GET'])
+@read_replica
 def get_latest_data():
     try:
-        # Get latest health data from database
-        latest_db_data = HealthData.query.order_by(HealthData.timestamp.desc()).first()
+        # Get latest health data from database: the newest reading of every shard
+        found = [latest for _, latest in scatter(_latest_on_shard) if latest]
+        latest_db_data = max(found, key=lambda latest: latest[0]['timestamp']) if found else None
         
         # If not in database, check in-memory (during transition)
-        if not latest_db_data and health_data:
-            latest_data = health_data[-1].to_dict()
+        recent_data = recent(health_data)
+        if not latest_db_data and recent_data:
+            latest_data = recent_data[-1].to_dict()
             
             # Find associated prediction from in-memory
             latest_prediction = None
-            for p in reversed(predictions):
+            for p in reversed(recent(predictions)):
                 if p.health_data_id == latest_data['id']:
                     latest_prediction = p.to_dict()
                     break
             
             # Get associated alerts from in-memory
-            data_alerts = [a.to_dict() for a in alerts if a.health_data_id == latest_data['id']]
+            data_alerts = [a.to_dict() for a in recent(alerts) if a.health_data_id == latest_data['id']]
             
         elif latest_db_data:
             # Get data from database
-            latest_data = latest_db_data.to_dict()
-            
-            # Find associated prediction from database
-            db_prediction = Prediction.query.filter_by(health_data_id=latest_data['id']).first()
-            latest_prediction = db_prediction.to_dict() if db_prediction else None
-            
-            # Get associated alerts from database
-            db_alerts = Alert.query.filter_by(health_data_id=latest_data['id']).all()
-            data_alerts = [a.to_dict() for a in db_alerts]
+            latest_data, latest_prediction, data_alerts = latest_db_data
             
         else:
             return jsonify({'status': 'error', 'message': 'No data available'}), 404
@@ -266,54 +166,267 @@ def get_latest_data():
             'message': str(e)
         }), 400
 
+def _latest_on_shard():
+    """The newest reading of the current shard with its prediction and alerts, as dicts"""
+    latest_db_data = HealthData.query.order_by(HealthData.timestamp.desc()).first()
+    if latest_db_data is None:
+        return None
+    latest_data = latest_db_data.to_dict()
+    
+    # Find associated prediction from database
+    db_prediction = Prediction.query.filter_by(health_data_id=latest_data['id']).first()
+    latest_prediction = db_prediction.to_dict() if db_prediction else None
+    
+    # Get associated alerts from database
+    db_alerts = Alert.query.filter_by(health_data_id=latest_data['id']).all()
+    return latest_data, latest_prediction, [a.to_dict() for a in db_alerts]
+
+HISTORY_COLUMNS = ('id', 'device_id', 'timestamp') + VITAL_FIELDS
+RISK_FIELDS = ('diabetes_risk', 'heart_disease_risk', 'hypoxia_risk')
+
+def _history_columns(cutoff_time, device_id, limit):
+    """Collect the most recent readings since cutoff_time as parallel columns
+
+    Vital columns are float64 arrays (views into the column store when that
+    backend is enabled); id, device_id and timestamp are string arrays.
+    Returns the columns and the predictions of any archived readings.
+    """
+    if app.config['HEALTHSENSE_READINGS_BACKEND'] == 'columnar':
+        stored = get_store().query(cutoff_time, device_id=device_id)
+        stored = {name: column[-limit:] for name, column in stored.items()}
+        columns = {
+            'id': stored['id'].astype(str),
+            'device_id': stored['device_id'].astype(str),
+            'timestamp': to_iso(stored['timestamp']),
+            **{name: stored[name] for name in VITAL_FIELDS}
+        }
+    else:
+        # Select plain tuples of the newest rows rather than ORM instances,
+        # from the device's shard or from every shard
+        def newest_rows():
+            query = (db.session.query(*[getattr(HealthData, name) for name in HISTORY_COLUMNS])
+                     .filter(HealthData.timestamp >= cutoff_time))
+            if device_id:
+                query = query.filter(HealthData.device_id == device_id)
+            return [tuple(row) for row in query.order_by(HealthData.timestamp.desc()).limit(limit)]
+        results = scatter(newest_rows, [shard_for(device_id)] if device_id else None)
+        rows = merge_sorted(results, key=lambda row: row[2], limit=limit, reverse=True)[::-1]
+        columns = _rows_to_columns(rows)
+    
+    # Rows not (or no longer) in the primary store: readings past the
+    # retention window and, for the transition period, in-memory readings
+    extra_rows = []
+    archived_predictions = {}
+    known_ids = set(columns['id'].tolist())
+    retention_cutoff = cutoff_for(app.config['HEALTHSENSE_RETENTION']['health_data'])
+    if (app.config['HEALTHSENSE_READINGS_BACKEND'] == 'sql'
+            and retention_cutoff and cutoff_time < retention_cutoff
+            and len(columns['id']) < limit):
+        archived_data, archived_predictions = read_archive(app.config['HEALTHSENSE_ARCHIVE_DIR'], cutoff_time,
+                                                               device_id=device_id, limit=limit)
+        extra_rows.extend(tuple(d[name] for name in HISTORY_COLUMNS) for d in archived_data)
+    for d in recent(health_data):
+        if d.timestamp >= cutoff_time and (not device_id or d.device_id == device_id) and d.id not in known_ids:
+            extra_rows.append(tuple(getattr(d, name) for name in HISTORY_COLUMNS))
+    
+    if extra_rows:
+        extra = _rows_to_columns(extra_rows)
+        merged = {name: np.concatenate([np.asarray(extra[name]), np.asarray(columns[name])])
+                  for name in HISTORY_COLUMNS}
+        _, first = np.unique(merged['id'], return_index=True)
+        order = first[np.argsort(merged['timestamp'][first], kind='stable')][-limit:]
+        columns = {name: column[order] for name, column in merged.items()}
+    return columns, archived_predictions
+
+def _rows_to_columns(rows):
+    """Transpose (id, device_id, timestamp, *vitals) tuples into columns"""
+    transposed = list(zip(*rows)) if rows else [()] * len(HISTORY_COLUMNS)
+    columns = {name: np.array(transposed[i], dtype=str) for i, name in enumerate(HISTORY_COLUMNS[:3])}
+    for i, name in enumerate(VITAL_FIELDS, start=3):
+        columns[name] = np.array(transposed[i], dtype=np.float64)
+    return columns
+
+def _history_predictions(ids, device_ids, archived_predictions):
+    """Load predictions for reading ids in batched queries, keyed by reading id
+
+    Each reading's prediction is looked up on the shard of its device.
+    """
+    def load(shard_ids):
+        loaded = {}
+        for chunk_start in range(0, len(shard_ids), 500):
+            chunk = shard_ids[chunk_start:chunk_start + 500]
+            rows = (db.session.query(Prediction.id, Prediction.health_data_id,
+                                     *[getattr(Prediction, name) for name in RISK_FIELDS], Prediction.timestamp)
+                    .filter(Prediction.health_data_id.in_(chunk)))
+            for row in rows:
+                loaded[row[1]] = {
+                    'id': row[0],
+                    'health_data_id': row[1],
+                    **{name: row[i] for i, name in enumerate(RISK_FIELDS, start=2)},
+                    'timestamp': row[-1]
+                }
+        return loaded
+    
+    ids_by_shard = {shard: [ids[i] for i in positions] for shard, positions in group_by_shard(device_ids).items()}
+    found = {}
+    for _, loaded in scatter(lambda: load(ids_by_shard[current_shard()]), list(ids_by_shard)):
+        found.update(loaded)
+    
+    missing = set(ids) - set(found)
+    if missing:
+        # Archived readings carry their risks in the archive files
+        found.update({k: v for k, v in archived_predictions.items() if k in missing})
+        # Try in-memory for the transition period
+        for p in recent(predictions):
+            if p.health_data_id in missing and p.health_data_id not in found:
+                found[p.health_data_id] = p.to_dict()
+    return found
+
+def _history_binary(columns, risks):
+    """Pack history columns as raw little-endian arrays
+
+    Layout: uint32 header length, UTF-8 JSON header (ids, device ids and an
+    index of arrays with byte offsets), zero padding to an 8-byte boundary,
+    then each array's bytes. Arrays are float64; timestamps are epoch
+    milliseconds. Missing risks are NaN.
+    """
+    count = len(columns['id'])
+    arrays = {'timestamp': columns['timestamp'].astype('datetime64[us]').astype(np.int64) / 1000.0}
+    arrays.update({name: columns[name] for name in VITAL_FIELDS})
+    arrays.update(risks)
+
+    index = []
+    offset = 0
+    for name, values in arrays.items():
+        index.append({'name': name, 'dtype': 'float64', 'offset': offset, 'length': count})
+        offset += count * 8
+    header = json.dumps({
+        'count': count,
+        'id': columns['id'].tolist(),
+        'device_id': columns['device_id'].tolist(),
+        'arrays': index
+    }).encode()
+    padding = -(4 + len(header)) % 8
+    parts = [len(header).to_bytes(4, 'little'), header, b'\0' * padding]
+    parts.extend(np.ascontiguousarray(values, dtype='<f8').tobytes() for values in arrays.values())
+    return b''.join(parts)
+
+# Rows scanned at most when a downsampled history is requested
+HISTORY_DOWNSAMPLE_MAX_ROWS = 200000
+
+def _downsample_columns(columns, points):
+    """Reduce time-ordered history vitals to about `points` min/max points each
+
+    Readings are grouped into points // 2 equal time buckets. In each
+    non-empty bucket every vital keeps its minimum and its maximum, each at
+    the timestamp where it occurred and in time order, so spikes survive
+    decimation where they happened. Returns per-vital timestamps and values.
+    """
+    timestamps = columns['timestamp'].astype('datetime64[us]').astype(np.int64)
+    count = len(timestamps)
+    if count <= points:
+        return ({name: columns['timestamp'] for name in VITAL_FIELDS},
+                {name: columns[name] for name in VITAL_FIELDS})
+
+    buckets = max(points // 2, 1)
+    span = int(timestamps[-1] - timestamps[0]) + 1
+    bucket = (timestamps - timestamps[0]) * buckets // span
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    ends = np.r_[starts[1:], count] - 1
+    downsampled_times, downsampled = {}, {}
+    for name in VITAL_FIELDS:
+        values = columns[name]
+        # Sorted by bucket, then value: each bucket's first row is its minimum, its last its maximum
+        order = np.lexsort((values, bucket))
+        first = np.minimum(order[starts], order[ends])
+        last = np.maximum(order[starts], order[ends])
+        # A bucket whose minimum and maximum are the same reading yields one point
+        picked = np.column_stack([first, last]).ravel()
+        picked = picked[np.r_[True, picked[1:] != picked[:-1]]]
+        downsampled_times[name] = to_iso(timestamps[picked])
+        downsampled[name] = values[picked]
+    return downsampled_times, downsampled
+
 # API endpoint to get historical data
 @app.route('/api/history', methods=['GET'])
+@read_replica
+@conditional
 def get_historical_data():
     try:
         # Get query parameters
         hours = int(request.args.get('hours', 24))
         limit = min(int(request.args.get('limit', 100)), 1000)  # Cap at 1000 records
+        device_id = request.args.get('device_id')
+        since = request.args.get('since')  # only return readings newer than this timestamp
+        response_format = request.args.get('format', 'rows')
+        if response_format not in ('rows', 'columnar', 'binary'):
+            return jsonify({'status': 'error', 'message': f"Unknown format: {response_format}"}), 400
+        points = int(request.args.get('points', 0))  # downsample to about this many points
+        if points:
+            if response_format != 'columnar':
+                return jsonify({'status': 'error', 'message': 'points requires format=columnar'}), 400
+            limit = HISTORY_DOWNSAMPLE_MAX_ROWS
         
         # Calculate cutoff time
         cutoff_time = (datetime.utcnow() - timedelta(hours=hours)).isoformat()
+        if since and since > cutoff_time:
+            cutoff_time = since
         
-        # Query database for recent health data
-        db_data = HealthData.query.filter(HealthData.timestamp >= cutoff_time).order_by(HealthData.timestamp).limit(limit).all()
-        db_data_dicts = [d.to_dict() for d in db_data]
-        
-        # For transition period, also include in-memory data
-        in_memory_data = [d.to_dict() for d in health_data if d.timestamp >= cutoff_time]
-        
-        # Combine data, avoiding duplicates
-        all_data = db_data_dicts.copy()
-        for d in in_memory_data:
-            if not any(db_d['id'] == d['id'] for db_d in db_data_dicts):
-                all_data.append(d)
-                
-        # Sort by timestamp
-        all_data.sort(key=lambda x: x['timestamp'])
-        
-        # Limit results
-        limited_data = all_data[-limit:] if limit < len(all_data) else all_data
-        
-        # Get associated predictions from database
-        data_predictions = {}
-        for d in limited_data:
-            # Try database first
-            db_prediction = Prediction.query.filter_by(health_data_id=d['id']).first()
-            if db_prediction:
-                data_predictions[d['id']] = db_prediction.to_dict()
-            else:
-                # Try in-memory
-                for p in predictions:
-                    if p.health_data_id == d['id']:
-                        data_predictions[d['id']] = p.to_dict()
-                        break
+        columns, archived_predictions = _history_columns(cutoff_time, device_id, limit)
+        if since:
+            newer = columns['timestamp'] > since
+            if not newer.all():
+                columns = {name: column[newer] for name, column in columns.items()}
+        
+        if points:
+            # Chart history: vitals only, so no prediction lookups for the scanned rows
+            timestamps, series = _downsample_columns(columns, points)
+            count = max(len(series[name]) for name in VITAL_FIELDS)
+            return jsonify({
+                'status': 'success',
+                'format': 'columnar',
+                'downsampled': count < len(columns['timestamp']),
+                'source_count': len(columns['timestamp']),
+                'count': count,
+                'data': {
+                    'timestamps': {name: timestamps[name].tolist() for name in VITAL_FIELDS},
+                    **{name: series[name].tolist() for name in VITAL_FIELDS}
+                }
+            }), 200
+        
+        ids = columns['id'].tolist()
+        data_predictions = _history_predictions(ids, columns['device_id'].tolist(), archived_predictions)
+        
+        if response_format == 'rows':
+            return jsonify({
+                'status': 'success',
+                'data': _columns_to_dicts(columns),
+                'predictions': data_predictions
+            }), 200
+        
+        # Risk columns aligned with the readings
+        risks = {
+            name: np.array([data_predictions[i][name] if i in data_predictions else np.nan for i in ids],
+                           dtype=np.float64)
+            for name in RISK_FIELDS
+        }
+        
+        if response_format == 'binary':
+            return app.response_class(_history_binary(columns, risks), mimetype='application/octet-stream')
         
         return jsonify({
             'status': 'success',
-            'data': limited_data,
-            'predictions': data_predictions
+            'format': 'columnar',
+            'count': len(ids),
+            'data': {
+                'id': ids,
+                'device_id': columns['device_id'].tolist(),
+                'timestamp': columns['timestamp'].tolist(),
+                **{name: columns[name].tolist() for name in VITAL_FIELDS}
+            },
+            'predictions': {
+                name: [None if np.isnan(v) else v for v in risks[name].tolist()] for name in RISK_FIELDS
+            }
         }), 200
         
     except Exception as e:
@@ -323,25 +436,308 @@ def get_historical_data():
             'message': str(e)
         }), 400
 
+def _columns_to_dicts(columns):
+    """Convert history columns into history API row dicts"""
+    ids = columns['id'].tolist()
+    device_ids = columns['device_id'].tolist()
+    timestamps = columns['timestamp'].tolist()
+    vitals = {name: np.asarray(columns[name]).tolist() for name in VITAL_FIELDS}
+    return [
+        {
+            'id': ids[i],
+            'device_id': device_ids[i],
+            **{name: vitals[name][i] for name in VITAL_FIELDS},
+            'timestamp': timestamps[i]
+        }
+        for i in range(len(ids))
+    ]
+
+# API endpoint to get bucketed min/mean/max rollups for one device
+@app.route('/api/rollups', methods=['GET'])
+@read_replica
+@conditional
+def get_rollups():
+    try:
+        device_id = request.args.get('device_id')
+        if not device_id:
+            return jsonify({'status': 'error', 'message': 'device_id is required'}), 400
+        hours = int(request.args.get('hours', 24))
+        bucket = max(int(request.args.get('bucket', 3600)), 1)  # bucket size in seconds
+        cutoff_time = (datetime.utcnow() - timedelta(hours=hours)).isoformat()
+        
+        if app.config['HEALTHSENSE_READINGS_BACKEND'] == 'columnar':
+            columns = get_store().query(cutoff_time, device_id=device_id)
+        else:
+            with on_shard(shard_for(device_id)):
+                rows = (db.session.query(HealthData.timestamp, *[getattr(HealthData, f) for f in VITAL_FIELDS])
+                        .filter(HealthData.device_id == device_id, HealthData.timestamp >= cutoff_time)
+                        .order_by(HealthData.timestamp)
+                        .all())
+            columns = {'timestamp': np.array([to_epoch_us(r[0]) for r in rows], dtype=np.int64)}
+            for i, field in enumerate(VITAL_FIELDS, start=1):
+                columns[field] = np.array([r[i] for r in rows], dtype=np.float64)
+        
+        return jsonify({
+            'status': 'success',
+            'device_id': device_id,
+            'bucket_seconds': bucket,
+            'rollups': rollup_columns(columns, bucket)
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Error getting rollups: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+
+def _analytics_window():
+    """Read the since/until (or hours) window of an analytics request"""
+    hours = float(request.args.get('hours', 24))
+    start_time = request.args.get('since') or (datetime.utcnow() - timedelta(hours=hours)).isoformat()
+    return start_time, request.args.get('until')
+
+# Cohort API: devices ranked by their longest run of readings past a threshold,
+# e.g. ?vital=spo2&op=lt&value=92&min_minutes=10
+@app.route('/api/analytics/threshold-episodes', methods=['GET'])
+@read_replica
+@conditional
+def get_threshold_episodes():
+    try:
+        vital = request.args.get('vital', 'spo2')
+        op = request.args.get('op', 'lt')
+        value = float(request.args['value'])
+        min_seconds = float(request.args.get('min_minutes', 10)) * 60
+        limit = min(max(int(request.args.get('limit', 50)), 1), 1000)
+        start_time, end_time = _analytics_window()
+
+        if app.config['HEALTHSENSE_READINGS_BACKEND'] == 'columnar':
+            columns = get_store().query(start_time, end_time)
+            devices = threshold_episodes_columnar(columns, vital, op, value, min_seconds, limit)
+        else:
+            results = scatter(lambda: threshold_episodes(db.session, vital, op, value, min_seconds,
+                                                         start_time, end_time, limit))
+            devices = merge_rankings(results, episode_order, limit)
+
+        return jsonify({
+            'status': 'success',
+            'since': start_time,
+            'until': end_time,
+            'devices': devices
+        }), 200
+
+    except KeyError as e:
+        return jsonify({'status': 'error', 'message': f'{e.args[0]} is required'}), 400
+    except Exception as e:
+        logger.error(f"Error getting threshold episodes: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+
+# Cohort API: devices ranked by mean predicted risk, e.g. ?risk=heart_disease_risk&hours=168
+@app.route('/api/analytics/top-risk', methods=['GET'])
+@read_replica
+@conditional
+def get_top_risk_devices():
+    try:
+        risk = request.args.get('risk', 'heart_disease_risk')
+        limit = min(max(int(request.args.get('limit', 50)), 1), 1000)
+        min_readings = max(int(request.args.get('min_readings', 1)), 1)
+        start_time, end_time = _analytics_window()
+
+        results = scatter(lambda: top_devices_by_risk(db.session, risk, start_time, end_time, limit, min_readings))
+        devices = merge_rankings(results, risk_order, limit)
+
+        return jsonify({
+            'status': 'success',
+            'since': start_time,
+            'until': end_time,
+            'devices': devices
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Error getting top risk devices: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+
+# API endpoint listing known devices one page at a time, for the ward wall
+@app.route('/api/devices', methods=['GET'])
+@read_replica
+def get_devices():
+    try:
+        limit = min(max(int(request.args.get('limit', 500)), 1), 5000)
+        cursor = request.args.get('cursor')  # last device id of the previous page
+        
+        def page():
+            query = db.session.query(DeviceVersion.device_id, DeviceVersion.updated_at)
+            if cursor:
+                query = query.filter(DeviceVersion.device_id > cursor)
+            return [tuple(row) for row in query.order_by(DeviceVersion.device_id).limit(limit + 1)]
+        rows = merge_sorted(scatter(page), key=lambda row: row[0], limit=limit + 1)
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1][0]
+        return jsonify({
+            'status': 'success',
+            'devices': [{'device_id': device_id, 'updated_at': updated_at} for device_id, updated_at in rows],
+            'next_cursor': next_cursor
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Error listing devices: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+
+# Server-sent events for one device; resumes after the Last-Event-ID header
+# (or last_event_id query parameter, for clients that cannot set headers)
+@app.route('/api/stream/<device_id>', methods=['GET'])
+def stream_device(device_id):
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    return Response(sse_events(device_id, last_event_id), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # stop nginx from buffering the stream
+    })
+
+# Long-poll fallback for the device stream: waits up to `timeout` seconds for
+# events after `last_event_id`; pass the returned last_event_id next time
+@app.route('/api/stream/<device_id>/poll', methods=['GET'])
+def poll_device_stream(device_id):
+    try:
+        timeout = float(request.args.get('timeout', 25))
+        events, last_event_id, lagged = poll_events(device_id, request.args.get('last_event_id'), timeout)
+        return jsonify({
+            'status': 'success',
+            'events': events,
+            'last_event_id': last_event_id,
+            'lagged': lagged
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Error polling device stream: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+
+# API endpoint returning a device's anomaly detection baseline
+@app.route('/api/devices/<device_id>/baseline', methods=['GET'])
+@read_replica
+def get_device_baseline(device_id):
+    with on_shard(shard_for(device_id)):
+        baseline = db.session.get(DeviceBaseline, device_id)
+    if baseline is None:
+        return jsonify({'status': 'error', 'message': 'No baseline for this device'}), 404
+    return jsonify({
+        'status': 'success',
+        'baseline': baseline.to_dict()
+    }), 200
+
+# API endpoint exposing prediction cache hit rates for this worker
+@app.route('/api/ml/cache-stats', methods=['GET'])
+def get_prediction_cache_stats():
+    return jsonify({
+        'status': 'success',
+        'caches': prediction_cache_stats()
+    }), 200
+
+# API endpoint describing the active and shadow model versions of this worker
+@app.route('/api/ml/models', methods=['GET'])
+def get_model_status():
+    return jsonify({
+        'status': 'success',
+        **model_manager.status()
+    }), 200
+
+# API endpoint reporting connection pool waits and query times for this worker
+@app.route('/api/db/health', methods=['GET'])
+def get_db_health():
+    return jsonify({
+        'status': 'success',
+        **health_report(db.engines),
+        'replica': replica_status(),
+        'shards': shard_status()
+    }), 200
+
+# API endpoint receiving readings shipped by edge boxes (central server)
+@app.route('/api/sync/batch', methods=['POST'])
+def receive_sync_batch():
+    authorization = request.headers.get('Authorization', '')
+    if not SYNC_TOKEN or not hmac.compare_digest(authorization, f'Bearer {SYNC_TOKEN}'):
+        return jsonify({
+            'status': 'error',
+            'message': 'Sync is not enabled on this server or the token is wrong'
+        }), 403
+    try:
+        data = request.get_data()
+        if request.headers.get('Content-Encoding') == 'gzip':
+            data = decompress_sync_batch(data)
+        payload = json.loads(data)
+        inserted = apply_sync_batch(payload)
+        logger.info(f"Applied sync batch from {payload.get('edge_id')}: {inserted}")
+        return jsonify({
+            'status': 'success',
+            'inserted': inserted
+        }), 200
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error applying sync batch: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+
+# API endpoint showing readings an edge box has not shipped yet
+@app.route('/api/sync/status', methods=['GET'])
+def get_sync_status():
+    try:
+        return jsonify({
+            'status': 'success',
+            **sync_status()
+        }), 200
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+
 # API endpoint to acknowledge an alert
 @app.route('/api/alerts/<alert_id>/acknowledge', methods=['POST'])
+@read_your_writes
 def acknowledge_alert(alert_id):
     try:
-        # First check database
-        alert = Alert.query.get(alert_id)
-        if alert:
-            alert.acknowledged = True
-            db.session.commit()
+        # First check database; the alert id does not tell which shard holds it
+        owners = [shard for shard, found in scatter(lambda: Alert.query.get(alert_id) is not None) if found]
+        if owners:
+            with on_shard(owners[0]):
+                alert = Alert.query.get(alert_id)
+                device_id = alert.health_data.device_id
+                alert.acknowledged = True
+                bump_data_version(device_id)
+                db.session.commit()
+                alert_data = alert.to_dict()
+            # For transition period, also update the in-memory copy
+            for in_memory_alert in recent(alerts):
+                if in_memory_alert.id == alert_id:
+                    in_memory_alert.acknowledged = True
+            publish_acknowledged([alert_id], device_id)
             return jsonify({
                 'status': 'success',
                 'message': 'Alert acknowledged',
-                'alert': alert.to_dict()
+                'alert': alert_data
             }), 200
         
         # If not found in database, check in-memory (for transition period)
-        for in_memory_alert in alerts:
+        for in_memory_alert in recent(alerts):
             if in_memory_alert.id == alert_id:
                 in_memory_alert.acknowledged = True
+                publish_acknowledged([in_memory_alert.id])
                 return jsonify({
                     'status': 'success',
                     'message': 'Alert acknowledged',
@@ -360,27 +756,151 @@ def acknowledge_alert(alert_id):
             'message': str(e)
         }), 400
 
-# API endpoint to get all active alerts
+def _alert_filter_values(value):
+    """Split a comma-separated condition/severity filter into a list"""
+    return [v.strip() for v in value.split(',') if v.strip()] if value else []
+
+# API endpoint to acknowledge many alerts at once
+@app.route('/api/alerts/acknowledge', methods=['POST'])
+@read_your_writes
+def acknowledge_alerts():
+    try:
+        data = request.json or {}
+        ids = data.get('ids') or []
+        device_id = data.get('device_id')
+        conditions = _alert_filter_values(data.get('condition'))
+        start = data.get('start')
+        end = data.get('end')
+        
+        if not (ids or device_id or start or end):
+            return jsonify({
+                'status': 'error',
+                'message': 'Provide ids, device_id (optionally with condition) or a start/end time range'
+            }), 400
+        
+        # Build the selection once and use it for both the lookup and the update
+        criteria = [Alert.acknowledged.is_(False)]
+        if ids:
+            criteria.append(Alert.id.in_(ids))
+        if device_id:
+            criteria.append(Alert.health_data_id.in_(
+                select(HealthData.id).where(HealthData.device_id == device_id)
+            ))
+        if conditions:
+            criteria.append(Alert.condition.in_(conditions))
+        if start:
+            criteria.append(Alert.timestamp >= start)
+        if end:
+            criteria.append(Alert.timestamp < end)
+        
+        def acknowledge():
+            # One set-based UPDATE per shard; RETURNING hands back what it changed
+            statement = update(Alert).where(*criteria).values(acknowledged=True)
+            if db.session.get_bind(Alert.__mapper__).dialect.update_returning:
+                changed = db.session.execute(statement.returning(Alert.id, Alert.health_data_id)).all()
+            else:
+                changed = db.session.query(Alert.id, Alert.health_data_id).filter(*criteria).with_for_update().all()
+                db.session.execute(statement)
+            # The affected devices drive the version bumps and events
+            reading_ids = list({health_data_id for _, health_data_id in changed})
+            devices = {}
+            for chunk_start in range(0, len(reading_ids), 500):
+                devices.update(db.session.query(HealthData.id, HealthData.device_id)
+                               .filter(HealthData.id.in_(reading_ids[chunk_start:chunk_start + 500])))
+            affected = [(alert_id, devices.get(health_data_id)) for alert_id, health_data_id in changed]
+            for alert_device in set(devices.values()):
+                bump_data_version(alert_device)
+            db.session.commit()
+            return affected
+        
+        # One device's alerts are on its shard; other selections span every shard
+        affected = [row for _, rows in scatter(acknowledge, [shard_for(device_id)] if device_id else None)
+                    for row in rows]
+        by_device = {}
+        for alert_id, alert_device in affected:
+            by_device.setdefault(alert_device, []).append(alert_id)
+        acknowledged_ids = [alert_id for alert_id, _ in affected]
+        
+        # For transition period, also update in-memory alerts
+        acknowledged_set = set(acknowledged_ids) | set(ids)
+        for in_memory_alert in recent(alerts):
+            if in_memory_alert.id in acknowledged_set:
+                in_memory_alert.acknowledged = True
+        
+        for alert_device, alert_ids in by_device.items():
+            publish_acknowledged(alert_ids, alert_device)
+        
+        return jsonify({
+            'status': 'success',
+            'message': f'{len(acknowledged_ids)} alerts acknowledged',
+            'acknowledged': acknowledged_ids
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Error acknowledging alerts: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+
+def _encode_cursor(timestamp, alert_id):
+    return base64.urlsafe_b64encode(f"{timestamp}|{alert_id}".encode()).decode()
+
+def _decode_cursor(cursor):
+    timestamp, _, alert_id = base64.urlsafe_b64decode(cursor.encode()).decode().partition('|')
+    return timestamp, alert_id
+
+# API endpoint to get alerts, newest first, one page at a time
 @app.route('/api/alerts', methods=['GET'])
+@read_replica
+@conditional
 def get_alerts():
     try:
         # Get query parameters
         acknowledged = request.args.get('acknowledged', 'false').lower() == 'true'
+        since = request.args.get('since')  # only return alerts newer than this timestamp
+        device_id = request.args.get('device_id')
+        limit = min(int(request.args.get('limit', 100)), 500)
+        cursor = request.args.get('cursor')  # next_cursor from the previous page
+        conditions = _alert_filter_values(request.args.get('condition'))
+        severities = _alert_filter_values(request.args.get('severity'))
+        
+        # Query database for alerts; the (acknowledged, timestamp) index
+        # serves both the filter and the ordering
+        def newest_alerts():
+            query = (db.session.query(Alert, HealthData.device_id)
+                     .join(HealthData, Alert.health_data_id == HealthData.id)
+                     .filter(Alert.acknowledged.is_(acknowledged)))
+            if device_id:
+                query = query.filter(HealthData.device_id == device_id)
+            if conditions:
+                query = query.filter(Alert.condition.in_(conditions))
+            if severities:
+                query = query.filter(Alert.severity.in_(severities))
+            if since:
+                query = query.filter(Alert.timestamp > since)
+            if cursor:
+                cursor_timestamp, cursor_id = _decode_cursor(cursor)
+                query = query.filter(or_(Alert.timestamp < cursor_timestamp,
+                                         and_(Alert.timestamp == cursor_timestamp, Alert.id < cursor_id)))
+            rows = query.order_by(Alert.timestamp.desc(), Alert.id.desc()).limit(limit + 1)
+            return [{**a.to_dict(), 'device_id': alert_device} for a, alert_device in rows]
         
-        # Query database for alerts
-        db_alerts = Alert.query.filter_by(acknowledged=acknowledged).all()
-        filtered_alerts = [a.to_dict() for a in db_alerts]
+        # Each shard returns its newest page; the merged page is the newest of those
+        results = scatter(newest_alerts, [shard_for(device_id)] if device_id else None)
+        filtered_alerts = merge_sorted(results, key=lambda a: (a['timestamp'], a['id']), limit=limit + 1,
+                                       reverse=True)
         
-        # For transition period, also include in-memory alerts
-        for a in alerts:
-            if a.acknowledged == acknowledged:
-                # Only add if not already in list (avoid duplicates)
-                if not any(db_alert['id'] == a.id for db_alert in filtered_alerts):
-                    filtered_alerts.append(a.to_dict())
+        next_cursor = None
+        if len(filtered_alerts) > limit:
+            filtered_alerts = filtered_alerts[:limit]
+            next_cursor = _encode_cursor(filtered_alerts[-1]['timestamp'], filtered_alerts[-1]['id'])
         
+        # Every alert is committed at ingest, so pages come from the database only
         return jsonify({
             'status': 'success',
-            'alerts': filtered_alerts
+            'alerts': filtered_alerts,
+            'next_cursor': next_cursor
         }), 200
         
     except Exception as e:
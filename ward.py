@@ -0,0 +1,167 @@
+"""Ward wall: viewport subscriptions and rate-limited device summary frames
+
+The ward page shows one tile per device. A browser tells the server which
+tiles are on screen (socket event `ward_subscribe` with a list of device
+ids), and its socket joins the room `device:<id>` of exactly those devices.
+Readings from devices nobody is looking at produce no socket traffic.
+
+Ingest records a compact summary of each reading in a per-device slot. A
+background task flushes the slots every HEALTHSENSE_WARD_FRAME_INTERVAL
+seconds, so each device sends at most one `ward_frame` per interval however
+fast it reports. A frame is
+
+    {'d': device id, 't': timestamp, 'v': [glucose, systolic, diastolic, spo2, heart rate],
+     'r': [diabetes, heart disease, hypoxia risk], 'a': highest new alert severity or None}
+
+Subscriptions are per process, like the socket connections they belong to.
+With HEALTHSENSE_SOCKETIO_MESSAGE_QUEUE set, a device's watchers may be
+connected to another worker. Every worker then keeps frames for all the
+devices it ingests and emits them to their rooms through the queue: still
+one frame per device per interval.
+"""
+import logging
+import os
+import threading
+
+from flask import request
+from flask_socketio import join_room, leave_room
+
+from app import socketio, db
+from models import HealthData, Prediction, Alert, ALERT_SEVERITIES, VITAL_FIELDS
+from serving import SOCKETIO_MESSAGE_QUEUE
+from streams import lagging_sids, device_room
+from shards import on_shard, shard_for
+
+logger = logging.getLogger(__name__)
+
+# Seconds between frames of one device
+WARD_FRAME_INTERVAL = float(os.environ.get("HEALTHSENSE_WARD_FRAME_INTERVAL", 1.0))
+# Most devices one socket may watch at a time
+WARD_MAX_SUBSCRIPTIONS = int(os.environ.get("HEALTHSENSE_WARD_MAX_SUBSCRIPTIONS", 200))
+
+_lock = threading.Lock()
+_viewers = {}        # device id -> sids watching it
+_subscriptions = {}  # sid -> device ids it watches
+_pending = {}        # device id -> latest unsent frame
+_flusher_started = False
+
+def _max_severity(*severities):
+    ranked = [s for s in severities if s]
+    return max(ranked, key=ALERT_SEVERITIES.index) if ranked else None
+
+def summary_frame(reading, prediction=None, severity=None):
+    """Compact summary of one reading for the ward wall"""
+    risks = None
+    if prediction is not None:
+        risks = [round(prediction.diabetes_risk, 3), round(prediction.heart_disease_risk, 3),
+                 round(prediction.hypoxia_risk, 3)]
+    return {
+        'd': reading.device_id,
+        't': reading.timestamp,
+        'v': [getattr(reading, name) for name in VITAL_FIELDS],
+        'r': risks,
+        'a': severity
+    }
+
+def record_reading(reading, prediction, new_alerts):
+    """Queue a reading's summary for the next flush if anyone may watch the device"""
+    if SOCKETIO_MESSAGE_QUEUE:
+        if not _flusher_started:
+            _ensure_flusher()
+    elif reading.device_id not in _viewers:
+        return
+    frame = summary_frame(reading, prediction, _max_severity(*(a.severity for a in new_alerts)))
+    with _lock:
+        previous = _pending.get(reading.device_id)
+        # Coalesced readings must not hide an alert raised by an earlier one
+        if previous is not None:
+            frame['a'] = _max_severity(frame['a'], previous['a'])
+        _pending[reading.device_id] = frame
+
+def flush_frames():
+    """Emit the pending frame of every watched device; returns frames sent"""
+    with _lock:
+        frames = [frame for device_id, frame in _pending.items()
+                  if SOCKETIO_MESSAGE_QUEUE or device_id in _viewers]
+        _pending.clear()
+    # A lagging socket skips frames; the next one it takes has the latest state
+    skip = lagging_sids(socketio) if frames else []
+    for frame in frames:
+        socketio.emit('ward_frame', frame, to=device_room(frame['d']), skip_sid=skip)
+    return len(frames)
+
+def _flush_loop():
+    while True:
+        socketio.sleep(WARD_FRAME_INTERVAL)
+        try:
+            flush_frames()
+        except Exception as e:
+            logger.error(f"Error flushing ward frames: {e}")
+
+def _ensure_flusher():
+    global _flusher_started
+    with _lock:
+        if _flusher_started:
+            return
+        _flusher_started = True
+    socketio.start_background_task(_flush_loop)
+
+def snapshot_frames(device_ids):
+    """Current frames for devices a viewer just started watching"""
+    frames = []
+    for device_id in device_ids:
+        with on_shard(shard_for(device_id)):
+            reading = (HealthData.query
+                       .filter_by(device_id=device_id)
+                       .order_by(HealthData.timestamp.desc())
+                       .first())
+            if reading is None:
+                continue
+            prediction = Prediction.query.filter_by(health_data_id=reading.id).first()
+            open_severities = (db.session.query(Alert.severity)
+                               .join(HealthData, Alert.health_data_id == HealthData.id)
+                               .filter(HealthData.device_id == device_id, Alert.acknowledged.is_(False))
+                               .distinct())
+            frames.append(summary_frame(reading, prediction, _max_severity(*(row[0] for row in open_severities))))
+    return frames
+
+def set_subscriptions(sid, device_ids):
+    """Make a socket watch exactly device_ids; returns the newly added ids"""
+    wanted = list(dict.fromkeys(str(d) for d in device_ids))[:WARD_MAX_SUBSCRIPTIONS]
+    with _lock:
+        current = _subscriptions.get(sid, set())
+        added = [d for d in wanted if d not in current]
+        removed = current.difference(wanted)
+        for device_id in added:
+            _viewers.setdefault(device_id, set()).add(sid)
+        for device_id in removed:
+            sids = _viewers.get(device_id)
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del _viewers[device_id]
+                    _pending.pop(device_id, None)
+        if wanted:
+            _subscriptions[sid] = set(wanted)
+        else:
+            _subscriptions.pop(sid, None)
+    for device_id in removed:
+        leave_room(device_room(device_id), sid=sid)
+    for device_id in added:
+        join_room(device_room(device_id), sid=sid)
+    return added
+
+@socketio.on('ward_subscribe')
+def on_ward_subscribe(data):
+    try:
+        device_ids = (data or {}).get('devices') or []
+        added = set_subscriptions(request.sid, device_ids)
+        _ensure_flusher()
+        for frame in snapshot_frames(added):
+            socketio.emit('ward_frame', frame, to=request.sid)
+    except Exception as e:
+        logger.error(f"Error updating ward subscriptions: {e}")
+
+@socketio.on('disconnect')
+def on_ward_disconnect(*args):
+    set_subscriptions(request.sid, [])